@@ -27,6 +27,8 @@ def create_app(testing=False, live=False):
     # Our config - need to move everything here
     app.config['VIDEO_BUCKET_URL'] = "https://storage.googleapis.com/bhs-movies"
     app.config['IMAGE_BUCKET_URL'] = "https://storage.googleapis.com/bhs-flat-pics"
+    # maximum number of related documents to fetch for a single item
+    app.config['MAX_RELATED_DOCUMENTS'] = getattr(conf, 'max_related_documents', 100)
 
     # Set app config
     app.config['DEBUG'] = True
@@ -62,6 +64,15 @@ def create_app(testing=False, live=False):
 
     # CACHING
     app.config['CACHING_TTL'] = conf.caching_ttl
+    # tests reindex the same elasticsearch index over and over, don't cache there
+    app.config['CACHING_ENABLED'] = getattr(conf, 'caching_enabled', not testing)
+    # seconds to merge the cache invalidations of the migration writes
+    app.config['CACHING_INVALIDATION_DELAY'] = getattr(conf, 'caching_invalidation_delay', 60)
+    # in-process suggest index, suggestions are served by elasticsearch above this size
+    app.config['SUGGEST_INDEX_MAX_ENTRIES'] = getattr(conf, 'suggest_index_max_entries', 2000000)
+    app.config['SUGGEST_INDEX_SNAPSHOT'] = getattr(conf, 'suggest_index_snapshot', None)
+    # search the person place param in the all_places fields, set it once scripts/backfill_all_places.py ran
+    app.config['PERSONS_SEARCH_ALL_PLACES'] = getattr(conf, 'persons_search_all_places', False)
 
     app.mail = Mail(app)
     app.db = MongoEngine(app)
@@ -0,0 +1,227 @@
+"""
+redis backed caching of expensive query results
+
+cached values are stored under a key built from the normalized query
+parameters and a per-namespace generation number. invalidating a namespace
+bumps its generation, so all the previously cached values are simply never
+read again and expire with the CACHING_TTL. the scripts which write to the
+search index invalidate the namespaces when they are done. the migration
+tasks write docs all the time, so they invalidate with a delay - the
+invalidations of all the writes during the delay are merged into one.
+
+objects which are expensive to build from the search index (e.g. the linkify
+title matcher) are kept per worker, see get_worker_cached. they are rebuilt
+after CACHING_TTL, or when the scripts which rewrite the search index
+invalidate the "search_index" namespace.
+"""
+import json
+import hashlib
+import logging
+import time
+import threading
+import redis
+from flask import current_app
+
+
+def _get_app(app=None):
+    return app if app else current_app
+
+
+def is_caching_enabled(app=None):
+    app = _get_app(app)
+    return bool(app.config.get('CACHING_ENABLED')
+                and getattr(app, 'redis', None)
+                and app.config.get('CACHING_TTL'))
+
+
+def _get_generation_key(namespace, app):
+    return 'cache_gen:{}:{}'.format(namespace, app.es_data_db_index_name)
+
+
+def _get_pending_key(namespace, app):
+    return 'cache_pending:{}:{}'.format(namespace, app.es_data_db_index_name)
+
+
+def _get_stats_key(namespace, app):
+    return 'cache_stats:{}:{}'.format(namespace, app.es_data_db_index_name)
+
+
+def get_cache_key(namespace, params, generation=0, app=None):
+    ''' returns a redis key for the given query params
+    >>> app = type('MockApp', (object,), {'es_data_db_index_name': 'bhdata'})
+    >>> get_cache_key('search', {'q': 'cohen', 'size': 15}, app=app)
+    'cache:search:bhdata:0:b74d4c0b10ceec70991d669ef690840c4316cfca'
+    >>> get_cache_key('search', {'size': 15, 'q': 'cohen'}, app=app) == get_cache_key('search', {'q': 'cohen', 'size': 15}, app=app)
+    True
+    '''
+    app = _get_app(app)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+    return 'cache:{}:{}:{}:{}'.format(namespace, app.es_data_db_index_name,
+                                      generation, digest)
+
+
+def get_cache_generation(namespace, app=None):
+    ''' returns the current generation of the namespace, it changes whenever
+        the namespace is invalidated
+    '''
+    app = _get_app(app)
+    if not getattr(app, 'redis', None):
+        return 0
+    try:
+        return _get_generation(namespace, app)
+    except redis.RedisError as e:
+        logging.exception(e)
+        return 0
+
+
+def _get_generation(namespace, app):
+    ''' returns the generation, after applying a delayed invalidation which is due '''
+    generation_key, pending_key = _get_generation_key(namespace, app), _get_pending_key(namespace, app)
+    generation, pending = app.redis.mget(generation_key, pending_key)
+    # only one of the readers who see it due gets to delete the pending invalidation
+    if pending and float(pending) <= time.time() and app.redis.delete(pending_key):
+        generation = app.redis.incr(generation_key)
+    return int(generation or 0)
+
+
+def get_cached(namespace, params, compute, app=None):
+    ''' return the cached value for `params`, or call `compute` to get it.
+        `compute` must return a json serializable value.
+        errors raised by `compute` are not cached and are propagated to the
+        caller, redis errors are logged and the value is computed as usual.
+    '''
+    app = _get_app(app)
+    if not is_caching_enabled(app):
+        return compute()
+    try:
+        generation = _get_generation(namespace, app)
+        key = get_cache_key(namespace, params, generation, app)
+        cached = app.redis.get(key)
+    except redis.RedisError as e:
+        logging.exception(e)
+        return compute()
+    stats_key = _get_stats_key(namespace, app)
+    if cached:
+        cached = json.loads(cached)
+        try:
+            pipe = app.redis.pipeline()
+            pipe.hincrby(stats_key, 'hits', 1)
+            pipe.hincrbyfloat(stats_key, 'saved_ms', cached['took_ms'])
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.exception(e)
+        return cached['value']
+    started = time.time()
+    value = compute()
+    took_ms = (time.time() - started) * 1000
+    try:
+        pipe = app.redis.pipeline()
+        pipe.setex(key, app.config['CACHING_TTL'],
+                   json.dumps({'value': value, 'took_ms': took_ms}))
+        pipe.hincrby(stats_key, 'misses', 1)
+        pipe.hincrbyfloat(stats_key, 'miss_ms', took_ms)
+        pipe.execute()
+    except (redis.RedisError, TypeError, ValueError) as e:
+        logging.exception(e)
+    return value
+
+
+def invalidate_cache(namespace, app=None, delay=None):
+    ''' make all the values cached so far for the namespace unreachable.
+        with a delay (seconds) the namespace is invalidated by the first read
+        after it, and other delayed invalidations until then are merged into it.
+    '''
+    app = _get_app(app)
+    if getattr(app, 'redis', None):
+        try:
+            if delay:
+                # expires in case there are no reads, the values cached before it expire by then as well
+                app.redis.set(_get_pending_key(namespace, app), time.time() + delay, nx=True,
+                              ex=int(delay + (app.config.get('CACHING_TTL') or 0)))
+            else:
+                app.redis.incr(_get_generation_key(namespace, app))
+        except redis.RedisError as e:
+            logging.exception(e)
+
+
+def get_cache_stats(namespace, app=None):
+    ''' returns the hit ratio and the time saved by the namespace cache '''
+    app = _get_app(app)
+    stats = {'enabled': is_caching_enabled(app), 'hits': 0, 'misses': 0,
+             'hit_ratio': 0.0, 'saved_ms': 0.0, 'avg_miss_ms': 0.0}
+    if getattr(app, 'redis', None):
+        try:
+            raw = app.redis.hgetall(_get_stats_key(namespace, app))
+        except redis.RedisError as e:
+            logging.exception(e)
+            raw = {}
+        stats['hits'] = int(raw.get('hits', 0))
+        stats['misses'] = int(raw.get('misses', 0))
+        stats['saved_ms'] = float(raw.get('saved_ms', 0))
+        total = stats['hits'] + stats['misses']
+        if total:
+            stats['hit_ratio'] = float(stats['hits']) / total
+        if stats['misses']:
+            stats['avg_miss_ms'] = float(raw.get('miss_ms', 0)) / stats['misses']
+    return stats
+
+
+_worker_objects = {}
+_worker_objects_lock = threading.Lock()
+
+
+def _build_worker_object(app, key, build):
+    generation = get_cache_generation("search_index", app)
+    started = time.time()
+    obj = build(app)
+    app.logger.info("built {} in {:.2f} seconds".format(key[0], time.time() - started))
+    _worker_objects[key] = {"object": obj, "built_at": started, "generation": generation}
+    return _worker_objects[key]
+
+
+def _refresh_worker_object(app, key, build):
+    try:
+        _build_worker_object(app, key, build)
+    except Exception as e:
+        logging.exception(e)
+        # keep serving the stale object, refresh will be retried on the next request
+        with _worker_objects_lock:
+            state = _worker_objects.get(key)
+            if state:
+                state.pop("refreshing", None)
+
+
+def _start_refresh(app, key, build, state):
+    with _worker_objects_lock:
+        start_refresh = not state.get("refreshing")
+        state["refreshing"] = True
+    if start_refresh:
+        thread = threading.Thread(target=_refresh_worker_object, args=(app, key, build))
+        thread.daemon = True
+        thread.start()
+
+
+def get_worker_cached(name, build, app=None, wait=True):
+    ''' returns an object which is built from the search index once per worker.
+        `build(app)` creates the object on first use and refreshes it in a
+        background thread once it's older than CACHING_TTL or when the
+        "search_index" namespace is invalidated.
+        with wait=False the first build is done in the background as well and
+        None is returned until the object is ready.
+    '''
+    # the refresh thread runs outside of the request context
+    app = app if app else current_app._get_current_object()
+    if not is_caching_enabled(app):
+        return build(app) if wait else None
+    key = (name, app.es_data_db_index_name)
+    state = _worker_objects.get(key)
+    if not state:
+        if wait:
+            return _build_worker_object(app, key, build)["object"]
+        with _worker_objects_lock:
+            state = _worker_objects.setdefault(key, {"object": None, "built_at": 0, "generation": None})
+        _start_refresh(app, key, build, state)
+    elif (time.time() - state["built_at"] > app.config['CACHING_TTL']
+          or get_cache_generation("search_index", app) != state["generation"]):
+        _start_refresh(app, key, build, state)
+    return state["object"]
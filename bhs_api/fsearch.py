@@ -1,7 +1,11 @@
 import logging
 import re
+import json
+import base64
+import pymongo
 from flask import abort, current_app
 from bhs_api import phonetic
+from bhs_api.cache import get_cached, is_caching_enabled
 from bhs_api.persons import is_living_person, LIVING_PERSON_WHITELISTED_KEYS
 
 MAX_RESULTS = 30  # aka chunk size
@@ -10,6 +14,14 @@ MAX_COUNT_RESULTS = -1  # maximum number of results to count for the total resul
                         # frontend can pass on a max_count_results parameter to specify a different number
                         # once frontend is modified to support the limit on count results, this default can be
                         # changed to e.g. 1000
+CAPPED_COUNT_RESULTS = 1000  # maximum number of results to count in capped mode, unless max_count_results is passed
+
+# ways to get the total results:
+# exact - count all the matching persons
+# capped - count up to max_count_results persons, total_capped is set if there are more
+# cached - the exact count, cached in redis per query for CACHING_TTL or until
+#          the migration writes persons
+COUNT_MODES = ("exact", "capped", "cached")
 
 ARGS_TO_INDEX = {'first_name':       'name_lc.0',
                  'last_name':        'name_lc.1',
@@ -21,6 +33,12 @@ ARGS_TO_INDEX = {'first_name':       'name_lc.0',
                  'place':            'filler_lc', # a dummy field name
                  }
 
+# results are sorted by the unique key of the persons, which allows paging with a
+# cursor that points to the last person of the previous page
+CURSOR_SORT = [('tree_num', pymongo.ASCENDING),
+               ('tree_version', pymongo.ASCENDING),
+               ('id', pymongo.ASCENDING)]
+
 PROJECTION = {'name': 1,
               'parents': 1,
               'partners': 1,
@@ -37,8 +55,12 @@ def _generate_year_range(year, fudge_factor=0):
     return {'min': minimum, 'max': maximum}
 
 
-def build_query(search_dict):
-    ''' build a mongo search query based on the search_dict '''
+def build_query(search_dict, all_places=False):
+    ''' build a mongo search query based on the search_dict
+
+    the place param is searched in the all_places_lc / all_places_S fields
+    if all_places is set, or else in an $or of all the place fields
+    '''
     names_and_places = {}
     years = {}
     # Set up optional queries
@@ -131,15 +153,15 @@ def build_query(search_dict):
     for param, item in names_and_places.items():
         # the names_and_places array contains only known/indexed fields (see above)
         for k, v in item.items():
-            # place is an or of all place fields
             if param == 'place':
-                if k.endswith('S'):
-                    s = 'S'
+                s = 'S' if k.endswith('S') else 'lc'
+                if all_places:
+                    # the multikey field of all the place fields
+                    search_query['all_places_' + s] = v
                 else:
-                    s = '_lc'
-                search_query['$or'] = [{'BIRT_PLAC' + s: v},
-                                       {'MARR_PLAC' + s: v},
-                                       {'DEAT_PLAC' + s: v}]
+                    search_query['$or'] = [{'BIRT_PLAC_' + s: v},
+                                           {'MARR_PLAC_' + s: v},
+                                           {'DEAT_PLAC_' + s: v}]
 
             else:
                 search_query[k] = v
@@ -159,6 +181,42 @@ def build_query(search_dict):
     return search_query
 
 
+def encode_cursor(person):
+    ''' returns an opaque token pointing to the person
+    >>> decode_cursor(encode_cursor({'tree_num': 2, 'tree_version': 1, 'id': 'I7'}))
+    [2, 1, u'I7']
+    '''
+    return base64.urlsafe_b64encode(json.dumps([person.get(key) for key, _ in CURSOR_SORT]))
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        abort(400, 'Invalid cursor')
+    if not isinstance(key, list) or len(key) != len(CURSOR_SORT):
+        abort(400, 'Invalid cursor')
+    return key
+
+
+def build_cursor_query(cursor):
+    ''' returns a query for the persons which come after the cursor in CURSOR_SORT order
+    >>> build_cursor_query(encode_cursor({'tree_num': 2, 'tree_version': 1, 'id': 'I7'})) == {'$or': [
+    ...     {'tree_num': {'$gt': 2}},
+    ...     {'tree_num': 2, 'tree_version': {'$gt': 1}},
+    ...     {'tree_num': 2, 'tree_version': 1, 'id': {'$gt': u'I7'}}]}
+    True
+    '''
+    key = decode_cursor(cursor)
+    fields = [field for field, _ in CURSOR_SORT]
+    or_query = []
+    for i, field in enumerate(fields):
+        q = dict(zip(fields[:i], key[:i]))
+        q[field] = {'$gt': key[i]}
+        or_query.append(q)
+    return {'$or': or_query}
+
+
 def build_search_dict(**kwargs):
     search_dict = {}
     for key, value in kwargs.items():
@@ -168,7 +226,23 @@ def build_search_dict(**kwargs):
     return search_dict
 
 
-def fsearch(max_results=None, db=None, max_count_results=None, **kwargs):
+def count_persons(collection, search_query, search_dict, mode, max_count_results):
+    ''' returns a (total, mode, total_capped) tuple, mode is the one that was
+        actually used - cached falls back to exact when caching is disabled
+    '''
+    if mode == "capped":
+        if max_count_results == -1:
+            max_count_results = CAPPED_COUNT_RESULTS
+        total = collection.find(search_query).limit(max_count_results + 1).count(True)
+        return min(total, max_count_results), mode, total > max_count_results
+    count = lambda: collection.find(search_query).count()
+    if mode == "cached" and is_caching_enabled():
+        params = {k: v for k, v in search_dict.items() if k not in ('start', 'cursor')}
+        return get_cached("persons_count", params, count), mode, False
+    return count(), "exact", False
+
+
+def fsearch(max_results=None, db=None, max_count_results=None, count=None, **kwargs):
     '''
     Search in the genTreeIindividuals table.
     Names and places could be matched exactly, by the prefix match
@@ -178,19 +252,34 @@ def fsearch(max_results=None, db=None, max_count_results=None, **kwargs):
     Years could be specified with a fudge factor - 1907~2 will match
     1905, 1906, 1907, 1908 and 1909.
     If `tree_number` kwarg is present, return only the results from this tree.
-    Return up to `MAX_RESULTS` starting with the `start` argument
+    Return up to `MAX_RESULTS` starting with the `start` argument, or after the
+    `cursor` argument - the `next_cursor` of the previous page. Paging with a
+    cursor costs the same for all the pages while `start` has to skip all the
+    previous results. The first page and the cursor pages are sorted by
+    CURSOR_SORT. Name searches read them in order from the name + CURSOR_SORT
+    indexes (see migration.indices), other searches sort all their matches,
+    keeping only the top `MAX_RESULTS` in memory.
+    `start` pages are not sorted, as the sort would have to keep all the
+    skipped persons in memory, and have no `next_cursor`.
+    The total is counted according to the `count` argument, one of COUNT_MODES.
+    Returns a dict with the total, count_mode, total_capped, items and next_cursor.
     '''
     max_results = max_results[0] if isinstance(max_results, (list, tuple)) else max_results
     max_count_results = max_count_results[0] if isinstance(max_count_results, (list, tuple)) else max_count_results
     max_results = int(MAX_RESULTS if not max_results else max_results)
     max_count_results = int(MAX_COUNT_RESULTS if not max_count_results else max_count_results)
+    count = count[0] if isinstance(count, (list, tuple)) else count
+    if not count:
+        count = "exact" if max_count_results == -1 else "capped"
+    elif count not in COUNT_MODES:
+        abort(400, 'count must be one of {}'.format(", ".join(COUNT_MODES)))
     if db:
         collection = db['persons']
     else:
         collection = current_app.data_db['persons']
     search_dict = build_search_dict(**kwargs)
 
-    search_query = build_query(search_dict)
+    search_query = build_query(search_dict, current_app.config.get('PERSONS_SEARCH_ALL_PLACES'))
     projection = {
         'name': 1,
         'parents': 1,
@@ -209,17 +298,21 @@ def fsearch(max_results=None, db=None, max_count_results=None, **kwargs):
         "marriage_years": 1
     }
 
-    if max_count_results == -1:
-        total = collection.find(search_query).count()
-    else:
-        total = collection.find(search_query).limit(max_count_results).count(True)
+    total, count, total_capped = count_persons(collection, search_query, search_dict, count, max_count_results)
 
+    if 'cursor' in search_dict:
+        search_query.setdefault('$and', []).append(build_cursor_query(search_dict['cursor']))
+    start = int(search_dict['start']) if 'start' in search_dict and 'cursor' not in search_dict else 0
     results = collection.find(search_query, projection)
-    if 'start' in search_dict:
-        results = results.skip(int(search_dict['start']))
+    if start:
+        results = results.skip(start)
+    else:
+        results = results.sort(CURSOR_SORT)
     results = map(clean_person, results.limit(max_results))
     logging.debug('FSearch query:\n{} returning {} results'.format(search_query, len(results)))
-    return total, results
+    next_cursor = encode_cursor(results[-1]) if results and len(results) == max_results and not start else None
+    return {"total": total, "count_mode": count, "total_capped": total_capped,
+            "items": results, "next_cursor": next_cursor}
 
 
 def clean_person(person):
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Daitch-Mokotoff soundex of hebrew names
+
+a port of hebrew_dm_server.js (c) Stephen P. Morse, which used to run as a
+node server on localhost:8765, the rule tables and the quirks of the
+original code are kept so the codes stay the same as the ones already
+stored in the db.
+"""
+
+ALEF = u'א'
+BAIS = u'ב'
+GIMEL = u'ג'
+DALET = u'ד'
+HAY = u'ה'
+VAV = u'ו'
+ZAYIN = u'ז'
+KHESS = u'ח'
+TESS = u'ט'
+YUD = u'י'
+KHAF2 = u'ך'
+KAF = u'כ'
+LAMED = u'ל'
+MEM2 = u'ם'
+MEM = u'מ'
+NUN2 = u'ן'
+NUN = u'נ'
+SAMEKH = u'ס'
+AYIN = u'ע'
+FAY2 = u'ף'
+PAY = u'פ'
+TSADI2 = u'ץ'
+TSADI = u'צ'
+KUF = u'ק'
+RAISH = u'ר'
+SHIN = u'ש'
+TAF = u'ת'
+
+# vowels for the dm rules, the vowels for inserting alternates are in IsVowel
+_RULE_VOWELS = (ALEF, AYIN, VAV)
+_VOWELS = (ALEF, AYIN, YUD)
+
+# (letters, code at start, code before a vowel, code elsewhere), None marks a vowel
+_NEW_RULES = [
+    (ZAYIN + DALET + ZAYIN, "2", "4", "4"),
+    (SAMEKH + TESS + SHIN, "2", "4", "4"),
+    (SAMEKH + TESS + ZAYIN, "2", "4", "4"),
+    (SAMEKH + TAF + ZAYIN, "2", "4", "4"),
+    (SAMEKH + TAF + SHIN, "2", "4", "4"),
+    (SHIN + TESS + SHIN, "2", "4", "4"),
+    (SHIN + TESS + ZAYIN, "2", "4", "4"),
+    (SHIN + TAF + SHIN, "2", "4", "4"),
+    (SHIN + TAF + ZAYIN, "2", "4", "4"),
+    (YUD + YUD + AYIN, "1", "1", "1"),
+    (YUD + YUD + HAY, "1", "1", "1"),
+    (DALET + SAMEKH, "4", "4", "4"),
+    (DALET + SHIN, "4", "4", "4"),
+    (DALET + ZAYIN, "4", "4", "4"),
+    (KHESS + SAMEKH, "5", "54", "54"),
+    (TESS + SHIN, "4", "4", "4"),
+    (KHESS + SHIN, "5", "54", "54"),
+    (KAF + SAMEKH, "5", "54", "54"),
+    (KAF + SHIN, "5", "54", "54"),
+    (MEM + NUN, "66", "66", "66"),
+    (MEM + NUN2, "66", "66", "66"),
+    (NUN + MEM, "66", "66", "66"),
+    (NUN + MEM2, "66", "66", "66"),
+    (PAY + BAIS, "7", "7", "7"),
+    (KUF + SAMEKH, "5", "54", "54"),
+    (KUF + SHIN, "5", "54", "54"),
+    (SAMEKH + DALET, "2", "43", "43"),
+    (SAMEKH + TESS, "2", "43", "43"),
+    (SAMEKH + TAF, "2", "43", "43"),
+    (SHIN + DALET, "2", "43", "43"),
+    (SHIN + TESS, "2", "43", "43"),
+    (SHIN + TAF, "2", "43", "43"),
+    (TAF + SHIN, "4", "4", "4"),
+    (ZAYIN + SHIN, "4", "4", "4"),
+    (ALEF + VAV, "0", "7", None),
+    (YUD + VAV, "1", None, None),
+    (YUD + ALEF, "1", "1", "1"),
+    (ALEF, "0", None, None),
+    (BAIS, "7", "7", "7"),
+    (GIMEL, "5", "5", "5"),
+    (DALET, "3", "3", "3"),
+    (HAY, "5", "5", None),
+    (VAV, "7", "7", "7"),
+    (ZAYIN, "4", "4", "4"),
+    (KHESS, "5", "5", "5"),
+    (TESS, "3", "3", "3"),
+    (YUD, "1", "1", None),
+    (KAF, "5", "5", "5"),
+    (KHAF2, "5", "5", "5"),
+    (LAMED, "8", "8", "8"),
+    (MEM, "6", "6", "6"),
+    (MEM2, "6", "6", "6"),
+    (NUN, "6", "6", "6"),
+    (NUN2, "6", "6", "6"),
+    (SAMEKH, "4", "4", "4"),
+    (AYIN, "0", None, None),
+    (PAY, "7", "7", "7"),
+    (FAY2, "7", "7", "7"),
+    (TSADI, "4", "4", "4"),
+    (TSADI2, "4", "4", "4"),
+    (KUF, "5", "5", "5"),
+    (RAISH, "9", "9", "9"),
+    (SHIN, "4", "4", "4"),
+    (TAF, "3", "3", "3"),
+]
+
+# the sephardic alternatives, these letters branch the codes in two
+_BRANCHING_RULES = {
+    YUD + ALEF: ("1", None, None),
+    YUD + VAV: ("1", "1", "1"),
+    VAV: ("7", None, None),
+}
+
+# rules by first letter, longest first (same as their order in _NEW_RULES)
+_RULES = {}
+for _rule in _NEW_RULES:
+    _RULES.setdefault(_rule[0][0], []).append(_rule)
+
+CODE_LENGTH = 6
+
+
+def _append_code(codes, last_codes, ii, code, is_vowel):
+    if not is_vowel and code != last_codes[ii]:
+        last_codes[ii] = code
+        codes[ii] += code
+        return True
+    return False
+
+
+def _word_soundex(word):
+    ''' the dm codes of a word which only has hebrew letters (soundex2 in the js) '''
+    codes, last_codes = [""], [""]
+    first = True
+    pos = 0
+    while pos < len(word):
+        for letters, start_code, vowel_code, other_code in _RULES[word[pos]]:
+            if word.startswith(letters, pos):
+                break
+        branch = _BRANCHING_RULES.get(letters)
+        if branch:
+            codes += codes
+            last_codes += last_codes
+        pos += len(letters)
+        if first:
+            first = False
+            codes[0] = last_codes[0] = start_code
+            if branch:
+                codes[1] = last_codes[1] = branch[0]
+            continue
+        num_codes = len(codes)
+        half = num_codes / 2 if num_codes > 1 else 1
+        # the js compares the "elsewhere" code to 999 in both cases
+        resets = other_code is None
+        if pos < len(word) and word[pos] in _RULE_VOWELS:
+            code = vowel_code
+            branch_code = branch[1] if branch else None
+        else:
+            code = other_code
+            branch_code = branch[2] if branch else None
+        for ii in range(half):
+            if not _append_code(codes, last_codes, ii, code, code is None) and resets:
+                last_codes[ii] = ""
+        for ii in range(half, num_codes):
+            if branch:
+                if not _append_code(codes, last_codes, ii, branch_code, branch_code is None):
+                    if branch_code is None or resets:
+                        last_codes[ii] = ""
+            elif not _append_code(codes, last_codes, ii, code, code is None) and resets:
+                last_codes[ii] = ""
+    res = []
+    for code in codes:
+        code = (code + "0" * CODE_LENGTH)[:CODE_LENGTH]
+        if code not in res:
+            res.append(code)
+    return res
+
+
+def _fix_vav(text):
+    ''' single VAV after BAIS/PAY or before MEM/NUN is a vowel, double VAV is
+        a consonant, double YUD is a vowel unless it's YUD YUD AYIN or a final
+        YUD YUD HAY
+    '''
+    res = []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        prev_char = text[i - 1] if i > 0 else u""
+        next_char = text[i + 1] if i + 1 < len(text) else u""
+        next_next_char = text[i + 2] if i + 2 < len(text) else u""
+        if ch == VAV:
+            if next_char == VAV:
+                ch = BAIS
+                i += 1
+            elif next_char in (MEM, MEM2, NUN, NUN2):
+                ch = AYIN
+            elif prev_char in (BAIS, PAY):
+                ch = AYIN
+        elif ch == YUD and next_char == YUD:
+            if i == len(text) - 3 and next_next_char == HAY:
+                ch = YUD + YUD + HAY
+                i += 2
+            elif i <= len(text) - 3 and next_next_char == AYIN:
+                ch = YUD + YUD + AYIN
+                i += 2
+            else:
+                ch = AYIN
+                i += 1
+        res.append(ch)
+        i += 1
+    return u"".join(res)
+
+
+def _alternates(text):
+    ''' the hebrew letters of the word, with and without a vowel between
+        every two consonants
+    '''
+    alternates = [u""]
+    for i, ch in enumerate(text):
+        if ch < ALEF or ch > TAF:
+            continue
+        alternates = [alternate + ch for alternate in alternates]
+        if (i != len(text) - 1 and text[i] not in _VOWELS and text[i + 1] not in _VOWELS
+                and not (text[i] == VAV and text[i + 1] == VAV)):
+            alternates += [alternate + AYIN for alternate in alternates]
+    return alternates
+
+
+def hebrew_dm_soundex(name):
+    ''' returns the space separated dm codes of all the words in the name,
+        e.g. u"194860 197486" for jerusalem
+    '''
+    words_codes = []
+    for word in _fix_vav(name).split(u" "):
+        codes = set()
+        for alternate in _alternates(word):
+            if alternate:
+                codes.update(_word_soundex(alternate))
+        words_codes.append(u" ".join(sorted(codes)))
+    res = u""
+    for word_codes in words_codes:
+        if res:
+            res += u" "
+        res += word_codes
+    return res
+
+
+def hebrew_dm_soundex_many(names):
+    ''' returns a list with the dm codes of each of the names '''
+    cache = {}
+    res = []
+    for name in names:
+        if name not in cache:
+            cache[name] = hebrew_dm_soundex(name)
+        res.append(cache[name])
+    return res
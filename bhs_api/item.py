@@ -164,27 +164,44 @@ def _make_serializable(obj):
     return obj
 
 def fetch_items(slug_list, full=False):
+    '''
+    Gets the items of all the slugs using a single elasticsearch request.
+    Returns a list in the order of `slug_list`, with an error dict in place of
+    every bad or missing slug.
+    '''
     rv = []
+    slugs, errors = {}, {}
     for slug in slug_list:
         try:
-            item = fetch_item(slug, full=full)
+            slugs[slug] = parse_slug(slug)
+        except NotFound as e:
+            errors[slug] = e
+    items = get_items(slugs.values(), full=full)
+    for slug in slug_list:
+        item = items.get(slugs[slug].full) if slug in slugs else None
+        if item:
             rv.append(item)
-        except (Forbidden, NotFound) as e:
+        else:
+            e = errors.get(slug, NotFound())
             rv.append({'slug': slug, 'error_code': e.code, 'msg': e.description})
     return rv
 
 
-def fetch_item(slug, full=False):
-    """
-    Gets an item based on slug and returns it
-    If slug is bad or item is not found, raises an exception.
-    """
+def parse_slug(slug):
     try:
-        slug = Slug(slug)
+        return Slug(slug)
     except ValueError as e:
         raise NotFound, "missing an underscore in item's slug: {}".format(e)
     except KeyError as e:
         raise NotFound, "bad collection name in slug: {}".format(e)
+
+
+def fetch_item(slug, full=False):
+    """
+    Gets an item based on slug and returns it
+    If slug is bad or item is not found, raises an exception.
+    """
+    slug = parse_slug(slug)
     item = get_item(slug, full=full)
     if item:
         return item
@@ -206,9 +223,14 @@ def fetch_item(slug, full=False):
     # else:
 
 def hits_to_docs(hits, full=False):
+    if full:
+        # fetch the related documents of all the hits together
+        related_items = fetch_related_items(get_related_item_ids(hit["_source"]) for hit in hits)
+    else:
+        related_items = None
     for hit in hits:
         doc = hit["_source"]
-        enrich_item(doc, full=full)
+        enrich_item(doc, full=full, related_items=related_items)
         yield doc
 
 def html_to_text(html):
@@ -218,23 +240,52 @@ def html_to_text(html):
     else:
         return html
 
-def fetch_related_item(item_id):
-    es_doc = None
-    try:
-        es_doc = current_app.es.get(index=current_app.es_data_db_index_name,
-                                              id=item_id,
-                                              doc_type=PIPELINES_ES_DOC_TYPE)
-    except Exception as e:
-        logging.exception(e)
-    if es_doc:
-        return enrich_item(es_doc["_source"])
-    else:
-        return False
+def get_related_item_ids(item):
+    """
+    returns a dict of related documents field id to the list of related item ids,
+    up to MAX_RELATED_DOCUMENTS ids for the whole item
+    """
+    max_related = current_app.config.get('MAX_RELATED_DOCUMENTS')
+    rv, num_ids = {}, 0
+    if item.get("source") == "clearmash":
+        for k in sorted(item.keys()):
+            if k.startswith("related_documents_"):
+                ids = item[k]
+                if max_related is not None:
+                    ids = ids[:max(0, max_related - num_ids)]
+                rv[k.replace("related_documents_", "")] = ids
+                num_ids += len(ids)
+    return rv
+
+def fetch_related_items(related_item_ids):
+    """
+    gets an iterable of the dicts returned from get_related_item_ids
+    returns a dict of item id to the enriched item, or False for missing items
+    all the items are fetched using a single elasticsearch mget request
+    """
+    item_ids = set()
+    for field_ids in related_item_ids:
+        for ids in field_ids.values():
+            item_ids.update(ids)
+    rv = {item_id: False for item_id in item_ids}
+    if item_ids:
+        try:
+            res = current_app.es.mget(index=current_app.es_data_db_index_name,
+                                      doc_type=PIPELINES_ES_DOC_TYPE,
+                                      body={"ids": list(item_ids)})
+        except Exception as e:
+            logging.exception(e)
+        else:
+            for es_doc in res["docs"]:
+                if es_doc.get("found"):
+                    rv[es_doc["_id"]] = enrich_item(es_doc["_source"])
+    return rv
 
-def enrich_item(item, full=False):
+def enrich_item(item, full=False, related_items=None):
     """
     ensure item has all needed attributes before returning it via API
     :param item: a new ES document
+    :param related_items: prefetched related items, as returned from fetch_related_items
     :return: enriched item
     """
     collection_name = item.get("collection", None)  # all new ES items have collection attribute
@@ -254,18 +305,14 @@ def enrich_item(item, full=False):
             except Exception as e:
                 logging.exception(e)
                 pass
+            related_item_ids = get_related_item_ids(item)
+            if related_items is None:
+                related_items = fetch_related_items([related_item_ids])
             item["related_documents"] = {}
-            fetched_items = {}
-            for k, v in item.items():
-                if k.startswith("related_documents_"):
-                    field_id = k.replace("related_documents_", "")
-                    item["related_documents"][field_id] = []
-                    for item_id in v:
-                        if item_id not in fetched_items:
-                            fetched_items[item_id] = fetch_related_item(item_id)
-                        if fetched_items[item_id]:
-                            item["related_documents"][field_id].append(fetched_items[item_id])
-                    del item[k]
+            for field_id, item_ids in related_item_ids.items():
+                item["related_documents"][field_id] = [related_items[item_id] for item_id in item_ids
+                                                       if related_items.get(item_id)]
+                del item["related_documents_{}".format(field_id)]
     for k,v in item.items():
         if k not in KNOWN_ITEM_ATTRIBUTES:
             del item[k]
@@ -345,16 +392,30 @@ def get_item_query(slug):
     else:
         return {'Slug.He': slug.full}
 
+def get_items(slugs, full=False):
+    '''
+    Search for all the slugs using a single terms query.
+    Returns a dict of slug.full to the item of that slug, missing slugs are not
+    in the dict.
+    '''
+    full_slugs = set(slug.full for slug in slugs)
+    if not full_slugs:
+        return {}
+    body = {"query": {"constant_score": {"filter": {"terms": {"slugs": list(full_slugs)}}}}}
+    # ask for more hits than slugs, so we can detect slugs with multiple items
+    results = current_app.es.search(index=current_app.es_data_db_index_name, body=body,
+                                    size=len(full_slugs) * 2)
+    rv = {}
+    for doc in hits_to_docs(results["hits"]["hits"], full=full):
+        for slug in doc.get("slugs", []):
+            if slug in full_slugs:
+                if slug in rv:
+                    raise Exception("too many hits for slug {}".format(json.dumps(slug)))
+                rv[slug] = doc
+    return rv
+
 def get_item(slug, full=False):
-    body = {"query": {"constant_score": {"filter": {"term": {"slugs": slug.full}}}}}
-    results = current_app.es.search(index=current_app.es_data_db_index_name, body=body)
-    docs = list(hits_to_docs(results["hits"]["hits"], full=full))
-    if len(docs) == 0:
-        return None
-    elif len(docs) == 1:
-        return docs[0]
-    else:
-        raise Exception("too many hits for slug {}".format(json.dumps(slug.full)))
+    return get_items([slug], full=full).get(slug.full)
     # TODO: ensure all below logic is transferred to above new code
     # '''
     # Try to return Mongo _id for the given unit_id and collection name.
@@ -473,6 +534,16 @@ def update_slugs(document, collection_name):
     # if 'GTN' in item:
     #     item['Slug'] = {'En': 'person_{}.{}'.format(item['GTN'], item['II'])}
 
+def create_slug(document, collection_name):
+    ''' returns the Slug of a legacy doc, made of its collection and its Header '''
+    slugify = Slugify(translate=None, safe_chars='_')
+    slug = {}
+    for lang, header in (document.get('Header') or {}).items():
+        collection_slug = SLUG_LANGUAGES_MAP.get(collection_name, UNKNOWN_SLUG_LANGUAGES_MAP).get(lang.lower())
+        if header and collection_slug:
+            slug[lang] = slugify(u'_'.join([collection_slug, header.lower()])).encode('utf8')
+    return slug
+
 def get_doc_id(collection_name, doc):
     if "source" in doc and "source_id" in doc:
         # new doc
@@ -484,3 +555,44 @@ def get_doc_id(collection_name, doc):
             raise Exception("persons collection items don't have a single doc_id, you must match on multiple fields")
         id_field = get_collection_id_field(collection_name)
         return doc[id_field]
+
+
+def get_es_doc(collection_name, doc):
+    ''' returns the elasticsearch id and body of a mongo doc
+    >>> es_id, body = get_es_doc("persons", {"_id": 1, "tree_num": 7, "tree_version": 2, "id": "I3", "name_lc": ["moshe", "cohen"], "sex": "m"})
+    >>> es_id, body["last_name_lc"], body["gender"], "_id" in body
+    ('7_2_I3', 'cohen', 'M', False)
+    '''
+    body = deepcopy(doc)
+    body.pop('_id', None)
+    if collection_name == "persons":
+        # the persons search fields, see bhs_api.persons
+        name_lc = body.get("name_lc") or []
+        body["person_id"] = body["id"]
+        body["first_name_lc"] = name_lc[0] if len(name_lc) > 0 else None
+        body["last_name_lc"] = name_lc[-1] if len(name_lc) > 1 else None
+        body["gender"] = body["sex"].upper() if body.get("sex") and body["sex"].upper() in ("F", "M") else "U"
+        es_id = "{}_{}_{}".format(body["tree_num"], body["tree_version"], body["person_id"])
+    else:
+        es_id = get_doc_id(collection_name, body)
+    uuids_to_str(body)
+    return es_id, body
+
+
+def update_es(collection_name, doc, is_new, es_index_name=None, es=None, app=None):
+    ''' index a mongo doc in elasticsearch, a new doc replaces the elasticsearch doc
+        and an existing doc updates its fields. returns (is_ok, message)
+    '''
+    app = app if app else current_app
+    es = es if es else app.es
+    es_index_name = es_index_name if es_index_name else app.es_data_db_index_name
+    es_id, body = get_es_doc(collection_name, doc)
+    try:
+        if is_new:
+            es.index(index=es_index_name, doc_type=collection_name, id=es_id, body=body)
+        else:
+            es.update(index=es_index_name, doc_type=collection_name, id=es_id,
+                      body={"doc": body, "doc_as_upsert": True})
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        return False, "failed to index {} {}: {}".format(collection_name, es_id, e)
+    return True, "indexed {} {}".format(collection_name, es_id)
@@ -0,0 +1,92 @@
+"""
+multi-pattern title matching for the linkify api
+
+the titles are compiled to an Aho-Corasick automaton, which finds all the
+titles contained in a text in a single pass over the text.
+"""
+from collections import deque
+from array import array
+
+# the automaton edges are kept in a single dict keyed by node * _UNICODE_SIZE + ord(char)
+# to keep the memory footprint down, a dict per node takes ~10 times more memory
+_UNICODE_SIZE = 0x110000
+
+
+class TitleMatcher(object):
+    ''' finds all the added titles which are contained in a text
+    >>> matcher = TitleMatcher()
+    >>> matcher.add(u"he", 1)
+    >>> matcher.add(u"she", 2)
+    >>> matcher.add(u"hers", 3)
+    >>> matcher.add(u"his", 4)
+    >>> matcher.build()
+    >>> matcher.search(u"ushers")
+    [1, 2, 3]
+    >>> matcher.search(u"this is it")
+    [4]
+    >>> matcher.search(u"nothing")
+    []
+    '''
+
+    def __init__(self):
+        self._trie = [{}]
+        self._outputs = {}
+        self._values = []
+        self._edges = None
+        self._fail = None
+
+    def add(self, title, value):
+        ''' add a title, search returns `value` when the title is found '''
+        node = 0
+        for char in title:
+            children = self._trie[node]
+            if char not in children:
+                children[char] = len(self._trie)
+                self._trie.append({})
+            node = children[char]
+        self._outputs.setdefault(node, []).append(len(self._values))
+        self._values.append(value)
+
+    def build(self):
+        ''' compile the added titles, must be called before searching '''
+        fail = array('l', [0]) * len(self._trie)
+        edges = {}
+        queue = deque()
+        for char, child in self._trie[0].items():
+            edges[ord(char)] = child
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in self._trie[node].items():
+                edges[node * _UNICODE_SIZE + ord(char)] = child
+                queue.append(child)
+                # the longest proper suffix of child which is also in the trie
+                f = fail[node]
+                while f and char not in self._trie[f]:
+                    f = fail[f]
+                fail[child] = self._trie[f].get(char, 0)
+                if fail[child] in self._outputs:
+                    self._outputs[child] = self._outputs.get(child, []) + self._outputs[fail[child]]
+        self._outputs = {node: tuple(sorted(set(outputs))) for node, outputs in self._outputs.items()}
+        self._edges, self._fail = edges, fail
+        # the trie is not needed for searching
+        self._trie = None
+
+    def search(self, text):
+        ''' returns the values of all the titles in text, in the order they were added '''
+        edges, fail, outputs = self._edges, self._fail, self._outputs
+        found = set()
+        node = 0
+        for char in text:
+            o = ord(char)
+            while True:
+                child = edges.get(node * _UNICODE_SIZE + o)
+                if child is not None:
+                    node = child
+                    break
+                elif node == 0:
+                    break
+                node = fail[node]
+            if node in outputs:
+                found.update(outputs[node])
+        return [self._values[i] for i in sorted(found)]
@@ -2,6 +2,7 @@
 logic and constants relating to persons
 """
 import datetime
+from bhs_api import phonetic
 
 
 LIVING_PERSON_WHITELISTED_KEYS = ["partners",
@@ -48,6 +49,22 @@ PERSONS_SEARCH_TEXT_PARAMS_LOWERCASE = (("first", "first_name_lc"),
 PERSONS_SEARCH_EXACT_PARAMS = (("sex", "gender"),
                                ("treenum", "tree_num"))
 
+# the gedcom place fields of a person, the fsearch place param searches all of them
+# using the all_places_lc / all_places_S multikey fields, if persons_search_all_places is set
+PERSON_PLACE_FIELDS = ("BIRT_PLAC", "MARR_PLAC", "DEAT_PLAC")
+
+
+def get_all_places(person):
+    ''' returns the all_places_lc and all_places_S fields of a person
+    >>> get_all_places({"BIRT_PLAC": u"Paris", "MARR_PLAC": None, "DEAT_PLAC": u"paris"})["all_places_lc"]
+    [u'paris']
+    '''
+    places = set(person.get(field) for field in PERSON_PLACE_FIELDS)
+    places.discard(None)
+    places.discard(u"")
+    return {"all_places_lc": sorted(set(place.lower() for place in places)),
+            "all_places_S": sorted(set(phonetic.get_bhp_soundex_many(list(places))))}
+
 
 def is_living_person(is_deceased, birth_year):
     if is_deceased:
@@ -4,14 +4,16 @@
 import argparse
 import subprocess
 import re
-from itertools import groupby
-import requests
-import urllib2
+import threading
+from collections import OrderedDict
+from itertools import product
 
 import pymongo
 
 import unicodedata
 
+from bhs_api.hebrew_dms import hebrew_dm_soundex, hebrew_dm_soundex_many
+
 
 def is_hebrew(string):
     'A hacky way to check if our string is in Hebrew - check the 1rst char'
@@ -34,10 +36,18 @@ def is_hebrew(string):
         return False
 
 def get_hebrew_dms(name):
-    ''' use the dms server to tturn a hebrew name into phonetic code '''
-    escaped_name = urllib2.quote(name.encode('utf8'))
-    r = requests.get('http://localhost:8765?n=' + escaped_name)
-    return r.text
+    ''' turn a hebrew name into phonetic code
+        the code ends with a newline, like the response of the dms server which
+        made the codes that are already stored (e.g. in name_S and BIRT_PLAC_S)
+    '''
+    if type(name) != unicode:
+        name = name.decode('utf-8')
+    return hebrew_dm_soundex(name) + u'\n'
+
+def get_hebrew_dms_many(names):
+    ''' turn a list of hebrew names into a list of phonetic codes, see get_hebrew_dms '''
+    return [dms + u'\n' for dms in hebrew_dm_soundex_many([name if type(name) == unicode else name.decode('utf-8')
+                                                            for name in names])]
 
 def get_english_dms(string):
     'Using code from https://github.com/chrislit/abydos/blob/master/abydos/phonetic.py'
@@ -45,20 +55,33 @@ def get_english_dms(string):
     result = str(' '.join(list(result_set))) # Cast the value to format returned by get_hebrew_dms()
     return result
 
+def get_english_dms_many(strings):
+    ''' get_english_dms of a list of strings '''
+    return [str(' '.join(list(result_set))) for result_set in encode_many(strings)]
+
 def get_bhp_soundex(string):
     '''Generate a dms from a string, then convert it to a format stored in BHP database.
-    get_bhp_soundex('ירושלים') ==> '194860 197486'  ==> 'ZZ H194860 H197486 ZZ ' # Yes, trailing space!
+    get_bhp_soundex('ירושלים') ==> '194860 197486\\n'  ==> 'ZZ H194860 H197486\\n ZZ ' # Yes, newline and trailing space!
     get_bhp_soundex('jerusalem') ==> '494860 194860' ==> 'ZZ E494860 E194860 ZZ '
     '''
     if is_hebrew(string):
-        dms = get_hebrew_dms(string)
-        to_list = dms.split(' ')
-        lang_list = ['H' + s for s in to_list]
+        return _to_bhp_soundex(get_hebrew_dms(string), 'H')
     else:
-        dms = get_english_dms(string)
-        to_list = dms.split(' ')
-        lang_list = ['E' + s for s in to_list]
+        return _to_bhp_soundex(get_english_dms(string), 'E')
 
+def get_bhp_soundex_many(strings):
+    ''' get_bhp_soundex of a list of strings, the hebrew and the english strings are encoded in a batch each
+    >>> get_bhp_soundex_many([u'jerusalem', u'jerusalem']) == [get_bhp_soundex(u'jerusalem')] * 2
+    True
+    '''
+    hebrew = [is_hebrew(string) for string in strings]
+    hebrew_dms = iter(get_hebrew_dms_many([s for s, h in zip(strings, hebrew) if h]))
+    english_dms = iter(get_english_dms_many([s for s, h in zip(strings, hebrew) if not h]))
+    return [_to_bhp_soundex(next(hebrew_dms), 'H') if h else _to_bhp_soundex(next(english_dms), 'E')
+            for h in hebrew]
+
+def _to_bhp_soundex(dms, lang_prefix):
+    lang_list = [lang_prefix + s for s in dms.split(' ')]
     lang_string = ' '.join(lang_list)
     return 'ZZ ' + lang_string + ' ZZ '
 
@@ -129,10 +152,152 @@ def get_similar_strings(string, collection_obj):
 
     return found
 
+_DMS_TABLE = {'STCH': (2, 4, 4), 'DRZ': (4, 4, 4), 'ZH': (4, 4, 4),
+              'ZHDZH': (2, 4, 4), 'DZH': (4, 4, 4), 'DRS': (4, 4, 4),
+              'DZS': (4, 4, 4), 'SCHTCH': (2, 4, 4), 'SHTSH': (2, 4, 4),
+              'SZCZ': (2, 4, 4), 'TZS': (4, 4, 4), 'SZCS': (2, 4, 4),
+              'STSH': (2, 4, 4), 'SHCH': (2, 4, 4), 'D': (3, 3, 3),
+              'H': (5, 5, '_'), 'TTSCH': (4, 4, 4), 'THS': (4, 4, 4),
+              'L': (8, 8, 8), 'P': (7, 7, 7), 'CHS': (5, 54, 54),
+              'T': (3, 3, 3), 'X': (5, 54, 54), 'OJ': (0, 1, '_'),
+              'OI': (0, 1, '_'), 'SCHTSH': (2, 4, 4), 'OY': (0, 1, '_'),
+              'Y': (1, '_', '_'), 'TSH': (4, 4, 4), 'ZDZ': (2, 4, 4),
+              'TSZ': (4, 4, 4), 'SHT': (2, 43, 43), 'SCHTSCH': (2, 4, 4),
+              'TTSZ': (4, 4, 4), 'TTZ': (4, 4, 4), 'SCH': (4, 4, 4),
+              'TTS': (4, 4, 4), 'SZD': (2, 43, 43), 'AI': (0, 1, '_'),
+              'PF': (7, 7, 7), 'TCH': (4, 4, 4), 'PH': (7, 7, 7),
+              'TTCH': (4, 4, 4), 'SZT': (2, 43, 43), 'ZDZH': (2, 4, 4),
+              'EI': (0, 1, '_'), 'G': (5, 5, 5), 'EJ': (0, 1, '_'),
+              'ZD': (2, 43, 43), 'IU': (1, '_', '_'), 'K': (5, 5, 5),
+              'O': (0, '_', '_'), 'SHTCH': (2, 4, 4), 'S': (4, 4, 4),
+              'TRZ': (4, 4, 4), 'SHD': (2, 43, 43), 'DSH': (4, 4, 4),
+              'CSZ': (4, 4, 4), 'EU': (1, 1, '_'), 'TRS': (4, 4, 4),
+              'ZS': (4, 4, 4), 'STRZ': (2, 4, 4), 'UY': (0, 1, '_'),
+              'STRS': (2, 4, 4), 'CZS': (4, 4, 4),
+              'MN': ('6_6', '6_6', '6_6'), 'UI': (0, 1, '_'),
+              'UJ': (0, 1, '_'), 'UE': (0, '_', '_'), 'EY': (0, 1, '_'),
+              'W': (7, 7, 7), 'IA': (1, '_', '_'), 'FB': (7, 7, 7),
+              'STSCH': (2, 4, 4), 'SCHT': (2, 43, 43),
+              'NM': ('6_6', '6_6', '6_6'), 'SCHD': (2, 43, 43),
+              'B': (7, 7, 7), 'DSZ': (4, 4, 4), 'F': (7, 7, 7),
+              'N': (6, 6, 6), 'CZ': (4, 4, 4), 'R': (9, 9, 9),
+              'U': (0, '_', '_'), 'V': (7, 7, 7), 'CS': (4, 4, 4),
+              'Z': (4, 4, 4), 'SZ': (4, 4, 4), 'TSCH': (4, 4, 4),
+              'KH': (5, 5, 5), 'ST': (2, 43, 43), 'KS': (5, 54, 54),
+              'SH': (4, 4, 4), 'SC': (2, 4, 4), 'SD': (2, 43, 43),
+              'DZ': (4, 4, 4), 'ZHD': (2, 43, 43), 'DT': (3, 3, 3),
+              'ZSH': (4, 4, 4), 'DS': (4, 4, 4), 'TZ': (4, 4, 4),
+              'TS': (4, 4, 4), 'TH': (3, 3, 3), 'TC': (4, 4, 4),
+              'A': (0, '_', '_'), 'E': (0, '_', '_'), 'I': (0, '_', '_'),
+              'AJ': (0, 1, '_'), 'M': (6, 6, 6), 'Q': (5, 5, 5),
+              'AU': (0, 7, '_'), 'IO': (1, '_', '_'), 'AY': (0, 1, '_'),
+              'IE': (1, '_', '_'), 'ZSCH': (4, 4, 4),
+              'CH':((5, 4), (5, 4), (5, 4)),
+              'CK':((5, 45), (5, 45), (5, 45)),
+              'C':((5, 4), (5, 4), (5, 4)),
+              'J':((1, 4), ('_', 4), ('_', 4)),
+              'RZ':((94, 4), (94, 4), (94, 4)),
+              'RS':((94, 4), (94, 4), (94, 4))}
+
+_DMS_ORDER = {'A':('AI', 'AJ', 'AU', 'AY', 'A'), 'B':('B'),
+              'C':('CHS', 'CSZ', 'CZS', 'CH', 'CK', 'CS', 'CZ', 'C'),
+              'D':('DRS', 'DRZ', 'DSH', 'DSZ', 'DZH', 'DZS', 'DS', 'DT',
+                   'DZ', 'D'), 'E':('EI', 'EJ', 'EU', 'EY', 'E'),
+              'F':('FB', 'F'), 'G':('G'), 'H':('H'),
+              'I':('IA', 'IE', 'IO', 'IU', 'I'), 'J':('J'),
+              'K':('KH', 'KS', 'K'), 'L':('L'), 'M':('MN', 'M'),
+              'N':('NM', 'N'), 'O':('OI', 'OJ', 'OY', 'O'),
+              'P':('PF', 'PH', 'P'), 'Q':('Q'), 'R':('RS', 'RZ', 'R'),
+              'S':('SCHTSCH', 'SCHTCH', 'SCHTSH', 'SHTCH', 'SHTSH', 'STSCH',
+                   'SCHD', 'SCHT', 'SHCH', 'STCH', 'STRS', 'STRZ', 'STSH',
+                   'SZCS', 'SZCZ', 'SCH', 'SHD', 'SHT', 'SZD', 'SZT', 'SC',
+                   'SD', 'SH', 'ST', 'SZ', 'S'),
+              'T':('TTSCH', 'TSCH', 'TTCH', 'TTSZ', 'TCH', 'THS', 'TRS',
+                   'TRZ', 'TSH', 'TSZ', 'TTS', 'TTZ', 'TZS', 'TC', 'TH',
+                   'TS', 'TZ', 'T'), 'U':('UE', 'UI', 'UJ', 'UY', 'U'),
+              'V':('V'), 'W':('W'), 'X':('X'), 'Y':('Y'),
+              'Z':('ZHDZH', 'ZDZH', 'ZSCH', 'ZDZ', 'ZHD', 'ZSH', 'ZD', 'ZH',
+                   'ZS', 'Z')}
+
+_VOWELS = frozenset('AEIJOUY')
+
+
+def _compile_dms_rules():
+    """Return the rules as {first letter: (max length, {substring: codes})},
+    the longest substring which matches is the one that is used
+    """
+    rules = {}
+    for letter, substrings in _DMS_ORDER.items():
+        if isinstance(substrings, str):
+            substrings = (substrings,)
+        codes = {}
+        for sstr in substrings:
+            codes[sstr] = tuple(tuple(unicode(_) for _ in dm_val)
+                                if isinstance(dm_val, tuple) else (unicode(dm_val),)
+                                for dm_val in _DMS_TABLE[sstr])
+        rules[letter] = (max(len(_) for _ in substrings), codes)
+    return rules
+
+_DMS_RULES = _compile_dms_rules()
+
+_DMS_CACHE_SIZE = 100000
+_dms_cache = OrderedDict()
+_dms_cache_lock = threading.Lock()
+
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def _normalize_dms_word(word):
+    """uppercase, normalize, decompose, and filter non-A-Z"""
+    word = unicodedata.normalize('NFKD', unicode(word.upper()))
+    word = word.replace(u'ß', 'SS')
+    return ''.join([c for c in word if 'A' <= c <= 'Z'])
+
+
+def _encode_dms_word(word, maxlength, zero_pad):
+    """Return the D-M Soundex values of a normalized word as a frozenset"""
+    # Nothing to convert, return base case
+    if not word:
+        return frozenset(['0'*maxlength if zero_pad else '0'])
+
+    # the code of each matched substring, with 2 alternatives for branching ones
+    parts = []
+    pos = 0
+    while pos < len(word):
+        maxlen, codes = _DMS_RULES[word[pos]]
+        for length in xrange(min(maxlen, len(word) - pos), 0, -1):
+            dm_val = codes.get(word[pos:pos+length])
+            if dm_val:
+                break
+        # Determine the correct positional variant (first, pre-vocalic,
+        # elsewhere)
+        if pos == 0:
+            dm_val = dm_val[0]
+        elif pos+length < len(word) and word[pos+length] in _VOWELS:
+            dm_val = dm_val[1]
+        else:
+            dm_val = dm_val[2]
+        parts.append(dm_val)
+        pos += length
+
+    dms = set()
+    for code in product(*parts):
+        # Filter out double letters and _ placeholders
+        code = _REPEATS.sub(r'\1', ''.join(code)).replace('_', '')
+        # Trim codes
+        if zero_pad:
+            code = (code + ('0'*maxlength))[:maxlength]
+        else:
+            code = code[:maxlength]
+        dms.add(code)
+    return frozenset(dms)
+
+
 def dm_soundex(word, maxlength=6, reverse=False, zero_pad=True):
     """Return the Daitch-Mokotoff Soundex values of a word as a set
         A collection is necessary since there can be multiple values for a
         single word.
+        the values of the last _DMS_CACHE_SIZE normalized words are cached.
 
     Arguments:
     word -- the word to translate to D-M Soundex
@@ -141,144 +306,69 @@ def dm_soundex(word, maxlength=6, reverse=False, zero_pad=True):
         to False); This results in "Reverse Soundex"
     zero_pad -- pad the end of the return value with 0s to achieve a maxlength
         string
-    """
-    _dms_table = {'STCH': (2, 4, 4), 'DRZ': (4, 4, 4), 'ZH': (4, 4, 4),
-                  'ZHDZH': (2, 4, 4), 'DZH': (4, 4, 4), 'DRS': (4, 4, 4),
-                  'DZS': (4, 4, 4), 'SCHTCH': (2, 4, 4), 'SHTSH': (2, 4, 4),
-                  'SZCZ': (2, 4, 4), 'TZS': (4, 4, 4), 'SZCS': (2, 4, 4),
-                  'STSH': (2, 4, 4), 'SHCH': (2, 4, 4), 'D': (3, 3, 3),
-                  'H': (5, 5, '_'), 'TTSCH': (4, 4, 4), 'THS': (4, 4, 4),
-                  'L': (8, 8, 8), 'P': (7, 7, 7), 'CHS': (5, 54, 54),
-                  'T': (3, 3, 3), 'X': (5, 54, 54), 'OJ': (0, 1, '_'),
-                  'OI': (0, 1, '_'), 'SCHTSH': (2, 4, 4), 'OY': (0, 1, '_'),
-                  'Y': (1, '_', '_'), 'TSH': (4, 4, 4), 'ZDZ': (2, 4, 4),
-                  'TSZ': (4, 4, 4), 'SHT': (2, 43, 43), 'SCHTSCH': (2, 4, 4),
-                  'TTSZ': (4, 4, 4), 'TTZ': (4, 4, 4), 'SCH': (4, 4, 4),
-                  'TTS': (4, 4, 4), 'SZD': (2, 43, 43), 'AI': (0, 1, '_'),
-                  'PF': (7, 7, 7), 'TCH': (4, 4, 4), 'PH': (7, 7, 7),
-                  'TTCH': (4, 4, 4), 'SZT': (2, 43, 43), 'ZDZH': (2, 4, 4),
-                  'EI': (0, 1, '_'), 'G': (5, 5, 5), 'EJ': (0, 1, '_'),
-                  'ZD': (2, 43, 43), 'IU': (1, '_', '_'), 'K': (5, 5, 5),
-                  'O': (0, '_', '_'), 'SHTCH': (2, 4, 4), 'S': (4, 4, 4),
-                  'TRZ': (4, 4, 4), 'SHD': (2, 43, 43), 'DSH': (4, 4, 4),
-                  'CSZ': (4, 4, 4), 'EU': (1, 1, '_'), 'TRS': (4, 4, 4),
-                  'ZS': (4, 4, 4), 'STRZ': (2, 4, 4), 'UY': (0, 1, '_'),
-                  'STRS': (2, 4, 4), 'CZS': (4, 4, 4),
-                  'MN': ('6_6', '6_6', '6_6'), 'UI': (0, 1, '_'),
-                  'UJ': (0, 1, '_'), 'UE': (0, '_', '_'), 'EY': (0, 1, '_'),
-                  'W': (7, 7, 7), 'IA': (1, '_', '_'), 'FB': (7, 7, 7),
-                  'STSCH': (2, 4, 4), 'SCHT': (2, 43, 43),
-                  'NM': ('6_6', '6_6', '6_6'), 'SCHD': (2, 43, 43),
-                  'B': (7, 7, 7), 'DSZ': (4, 4, 4), 'F': (7, 7, 7),
-                  'N': (6, 6, 6), 'CZ': (4, 4, 4), 'R': (9, 9, 9),
-                  'U': (0, '_', '_'), 'V': (7, 7, 7), 'CS': (4, 4, 4),
-                  'Z': (4, 4, 4), 'SZ': (4, 4, 4), 'TSCH': (4, 4, 4),
-                  'KH': (5, 5, 5), 'ST': (2, 43, 43), 'KS': (5, 54, 54),
-                  'SH': (4, 4, 4), 'SC': (2, 4, 4), 'SD': (2, 43, 43),
-                  'DZ': (4, 4, 4), 'ZHD': (2, 43, 43), 'DT': (3, 3, 3),
-                  'ZSH': (4, 4, 4), 'DS': (4, 4, 4), 'TZ': (4, 4, 4),
-                  'TS': (4, 4, 4), 'TH': (3, 3, 3), 'TC': (4, 4, 4),
-                  'A': (0, '_', '_'), 'E': (0, '_', '_'), 'I': (0, '_', '_'),
-                  'AJ': (0, 1, '_'), 'M': (6, 6, 6), 'Q': (5, 5, 5),
-                  'AU': (0, 7, '_'), 'IO': (1, '_', '_'), 'AY': (0, 1, '_'),
-                  'IE': (1, '_', '_'), 'ZSCH': (4, 4, 4),
-                  'CH':((5, 4), (5, 4), (5, 4)),
-                  'CK':((5, 45), (5, 45), (5, 45)),
-                  'C':((5, 4), (5, 4), (5, 4)),
-                  'J':((1, 4), ('_', 4), ('_', 4)),
-                  'RZ':((94, 4), (94, 4), (94, 4)),
-                  'RS':((94, 4), (94, 4), (94, 4))}
-
-    _dms_order = {'A':('AI', 'AJ', 'AU', 'AY', 'A'), 'B':('B'),
-                  'C':('CHS', 'CSZ', 'CZS', 'CH', 'CK', 'CS', 'CZ', 'C'),
-                  'D':('DRS', 'DRZ', 'DSH', 'DSZ', 'DZH', 'DZS', 'DS', 'DT',
-                       'DZ', 'D'), 'E':('EI', 'EJ', 'EU', 'EY', 'E'),
-                  'F':('FB', 'F'), 'G':('G'), 'H':('H'),
-                  'I':('IA', 'IE', 'IO', 'IU', 'I'), 'J':('J'),
-                  'K':('KH', 'KS', 'K'), 'L':('L'), 'M':('MN', 'M'),
-                  'N':('NM', 'N'), 'O':('OI', 'OJ', 'OY', 'O'),
-                  'P':('PF', 'PH', 'P'), 'Q':('Q'), 'R':('RS', 'RZ', 'R'),
-                  'S':('SCHTSCH', 'SCHTCH', 'SCHTSH', 'SHTCH', 'SHTSH', 'STSCH',
-                       'SCHD', 'SCHT', 'SHCH', 'STCH', 'STRS', 'STRZ', 'STSH',
-                       'SZCS', 'SZCZ', 'SCH', 'SHD', 'SHT', 'SZD', 'SZT', 'SC',
-                       'SD', 'SH', 'ST', 'SZ', 'S'),
-                  'T':('TTSCH', 'TSCH', 'TTCH', 'TTSZ', 'TCH', 'THS', 'TRS',
-                       'TRZ', 'TSH', 'TSZ', 'TTS', 'TTZ', 'TZS', 'TC', 'TH',
-                       'TS', 'TZ', 'T'), 'U':('UE', 'UI', 'UJ', 'UY', 'U'),
-                  'V':('V'), 'W':('W'), 'X':('X'), 'Y':('Y'),
-                  'Z':('ZHDZH', 'ZDZH', 'ZSCH', 'ZDZ', 'ZHD', 'ZSH', 'ZD', 'ZH',
-                       'ZS', 'Z')}
-
-    _vowels = tuple('AEIJOUY')
-    dms = [''] # initialize empty code list
 
+    >>> sorted(dm_soundex('jerusalem'))
+    [u'194860', u'494860']
+    >>> sorted(dm_soundex(u'Schwarzenegger', maxlength=8, zero_pad=False))
+    [u'474659', u'4794659']
+    """
     # Require a maxlength of at least 6 and not more than 64
     if maxlength is not None:
         maxlength = min(max(6, maxlength), 64)
     else:
         maxlength = 64
 
-    # uppercase, normalize, decompose, and filter non-A-Z
-    word = unicodedata.normalize('NFKD', unicode(word.upper()))
-    word = word.replace(u'ß', 'SS')
-    word = ''.join([c for c in word if c in
-                    tuple('ABCDEFGHIJKLMNOPQRSTUVWXYZ')])
-
-    # Nothing to convert, return base case
-    if not word:
-        if zero_pad:
-            return set(['0'*maxlength])
-        else:
-            return set(['0'])
-
+    word = _normalize_dms_word(word)
     # Reverse word if computing Reverse Soundex
     if reverse:
         word = word[::-1]
 
-    pos = 0
-    while pos < len(word):
-        # Iterate through _dms_order, which specifies the possible substrings
-        # for which codes exist in the Daitch-Mokotoff coding
-        for sstr in _dms_order[word[pos]]:
-            if word[pos:].startswith(sstr):
-                # Having determined a valid substring start, retrieve the code
-                dm_val = _dms_table[sstr]
-
-                # Having retried the code (triple), determine the correct
-                # positional variant (first, pre-vocalic, elsewhere)
-                if pos == 0:
-                    dm_val = dm_val[0]
-                elif (pos+len(sstr) < len(word) and
-                      word[pos+len(sstr)] in _vowels):
-                    dm_val = dm_val[1]
-                else:
-                    dm_val = dm_val[2]
-
-                # Build the code strings
-                if isinstance(dm_val, tuple):
-                    dms = [_ + unicode(dm_val[0]) for _ in dms] \
-                            + [_ + unicode(dm_val[1]) for _ in dms]
-                else:
-                    dms = [_ + unicode(dm_val) for _ in dms]
-                pos += len(sstr)
-                break
+    key = (word, maxlength, zero_pad)
+    with _dms_cache_lock:
+        dms = _dms_cache.pop(key, None)
+        if dms is not None:
+            _dms_cache[key] = dms
+    if dms is None:
+        dms = _encode_dms_word(word, maxlength, zero_pad)
+        with _dms_cache_lock:
+            _dms_cache[key] = dms
+            if len(_dms_cache) > _DMS_CACHE_SIZE:
+                _dms_cache.popitem(last=False)
+    return set(dms)
 
-    # Filter out double letters and _ placeholders
-    dms = [''.join([c for c in _delete_consecutive_repeats(_) if c != '_'])
-           for _ in dms]
 
-    # Trim codes and return set
-    if zero_pad:
-        dms = [(_ + ('0'*maxlength))[:maxlength] for _ in dms]
-    else:
-        dms = [_[:maxlength] for _ in dms]
-    return set(dms)
+def encode_many(words, maxlength=6, reverse=False, zero_pad=True):
+    """Return a list with the Daitch-Mokotoff Soundex values of each word
+        the distinct words of the batch are encoded once, and the cache is
+        looked up and updated under a single lock for the whole batch.
 
-def _delete_consecutive_repeats(word):
-    """Return word with all contiguous repeating characters collapsed to
-    a single instance
+    >>> [sorted(_) for _ in encode_many(['jerusalem', 'Jerusalem', ''])]
+    [[u'194860', u'494860'], [u'194860', u'494860'], ['000000']]
     """
-    return ''.join(char for char, _ in groupby(word))
+    if maxlength is not None:
+        maxlength = min(max(6, maxlength), 64)
+    else:
+        maxlength = 64
+    keys = []
+    for word in words:
+        word = _normalize_dms_word(word)
+        keys.append((word[::-1] if reverse else word, maxlength, zero_pad))
+    found = {}
+    with _dms_cache_lock:
+        for key in set(keys):
+            dms = _dms_cache.pop(key, None)
+            if dms is not None:
+                _dms_cache[key] = found[key] = dms
+    missing = [key for key in set(keys) if key not in found]
+    for key in missing:
+        found[key] = _encode_dms_word(*key)
+    if missing:
+        with _dms_cache_lock:
+            for key in missing:
+                _dms_cache[key] = found[key]
+            while len(_dms_cache) > _DMS_CACHE_SIZE:
+                _dms_cache.popitem(last=False)
+    return [set(found[key]) for key in keys]
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -0,0 +1,265 @@
+"""
+in-process prefix index for the suggest api
+
+the title_{lang}_suggest inputs of all the documents are kept per worker in
+sorted arrays, one per collection and language, so a prefix lookup is a
+binary search followed by a short scan. like the completion suggester, the
+inputs with a higher weight are suggested first - the top titles of the short
+prefixes are computed when the index is built, longer prefixes match few keys.
+the index is built in the background from a scan of the search index, or
+from a snapshot file when the worker starts, until it's ready - or when it
+grows beyond SUGGEST_INDEX_MAX_ENTRIES - the suggestions are served by the
+elasticsearch completion suggester.
+"""
+import os
+import re
+import json
+import time
+import heapq
+import bisect
+import logging
+from array import array
+import elasticsearch.helpers
+from bhs_api.cache import get_worker_cached, get_cache_generation
+from bhs_api.constants import PIPELINES_ES_DOC_TYPE, SUPPORTED_SUGGEST_LANGS
+
+# same as the max_input_length of the title_{lang}_suggest completion fields
+MAX_INPUT_LENGTH = 20
+
+_NON_LETTERS = re.compile(r"[\W\d_]+", re.UNICODE)
+
+# the top titles of the prefixes up to this length are computed when the index is built
+SHORT_PREFIX_LENGTH = 2
+# the number of top titles kept for each short prefix
+SHORT_PREFIX_SIZE = 20
+
+
+def normalize_suggest_input(text):
+    ''' lowercase and split on non letters, like the simple analyzer used by
+        the completion fields
+    >>> normalize_suggest_input(u"Davydov, Karl")
+    u'davydov karl'
+    >>> normalize_suggest_input(u"_")
+    u''
+    '''
+    return _NON_LETTERS.sub(u" ", text.lower()).strip()[:MAX_INPUT_LENGTH]
+
+
+def get_weighted_inputs(value):
+    ''' returns a list of (input, weight) of a completion field value, which is
+        an input, a list of inputs or of objects with inputs and a weight
+    >>> get_weighted_inputs([u"Paris", {"input": [u"Parigi"], "weight": 3}])
+    [(u'Paris', 1), (u'Parigi', 3)]
+    '''
+    res = []
+    for item in value if isinstance(value, (list, tuple)) else [value]:
+        if isinstance(item, dict):
+            inputs = item.get("input")
+            weight = int(item.get("weight") or 1)
+            res += [(i, weight) for i in (inputs if isinstance(inputs, (list, tuple)) else [inputs])]
+        else:
+            res.append((item, 1))
+    return res
+
+
+class SuggestIndex(object):
+    ''' prefix lookups of titles by their suggest inputs
+    >>> index = SuggestIndex()
+    >>> index.add(u"places", u"en", [u"BOURGES"], u"BOURGES")
+    >>> index.add(u"places", u"en", u"BOZZOLO", u"BOZZOLO")
+    >>> index.add(u"places", u"en", [u"Paris", u"Parigi"], u"PARIS")
+    >>> index.build()
+    >>> index.complete(u"places", u"en", u"bo")
+    [u'BOURGES', u'BOZZOLO']
+    >>> index.complete(u"places", u"en", u"Par", size=7)
+    [u'PARIS']
+    >>> index.complete(u"places", u"he", u"bo")
+    []
+    >>> len(index)
+    4
+    >>> index = SuggestIndex()
+    >>> index.add(u"places", u"en", u"BOURGES", u"BOURGES")
+    >>> index.add(u"places", u"en", u"BOZZOLO", u"BOZZOLO")
+    >>> index.add(u"places", u"en", {"input": u"BOSTON", "weight": 5}, u"BOSTON")
+    >>> index.build()
+    >>> index.complete(u"places", u"en", u"bo", size=2)
+    [u'BOSTON', u'BOURGES']
+    >>> index.complete(u"places", u"en", u"bou")
+    [u'BOURGES']
+    '''
+
+    def __init__(self):
+        self._titles = []
+        self._title_ids = {}
+        self._pending = {}
+        self._keys = {}
+        self._ids = {}
+        # the weights of the keys, None if all the keys have the same weight
+        self._weights = {}
+        # {short prefix: the top title ids} of the keys with weights
+        self._top_ids = {}
+        # the search_index cache generation and the time the index was scanned at
+        self.generation = None
+        self.built_at = None
+
+    def __len__(self):
+        return (sum(len(keys) for keys in self._keys.values())
+                + sum(len(entries) for entries in self._pending.values()))
+
+    def _get_title_id(self, title):
+        if title not in self._title_ids:
+            self._title_ids[title] = len(self._titles)
+            self._titles.append(title)
+        return self._title_ids[title]
+
+    def add(self, collection, lang, inputs, title):
+        weights = {}
+        for i, weight in get_weighted_inputs(inputs):
+            key = normalize_suggest_input(i) if i else u""
+            if key:
+                weights[key] = max(weight, weights.get(key, weight))
+        if weights and title:
+            title_id = self._get_title_id(title)
+            entries = self._pending.setdefault((collection, lang), [])
+            entries.extend((key, -weight, title_id) for key, weight in weights.items())
+
+    def build(self):
+        for key, entries in self._pending.items():
+            entries.sort()
+            self._keys[key] = [entry[0] for entry in entries]
+            self._ids[key] = array('l', (entry[2] for entry in entries))
+            weights = array('l', (-entry[1] for entry in entries))
+            self._weights[key] = weights if len(set(weights)) > 1 else None
+            self._build_top_ids(key)
+        self._pending = {}
+        self._title_ids = {}
+
+    def _get_top_ids(self, ids, weights, start, end, size):
+        ''' returns the ids of the top `size` distinct titles of the keys between start and end '''
+        num = size
+        while True:
+            res, seen = [], set()
+            for i in heapq.nsmallest(num, xrange(start, end), key=lambda i: (-weights[i], i)):
+                if ids[i] not in seen and len(res) < size:
+                    seen.add(ids[i])
+                    res.append(ids[i])
+            # a title can have a few keys with the same prefix
+            if len(res) >= size or num >= end - start:
+                return res
+            num *= 2
+
+    def _build_top_ids(self, key):
+        keys, ids, weights = self._keys[key], self._ids[key], self._weights[key]
+        self._top_ids[key] = top_ids = {}
+        if not weights:
+            return
+        for length in range(SHORT_PREFIX_LENGTH + 1):
+            # the keys are sorted, so the keys of a prefix are next to each other
+            start = 0
+            while start < len(keys):
+                prefix = keys[start][:length]
+                end = bisect.bisect_left(keys, prefix + u"\uffff", start)
+                top_ids[prefix] = array('l', self._get_top_ids(ids, weights, start, end, SHORT_PREFIX_SIZE))
+                start = end
+
+    def complete(self, collection, lang, prefix, size=7):
+        keys = self._keys.get((collection, lang))
+        if not keys:
+            return []
+        ids = self._ids[(collection, lang)]
+        weights = self._weights[(collection, lang)]
+        prefix = normalize_suggest_input(prefix)
+        if weights:
+            if len(prefix) <= SHORT_PREFIX_LENGTH and size <= SHORT_PREFIX_SIZE:
+                top_ids = self._top_ids[(collection, lang)].get(prefix, [])[:size]
+            else:
+                start = bisect.bisect_left(keys, prefix)
+                end = bisect.bisect_left(keys, prefix + u"\uffff", start)
+                top_ids = self._get_top_ids(ids, weights, start, end, size)
+            return [self._titles[i] for i in top_ids]
+        res, seen = [], set()
+        for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+            if len(res) >= size or not keys[i].startswith(prefix):
+                break
+            if ids[i] not in seen:
+                seen.add(ids[i])
+                res.append(self._titles[ids[i]])
+        return res
+
+    def dump(self, f):
+        json.dump({"titles": self._titles, "generation": self.generation, "built_at": self.built_at,
+                   "collections": [{"collection": collection, "lang": lang,
+                                    "keys": self._keys[(collection, lang)],
+                                    "ids": self._ids[(collection, lang)].tolist(),
+                                    "weights": (self._weights[(collection, lang)] or array('l')).tolist()}
+                                   for collection, lang in self._keys]}, f)
+
+    @classmethod
+    def load(cls, f):
+        index = cls()
+        data = json.load(f)
+        index._titles = data["titles"]
+        index.generation, index.built_at = data.get("generation"), data.get("built_at")
+        for row in data["collections"]:
+            index._keys[(row["collection"], row["lang"])] = row["keys"]
+            index._ids[(row["collection"], row["lang"])] = array('l', row["ids"])
+            index._weights[(row["collection"], row["lang"])] = array('l', row.get("weights", [])) or None
+            index._build_top_ids((row["collection"], row["lang"]))
+        return index
+
+
+def _save_snapshot(index, path):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        index.dump(f)
+    os.rename(tmp_path, path)
+
+
+def build_suggest_index(app):
+    ''' returns the suggest index or None if it exceeds SUGGEST_INDEX_MAX_ENTRIES.
+        a worker loads the snapshot file when it starts, later refreshes are
+        scanned from elasticsearch and saved to the snapshot for the next workers.
+    '''
+    snapshot = app.config.get('SUGGEST_INDEX_SNAPSHOT')
+    generation = get_cache_generation("search_index", app)
+    if snapshot and os.path.exists(snapshot) and not getattr(app, "suggest_snapshot_loaded", False):
+        app.suggest_snapshot_loaded = True
+        try:
+            with open(snapshot) as f:
+                index = SuggestIndex.load(f)
+            # the search index was rewritten or the snapshot is older than a refresh
+            if index.generation != generation or time.time() - (index.built_at or 0) > app.config['CACHING_TTL']:
+                app.logger.info("suggest index snapshot is stale, scanning the search index")
+            else:
+                return index
+        except (IOError, ValueError, KeyError) as e:
+            logging.exception(e)
+    max_entries = app.config.get('SUGGEST_INDEX_MAX_ENTRIES')
+    fields = ["collection"] + ["title_{}".format(lang) for lang in SUPPORTED_SUGGEST_LANGS] \
+             + ["title_{}_suggest".format(lang) for lang in SUPPORTED_SUGGEST_LANGS]
+    index = SuggestIndex()
+    index.generation, index.built_at = generation, time.time()
+    for doc in elasticsearch.helpers.scan(app.es, index=app.es_data_db_index_name,
+                                          doc_type=PIPELINES_ES_DOC_TYPE, scroll="5m", size=1000,
+                                          query={"_source": fields}):
+        source = doc["_source"]
+        for lang in SUPPORTED_SUGGEST_LANGS:
+            index.add(source.get("collection"), lang,
+                      source.get("title_{}_suggest".format(lang)),
+                      source.get("title_{}".format(lang)))
+        if max_entries and len(index) > max_entries:
+            app.logger.warning("suggest index has more than SUGGEST_INDEX_MAX_ENTRIES={} entries, dropping it "
+                               "and using elasticsearch for suggestions".format(max_entries))
+            return None
+    index.build()
+    if snapshot:
+        try:
+            _save_snapshot(index, snapshot)
+        except (IOError, OSError) as e:
+            logging.exception(e)
+    return index
+
+
+def get_suggest_index(app=None):
+    ''' returns the worker's suggest index, or None if it's not available '''
+    return get_worker_cached("suggest index", build_suggest_index, app=app, wait=False)
@@ -19,6 +19,9 @@ from bhs_api.item import (fetch_items, search_by_header, get_image_url, update_s
 from bhs_api.fsearch import fsearch
 from bhs_api.user import get_user
 from bhs_api import phonetic
+from bhs_api.cache import get_cached, get_cache_stats, get_worker_cached
+from bhs_api.linkify import TitleMatcher
+from bhs_api.suggest import get_suggest_index
 from bhs_api.persons import (PERSONS_SEARCH_DEFAULT_PARAMETERS, PERSONS_SEARCH_REQUIRES_ONE_OF,
                              PERSONS_SEARCH_YEAR_PARAMS, PERSONS_SEARCH_TEXT_PARAMS_LOWERCASE, PERSONS_SEARCH_EXACT_PARAMS)
 from bhs_api.constants import PIPELINES_ES_DOC_TYPE
@@ -172,6 +175,45 @@ def es_search(q, size, collection=None, from_=0, sort=None, with_persons=False,
         raise Exception("Elasticsearch error: {}".format(e))
     return results
 
+def get_es_search_cache_params(parameters):
+    '''normalize the es_search parameters, so that searches which are bound to
+    return the same results share a cache key
+    >>> sorted(get_es_search_cache_params({"q": " Cohen ", "collection": "places,familyNames", "size": "15", "from_": 0,
+    ...                                    "sort": None, "with_persons": True, "last": None, "last_t": "exact"}).items())
+    [('collection', 'familyNames,places'), ('from_', 0), ('q', 'Cohen'), ('size', 15)]
+    '''
+    text_params = [text_param for text_param, text_attr in PERSONS_SEARCH_TEXT_PARAMS_LOWERCASE]
+    params = {}
+    for k, v in parameters.items():
+        base_param = k[:-2] if k.endswith(("_t", "_v")) else k
+        if v is None or v == "" or (base_param != k and not parameters.get(base_param)):
+            # unset parameters, or the type of an unset parameter, don't affect the results
+            continue
+        elif k in ("size", "from_"):
+            try:
+                v = int(v)
+            except ValueError:
+                pass
+        elif k == "q":
+            v = v.strip()
+        elif k == "collection":
+            v = ",".join(sorted(v.split(",")))
+        elif k == "with_persons":
+            if parameters.get("collection") or not v:
+                # with_persons is ignored when searching specific collections
+                continue
+        elif k in text_params:
+            v = v.lower()
+        elif k == "sex":
+            v = v.upper()
+        params[k] = v
+    return params
+
+def cached_es_search(parameters):
+    '''es_search with the results cached in redis for CACHING_TTL'''
+    return get_cached("search", get_es_search_cache_params(parameters),
+                      lambda: es_search(**parameters))
+
 def _convert_meta_to_bhp6(upload_md, file_info):
     '''Convert language specific metadata fields to bhp6 format.
     Use file_info to set the unit type.
@@ -257,14 +299,52 @@ def _validate_filetype(file_info_str):
     return False
 
 def get_completion_all_collections(string, size=7):
+    '''Search for completion options in all the searchable collections,
+    using the worker's suggest index, or a single elasticsearch request with
+    a suggester per collection when the index is not ready.
+    Returns tuple of (text_completion_results, phonetic_results) dicts
+    of collection name to the results of that collection.
+    '''
+    lang = "he" if phonetic.is_hebrew(string) else "en"
+    suggest_index = get_suggest_index()
+    if suggest_index:
+        return ({collection: suggest_index.complete(collection, lang, string, size)
+                 for collection in SEARCHABLE_COLLECTIONS},
+                {collection: [] for collection in SEARCHABLE_COLLECTIONS})
+    q = {"suggest": {"header_{}".format(collection): get_completion_suggester(collection, string, lang, size)
+                     for collection in SEARCHABLE_COLLECTIONS}}
+    results = current_app.es.search(index=current_app.es_data_db_index_name,
+                                    doc_type=PIPELINES_ES_DOC_TYPE,
+                                    body=q, size=0)
     text_completion_result = {}
     phonetic_result = {}
     for collection in SEARCHABLE_COLLECTIONS:
-        text_completion_result[collection], phonetic_result[collection] = get_completion(collection, string, size)
+        text_completion_result[collection] = get_suggest_options(results, "header_{}".format(collection), lang)
+        phonetic_result[collection] = get_suggest_options(results, "phonetic_{}".format(collection), lang)
     return text_completion_result, phonetic_result
 
+def get_completion_suggester(collection, string, lang, size=7):
+    return {
+        "prefix": string,
+        "completion": {
+            "field": "title_{}_suggest".format(lang),
+            "size": size,
+            "contexts": {
+                "collection": collection,
+            }
+        }
+    }
+
+def get_suggest_options(results, suggester_name, lang):
+    try:
+        options = results['suggest'][suggester_name][0]['options']
+    except KeyError:
+        options = []
+    return [i['_source']['title_{}'.format(lang)] for i in options]
+
 def get_completion(collection, string, size=7):
-    '''Search in the elastic search index for completion options.
+    '''Search in the worker's suggest index for completion options,
+    falls back to the elastic search completion suggester.
     Returns tuple of (text_completion_results, phonetic_results)
     Where each array contains up to `size` results.
     '''
@@ -272,34 +352,20 @@ def get_completion(collection, string, size=7):
     # TODO: fix phonetics search, some work was done for that
     # see https://github.com/Beit-Hatfutsot/dbs-back/blob/2e79c363e40472f28fd07f8a344fe55ab77198ee/bhs_api/v1_endpoints.py#L189
     lang = "he" if phonetic.is_hebrew(string) else "en"
+    suggest_index = get_suggest_index()
+    if suggest_index:
+        return suggest_index.complete(collection, lang, string, size), []
     q = {
         # TODO: find out why it was needed, or if it was a mistake
         # "_source": ["Slug", "Header"],
         "suggest": {
-            "header" : {
-                "prefix": string,
-                "completion": {
-                    "field": "title_{}_suggest".format(lang),
-                    "size": size,
-                    "contexts": {
-                        "collection": collection,
-                    }
-                }
-            },
+            "header": get_completion_suggester(collection, string, lang, size),
         }
     }
     results = current_app.es.search(index=current_app.es_data_db_index_name,
                                     doc_type=PIPELINES_ES_DOC_TYPE,
                                     body=q, size=0)
-    try:
-        header_options = results['suggest']['header'][0]['options']
-    except KeyError:
-        header_options = []
-    try:
-        phonetic_options = results['suggest']['phonetic'][0]['options']
-    except KeyError:
-        phonetic_options = []
-    return  [i['_source']['title_{}'.format(lang)] for i in header_options], [i['_source']['title_{}'.format(lang)] for i in phonetic_options]
+    return get_suggest_options(results, "header", lang), get_suggest_options(results, "phonetic", lang)
 
 
 def get_phonetic(collection, string, limit=5):
@@ -463,7 +529,7 @@ def general_search():
                         got_one_of_required_persons_params = True
         if parameters["q"] or (parameters["collection"] == "persons" and got_one_of_required_persons_params):
             try:
-                res = es_search(**parameters)
+                res = cached_es_search(parameters)
             except Exception as e:
                 logging.exception(e)
                 return humanify({"error": e.message}, 500)
@@ -474,6 +540,11 @@ def general_search():
         logging.exception("unexpected error")
         return humanify(({"error": e.message}, 500))
 
+@v1_endpoints.route('/search/cache')
+def search_cache_stats():
+    '''report the search results cache hit ratio and the elasticsearch time it saved'''
+    return humanify(get_cache_stats("search"))
+
 @v1_endpoints.route('/wsearch')
 def wizard_search():
     '''
@@ -573,8 +644,7 @@ def ftree_search():
     if len(keys) == 1 and keys[0]=='sex':
         em = "Sex only is not enough"
         abort (400, em)
-    total, items = fsearch(**args)
-    return humanify({"items": items, "total": total})
+    return humanify(fsearch(**args))
 
 @v1_endpoints.route('/get_image_urls/<image_ids>')
 def fetch_images(image_ids):
@@ -705,11 +775,37 @@ def get_geocoded_places():
     hits = res["hits"]["hits"]
     return humanify(hits_to_docs(hits))
 
+LINKIFY_COLLECTIONS = ["places", "personalities", "familyNames"]
+
+def build_linkify_matcher(app):
+    matcher = TitleMatcher()
+    items = elasticsearch.helpers.scan(app.es,
+                                       index=app.es_data_db_index_name,
+                                       query={"query": get_collections_es_query(LINKIFY_COLLECTIONS)},
+                                       scroll=u"5m", size=1000)
+    for item in items:
+        item = item["_source"]
+        collection = item["collection"]
+        update_slugs(item, collection)
+        # TODO: support more langs? it's possible from backend perspective
+        for lang in ["he", "en"]:
+            title = item.get("title_{}".format(lang))
+            if title and len(title) > 2:
+                slug = item.get("slug_{}".format(lang))
+                if slug:
+                    # TODO: determine better way to transform slug to URL
+                    # TODO: add the domain dynamically based on the environment
+                    slug = slug.decode("utf-8")
+                    slug = slug.replace(u"_", u"/")
+                    url = u"http://dbs.bh.org.il/{}{}".format("he/" if lang == "he" else "", slug)
+                    matcher.add(title.lower(), (collection, {"title": title, "url": url}))
+    matcher.build()
+    return matcher
+
 @v1_endpoints.route("/linkify", methods=['GET', 'POST'])
 def linkify():
     try:
-        collections = ["places", "personalities", "familyNames"]
-        res = {collection: [] for collection in collections}
+        res = {collection: [] for collection in LINKIFY_COLLECTIONS}
         try:
             if request.method == "POST":
                 html_lower = request.form["html"].lower()
@@ -718,27 +814,9 @@ def linkify():
         except Exception as e:
             logging.exception(e)
             raise
-        items = elasticsearch.helpers.scan(current_app.es,
-                                           index=current_app.es_data_db_index_name,
-                                           query={"query": get_collections_es_query(collections)},
-                                           scroll=u"3h")
-        for item in items:
-            item = item["_source"]
-            collection = item["collection"]
-            update_slugs(item, collection)
-            # TODO: support more langs? it's possible from backend perspective
-            for lang in ["he", "en"]:
-                title = item.get("title_{}".format(lang))
-                if title and len(title) > 2 and title.lower() in html_lower:
-                    slug = item.get("slug_{}".format(lang))
-                    if slug:
-                        # TODO: determine better way to transform slug to URL
-                        # TODO: add the domain dynamically based on the environment
-                        slug = slug.decode("utf-8")
-                        slug = slug.replace(u"_", u"/")
-                        url = u"http://dbs.bh.org.il/{}{}".format("he/" if lang == "he" else "", slug)
-                        res[collection].append({"title": title, "url": url})
+        matcher = get_worker_cached("linkify title matcher", build_linkify_matcher)
+        for collection, link in matcher.search(html_lower):
+            res[collection].append(link)
         return humanify(res)
     except Exception as e:
         return humanify({"error": e.message, "traceback": traceback.format_exc()}, 500)
-
@@ -28,14 +28,23 @@ def add_children(elem, prefix, props):
 
 class Gedcom2Persons:
 
-    def __init__(self, gedcom, tree_num, file_id, onsave, dryrun=False):
-        ''' main import function, receieve a parsed gedcom '''
+    def __init__(self, gedcom, tree_num, file_id, onsave, dryrun=False, ontree=None):
+        ''' main import function, receieve a parsed gedcom.
+            onsave is called with every person and ontree with the tree meta,
+            by default the meta is sent to the update_tree task
+        '''
 
         self.gedcom = gedcom
         self.tree_num = tree_num
         self.file_id = file_id
         self.onsave = onsave
         self.dryrun=dryrun
+        # the same persons and families are visited again and again as the
+        # relatives of their relatives, so these are computed once per pointer
+        self._flat_nodes = {}
+        self._families = {}
+        self._children = {}
+        self._parents = {}
 
         form = ''
         ver = '?'
@@ -77,7 +86,10 @@ class Gedcom2Persons:
                     persons = count,
                     file_id = file_id,
                     )
-        update_tree.delay(self.meta)
+        if ontree:
+            ontree(self.meta)
+        else:
+            update_tree.delay(self.meta)
         self.add_nodes()
 
     def save(self, data, name):
@@ -91,27 +103,53 @@ class Gedcom2Persons:
         data['tree_file_id'] = self.meta['file_id']
         self.onsave(data)
 
+    def make_node(self, e, full=False):
+        node_id = e.pointer[1:-1]
+        node = dict(id=node_id, sex=e.gender)
+        node['deceased'] = not is_living_person(e.deceased, e.birth_year)
+        if not e.private:
+            node['name'] = e.name
+            if full and node['deceased']:
+                node['birth_year'] = e.birth_year
+                node['death_year'] = e.death_year
+                node['marriage_years'] = self.gedcom.marriage_years(e)
+                add_children(e, None, node)
+        if not node['deceased']:
+            # it's alive! delete all keys not in the living person whitelist
+            for key in node:
+                if key not in LIVING_PERSON_WHITELISTED_KEYS:
+                    del node[key]
+        return node
+
     def flatten(self, node_or_nodes, full=False):
         ret = []
-        nodes = node_or_nodes if isinstance(node_or_nodes, collections.Iterable) else [node_or_nodes]
+        many = isinstance(node_or_nodes, collections.Iterable)
+        nodes = node_or_nodes if many else [node_or_nodes]
         for e in nodes:
-            node_id = e.pointer[1:-1]
-            node = dict(id=node_id, sex=e.gender)
-            node['deceased'] = not is_living_person(e.deceased, e.birth_year)
-            if not e.private:
-                node['name'] = e.name
-                if full and node['deceased']:
-                    node['birth_year'] = e.birth_year
-                    node['death_year'] = e.death_year
-                    node['marriage_years'] = self.gedcom.marriage_years(e)
-                    add_children(e, None, node)
-            if not node['deceased']:
-                # it's alive! delete all keys not in the living person whitelist
-                for key in node:
-                    if key not in LIVING_PERSON_WHITELISTED_KEYS:
-                        del node[key]
-            ret.append(node)
-        return ret if isinstance(node_or_nodes, collections.Iterable) else ret[0]
+            if full:
+                ret.append(self.make_node(e, full))
+            else:
+                if e.pointer not in self._flat_nodes:
+                    self._flat_nodes[e.pointer] = self.make_node(e)
+                # a copy, the callers add the relatives of the node to it
+                ret.append(dict(self._flat_nodes[e.pointer]))
+        return ret if many else ret[0]
+
+    def families(self, e, family_type):
+        key = (e.pointer, family_type)
+        if key not in self._families:
+            self._families[key] = self.gedcom.families(e, family_type)
+        return self._families[key]
+
+    def get_children(self, family):
+        if family.pointer not in self._children:
+            self._children[family.pointer] = self.gedcom.get_family_members(family, "CHIL")
+        return self._children[family.pointer]
+
+    def get_parents(self, e):
+        if e.pointer not in self._parents:
+            self._parents[e.pointer] = self.gedcom.get_parents(e)
+        return self._parents[e.pointer]
 
     def find_partners(self, node, depth=0, exclude_ids=None):
         ret = []
@@ -119,11 +157,11 @@ class Gedcom2Persons:
             return ret
 
         if exclude_ids:
-            eids = exclude_ids + [node.pointer]
+            eids = exclude_ids | set([node.pointer])
         else:
-            eids = [node.pointer]
+            eids = set([node.pointer])
 
-        for f in self.gedcom.families(node, "FAMS"):
+        for f in self.families(node, "FAMS"):
             partner = None
             kids = []
             for i in f.children:
@@ -158,9 +196,8 @@ class Gedcom2Persons:
     def find_siblings(self, ptr, e):
         found = []
         siblings_ids = []
-        for family in self.gedcom.families(e, "FAMC"):
-            for sibling in \
-                    self.gedcom.get_family_members(family, "CHIL"):
+        for family in self.families(e, "FAMC"):
+            for sibling in self.get_children(family):
                 siblings_ids.append(sibling.pointer)
                 if sibling.pointer != ptr:
                     found.append(self.flatten(sibling))
@@ -169,12 +206,13 @@ class Gedcom2Persons:
     def find_parents(self, e, siblings_ids):
         ''' gather the parents and their parents '''
         found = []
-        parents = self.gedcom.get_parents(e)
+        parents = self.get_parents(e)
+        siblings_ids = set(siblings_ids)
         for i in parents:
             if not i.is_individual:
                 continue
             parent = self.flatten(i)
-            grandparents = self.gedcom.get_parents(i)
+            grandparents = self.get_parents(i)
             parent["parents"] = self.flatten(grandparents)
             parent["partners"] = self.find_partners(i, depth=1,
                                             exclude_ids=siblings_ids)
@@ -184,8 +222,8 @@ class Gedcom2Persons:
     def add_nodes(self):
         '''Add the self.gedcom nodes to the graph, extracting children data'''
         for ptr, e in self.gedcom.as_dict.items():
-            node = self.flatten(e, full=True)
             if e.is_individual:
+                node = self.flatten(e, full=True)
                 node["partners"] = self.find_partners(e, depth=2)
                 node["siblings"], siblings_ids = self.find_siblings(ptr, e)
                 node["parents"] = self.find_parents(e, siblings_ids)
@@ -0,0 +1,105 @@
+"""
+the mongo indexes of the migrated collections
+
+every index is declared as a (keys, options) tuple - the arguments of
+pymongo's create_index. ensure_indices creates the indexes of a collection
+once per process, scripts/mongo_indices.py diffs them against the live db.
+"""
+import pymongo
+
+_ITEM_FIELDS = ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He']
+
+# the unique key of a person, bhs_api.fsearch sorts the results by it (CURSOR_SORT)
+_PERSON_KEY = [("tree_num", pymongo.ASCENDING),
+               ("tree_version", pymongo.ASCENDING),
+               ("id", pymongo.ASCENDING)]
+
+_SLUG_INDICES = [([("Slug.He", pymongo.ASCENDING)], {"unique": True, "sparse": True}),
+                 ([("Slug.En", pymongo.ASCENDING)], {"unique": True, "sparse": True})]
+
+# single field indexes
+INDICES = {
+    'places': _ITEM_FIELDS,
+    'familyNames': _ITEM_FIELDS,
+    'lexicon': ['UnitId'],
+    'photoUnits': _ITEM_FIELDS,
+    'photos': ['PictureId', 'PictureFileName', 'PicturePath'],
+    # the fields bhs_api.fsearch searches in
+    'persons': ['sex', 'BIRT_PLAC_lc', 'MARR_PLAC_lc', 'tree_num', 'DEAT_PLAC_lc',
+                'all_places_lc', 'all_places_S', 'marriage_years', 'birth_year', 'death_year', 'archived',
+                'deceased'],
+    'synonyms': ['s_group', 'str_lc'],
+    'personalities': _ITEM_FIELDS,
+}
+
+# compound and unique indexes
+UNIQUE_INDICES = {
+    'persons': [(_PERSON_KEY, {"unique": True, "sparse": True}),
+                # the name searches return their first page in the CURSOR_SORT order of the
+                # index, instead of sorting all the persons with the name in memory
+                ([("name_lc.1", pymongo.ASCENDING)] + _PERSON_KEY, {}),
+                ([("name_lc.0", pymongo.ASCENDING)] + _PERSON_KEY, {})],
+}
+
+# collections whose indexes were already created by this process
+_ensured_collections = set()
+
+
+def get_index_keys(keys):
+    ''' returns the keys of an index as a list of (field, direction)
+    >>> get_index_keys("UnitId")
+    [('UnitId', 1)]
+    >>> get_index_keys([(u"tree_num", 1.0), (u"id", -1.0)])
+    [(u'tree_num', 1), (u'id', -1)]
+    '''
+    if isinstance(keys, basestring):
+        return [(keys, pymongo.ASCENDING)]
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction)
+            for field, direction in keys]
+
+
+def get_declared_indices(collection_name):
+    ''' returns the (keys, options) of all the indexes the collection should have '''
+    indices = [(get_index_keys(field), {}) for field in INDICES.get(collection_name, [])]
+    indices += UNIQUE_INDICES.get(collection_name, _SLUG_INDICES)
+    return indices
+
+
+def get_live_indices(collection):
+    ''' returns the (keys, options) of the indexes the collection has, without the _id index '''
+    indices = []
+    for name, info in collection.index_information().items():
+        if name != "_id_":
+            options = {option: info[option] for option in ("unique", "sparse") if info.get(option)}
+            indices.append((get_index_keys(info["key"]), options))
+    return indices
+
+
+def diff_indices(declared, live):
+    ''' returns the (missing, extra, changed) indexes, changed are the
+        (declared, live) pairs of the indexes that differ in their options
+    >>> diff_indices([([('UnitId', 1)], {}), ([('Slug.En', 1)], {'unique': True})],
+    ...              [([('Slug.En', 1)], {}), ([('Header.En', 1)], {})])
+    ([([('UnitId', 1)], {})], [([('Header.En', 1)], {})], [(([('Slug.En', 1)], {'unique': True}), ([('Slug.En', 1)], {}))])
+    '''
+    missing, changed = [], []
+    for keys, options in declared:
+        live_index = next((index for index in live if index[0] == keys), None)
+        if not live_index:
+            missing.append((keys, options))
+        elif live_index[1] != options:
+            changed.append(((keys, options), live_index))
+    declared_keys = [keys for keys, _ in declared]
+    extra = [(keys, options) for keys, options in live if keys not in declared_keys]
+    return missing, extra, changed
+
+
+def ensure_indices(collection, force=False):
+    ''' create the declared indexes of the collection, only the first call
+        for each collection does it unless force is set
+    '''
+    if collection.full_name in _ensured_collections and not force:
+        return
+    for keys, options in get_declared_indices(collection.name):
+        collection.create_index(keys, **options)
+    _ensured_collections.add(collection.full_name)
@@ -14,7 +14,9 @@ class MigrationSQLClient:
 
     def execute(self, query, hunk_size=10000, stringify=False, 
                 unit_ids=None, since=0, until=0):
-        """ This method executes a SQL query and returns a pymssql cursor """
+        """ This method executes a SQL query and returns a generator of its
+            rows, which fetches them from the server hunk_size rows at a time
+        """
 
         params = {}
         if unit_ids:
@@ -25,7 +27,19 @@ class MigrationSQLClient:
         params['since'] = MayaDT(since).datetime().strftime('%Y-%m-%d %H:%M:%S')
         params['until'] = MayaDT(until).datetime().strftime('%Y-%m-%d %H:%M:%S')
         self.cursor.execute(query, params)
-        return self.cursor
+        return self.fetch_rows(self.cursor, hunk_size)
+
+    @staticmethod
+    def fetch_rows(cursor, hunk_size=10000):
+        """ yields the rows of an executed cursor without keeping more than
+            hunk_size of them in memory
+        """
+        while True:
+            rows = cursor.fetchmany(hunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
 
     def audit(self, **params):
         self.cursor.execute(params['query'], (params['operation'], params['from_date'], params['to_date'], params['unit_type']))
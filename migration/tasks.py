@@ -1,29 +1,35 @@
 import os
 import json
+import hashlib
 import elasticsearch
+import elasticsearch.helpers
 import pymongo
 from celery import Celery
 from flask import current_app
 from bhs_api import create_app
 from bhs_api.utils import uuids_to_str
-from bhs_api.item import get_collection_id_field, create_slug, doc_show_filter, get_doc_id, update_es
+from bhs_api.item import get_collection_id_field, create_slug, doc_show_filter, get_doc_id, get_es_doc, update_es
 from scripts.get_places_geo import get_place_geo
 from scripts.batch_related import get_bhp_related
+from bhs_api.cache import invalidate_cache
+from migration.indices import ensure_indices
 
 
 MIGRATE_MODE = os.environ.get('MIGRATE_MODE')
 MIGRATE_ES = os.environ.get('MIGRATE_ES', '1')
 MIGRATE_RELATED = os.environ.get('MIGRATE_RELATED', True)
-INDICES = {
-    'places' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
-    'familyNames' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
-    'lexicon' : ['UnitId'],
-    'photoUnits' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
-    'photos' : ['PictureId', 'PictureFileName', 'PicturePath'],
-    'persons' : ['name_lc.0', 'name_lc.1', 'sex', 'BIRT_PLAC_lc', 'MARR_PLAC_lc', 'tree_num', 'DEAT_PLAC_lc'],
-    'synonyms': ['s_group', 'str_lc'],
-    'personalities' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He']
-}
+# number of rows scripts.migrate sends to a single update_rows task, 0 sends a task per row
+MIGRATE_BATCH_SIZE = int(os.environ.get('MIGRATE_BATCH_SIZE', 500))
+# when a new tree version is migrated, carry forward the persons whose content didn't change
+MIGRATE_TREE_DIFF = os.environ.get('MIGRATE_TREE_DIFF', '0')
+
+# redis hash of the update counts of the current migration run, by "collection:count"
+MIGRATE_STATS_KEY = 'migrate_stats'
+
+# fields which are not part of the content hash of a doc
+HASH_EXCLUDED_FIELDS = ('_id', 'Slug', 'related', 'archived', 'content_hash')
+# persons fields which change with every version of the tree
+TREE_VERSION_FIELDS = ('tree_version', 'tree_file_id', 'tree_size')
 
 def make_celery():
     app, conf = create_app()
@@ -43,6 +49,7 @@ def make_celery():
     celery = Celery(app.import_name, broker=redis_broker)
     celery.conf.update(app.config)
     celery.data_db = app.data_db
+    celery.redis = app.redis
     # boiler plate to get our tasks running in the app context
     TaskBase = celery.Task
     class ContextTask(TaskBase):
@@ -55,22 +62,6 @@ def make_celery():
 celery = make_celery()
 
 
-def ensure_indices(collection):
-    indices = INDICES.get(collection.name, set())
-    for index in indices:
-        collection.ensure_index(index)
-    # add unique inxexes
-    if collection.name == 'persons':
-        collection.create_index([("tree_num", pymongo.ASCENDING),
-                ("tree_version", pymongo.ASCENDING),
-                ("id", pymongo.ASCENDING),
-            ],
-            unique=True, sparse=True)
-    else:
-        collection.create_index("Slug.He", unique=True, sparse=True)
-        collection.create_index("Slug.En", unique=True, sparse=True)
-
-
 def reslugify(collection, document):
     ''' append the document id to the slug to ensure uniquness '''
     for lang, val in document['Slug'].items():
@@ -116,6 +107,7 @@ def update_tree(data, db=None):
              'tree_version': {'$lt': last_version}},
             {'$set': {'archived': True}}
         )
+        invalidate_caches(persons)
 
     else:
         doc['versions'] = [current_ver]
@@ -125,6 +117,50 @@ def update_tree(data, db=None):
                           300)
 
 
+def get_content_hash(document, excluded_fields=HASH_EXCLUDED_FIELDS):
+    ''' returns a hash of the document which doesn't depend on the keys order
+    >>> get_content_hash({'a': 1, 'b': [u'x'], 'Slug': {'En': 'a'}}) == get_content_hash({'b': ['x'], 'a': 1})
+    True
+    '''
+    content = {k: v for k, v in document.items() if k not in excluded_fields}
+    # latin-1 accepts any byte string, e.g. the thumbnails of photos
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=unicode, encoding='latin-1')).hexdigest()
+
+
+def invalidate_caches(collection):
+    ''' the cached responses may include the docs which were just written,
+        the invalidations of all the writes during CACHING_INVALIDATION_DELAY are merged
+    '''
+    delay = current_app.config.get('CACHING_INVALIDATION_DELAY')
+    invalidate_cache('search', delay=delay)
+    if collection.name == 'persons':
+        invalidate_cache('persons_count', delay=delay)
+
+
+def count_updates(collection_name, **counts):
+    ''' add to the update counts of the current migration run '''
+    if celery.redis:
+        pipe = celery.redis.pipeline()
+        for name, count in counts.items():
+            if count:
+                pipe.hincrby(MIGRATE_STATS_KEY, '{}:{}'.format(collection_name, name), count)
+        pipe.execute()
+
+
+def get_update_counts():
+    ''' returns the update counts of the current migration run, by collection name '''
+    counts = {}
+    for key, count in (celery.redis.hgetall(MIGRATE_STATS_KEY) if celery.redis else {}).items():
+        collection_name, name = key.rsplit(':', 1)
+        counts.setdefault(collection_name, {})[name] = int(count)
+    return counts
+
+
+def reset_update_counts():
+    if celery.redis:
+        celery.redis.delete(MIGRATE_STATS_KEY)
+
+
 def find_version(tree_vers, file_id):
     ''' finding the version index based on an array of version and a file id '''
     for i, ver in enumerate(tree_vers):
@@ -141,17 +177,28 @@ def update_row(doc, collection_name):
     update_doc(collection, doc)
     ensure_indices(collection)
 
-def update_collection(collection, query, doc):
-    """ update the mongo collection.
-        returns True is a new doc was created and False is an existing item
-        has been updated
-    """
 
+@celery.task
+def update_rows(docs, collection_name):
+    ''' update a chunk of rows of the same collection '''
+    collection = celery.data_db[collection_name]
+    update_docs(collection, docs)
+    ensure_indices(collection)
+
+def add_related(collection, doc):
     if MIGRATE_RELATED != '0':
         doc['related'] = get_bhp_related(doc, collection.name,
                                                 max_items=6,
                                                 bhp_only=True)
 
+
+def update_collection(collection, query, doc):
+    """ update the mongo collection.
+        returns True is a new doc was created and False is an existing item
+        has been updated
+    """
+    add_related(collection, doc)
+
     if MIGRATE_MODE  == 'i':
         doc['Slug'] = create_slug(doc, collection.name)
         try:
@@ -186,7 +233,10 @@ def update_collection(collection, query, doc):
     return created
 
 
-def update_doc(collection, document):
+def get_doc_query(collection, document):
+    """ prepare the document for saving and return the query for its existing doc,
+        returns None if the document has no id.
+    """
     # update place items with geojson
     if collection.name == 'places':
         document['geometry'] = get_place_geo(document)
@@ -221,23 +271,235 @@ def update_doc(collection, document):
                               tree_num,
                               i,
                               id)}
+        document['content_hash'] = get_content_hash(document, HASH_EXCLUDED_FIELDS + TREE_VERSION_FIELDS)
+        return query
+    else:
+        doc_id = get_doc_id(collection.name, document)
+        if doc_id:
+            document['content_hash'] = get_content_hash(document)
+            return {get_collection_id_field(collection.name): doc_id}
+        else:
+            return None
+
+
+def get_saved_docs(collection, queries, fields):
+    """ gets (query, document) pairs and returns the saved doc of each pair,
+        or None if it's not saved, with only the given fields
+    """
+    # all the queries of a collection match on the same fields
+    query_fields = sorted(queries[0][0])
+    key = lambda doc: tuple(doc.get(field) for field in query_fields)
+    projection = {field: 1 for field in query_fields + list(fields)}
+    saved_docs = {key(saved): saved for saved in collection.find({'$or': [query for query, _ in queries]}, projection)}
+    return [saved_docs.get(key(query)) for query, _ in queries]
+
+
+def get_unchanged_docs(collection, queries):
+    """ gets (query, document) pairs and returns the id() of the documents
+        which are saved with the same content hash
+    """
+    if MIGRATE_MODE == 'i' or not queries:
+        return set()
+    return set(id(document) for (query, document), saved in zip(queries, get_saved_docs(collection, queries, ['content_hash']))
+               if saved and saved.get('content_hash') == document['content_hash'])
+
+
+def add_saved_slugs(collection, queries):
+    """ the slug of a new doc is only set on insert, copy it from the saved doc """
+    queries = [(query, document) for query, document in queries if 'Slug' not in document]
+    if queries:
+        for (query, document), saved in zip(queries, get_saved_docs(collection, queries, ['Slug'])):
+            if saved and saved.get('Slug'):
+                document['Slug'] = saved['Slug']
+
+
+def get_doc_log_identifier(collection, document):
+    if collection.name == 'persons':
+        return 'person: {}.{}'.format(document['tree_num'], document['id'])
+    else:
+        return '{} {}, Slug: {}'.format(collection.name, get_doc_id(collection.name, document),
+                                        document.get("Slug", {}).get("En"))
+
+
+def get_unchanged_persons(collection, documents):
+    """ in tree diff mode, returns (previous, document) pairs of the persons
+        which have the same content in an earlier version of their tree
+    """
+    if MIGRATE_TREE_DIFF != '1' or collection.name != 'persons':
+        return []
+    versions = {}
+    for document in documents:
+        versions.setdefault((document['tree_num'], document['tree_version']), []).append(document)
+    unchanged = []
+    for (tree_num, tree_version), tree_documents in versions.items():
+        # the latest earlier version of each person, archived or not - update_tree
+        # archives all the persons of the earlier versions
+        previous = {}
+        for person in collection.find({'tree_num': tree_num,
+                                       'id': {'$in': [document['id'] for document in tree_documents]},
+                                       'tree_version': {'$lte': tree_version}},
+                                      {'id': 1, 'tree_version': 1, 'content_hash': 1}
+                                      ).sort('tree_version', pymongo.ASCENDING):
+            previous[person['id']] = person
+        for document in tree_documents:
+            person = previous.get(document['id'])
+            # a person of the same version is a rerun of the version, it's updated as usual
+            if (person and person['tree_version'] < tree_version
+                    and person.get('content_hash') == document['content_hash']):
+                unchanged.append((person, document))
+    return unchanged
+
+
+def carry_forward_persons(collection, unchanged):
+    """ copy the unchanged persons to the new version of their tree, only the
+        version fields and the slug of the copy are updated, so the related
+        persons don't need to be computed again. like update_tree does, the
+        previous version is archived - its doc is kept in mongo and
+        elasticsearch so its slug still resolves to the archived person
+    """
+    saved = {person['_id']: person
+             for person in collection.find({'_id': {'$in': [previous['_id'] for previous, _ in unchanged]}})}
+    ops, persons = [], []
+    for previous, document in unchanged:
+        person = saved[previous['_id']].copy()
+        person.pop('_id')
+        person.pop('archived', None)
+        person.update({field: document[field] for field in TREE_VERSION_FIELDS + ('Slug',)})
+        persons.append(person)
+        ops.append(pymongo.InsertOne(person))
+        ops.append(pymongo.UpdateOne({'_id': previous['_id']}, {'$set': {'archived': True}}))
+    collection.bulk_write(ops, ordered=False)
+    count_updates(collection.name, carried=len(persons))
+    if MIGRATE_ES == '1':
+        actions = []
+        for person in persons:
+            es_id, body = get_es_doc(collection.name, person)
+            actions.append({'_index': current_app.es_data_db_index_name,
+                            '_type': collection.name,
+                            '_id': es_id,
+                            '_source': body})
+        failed = bulk_es(actions)
+        for action in actions:
+            if action['_id'] in failed:
+                current_app.logger.error('failed to carry forward person {}: {}'.format(action['_id'], failed[action['_id']]))
+    invalidate_caches(collection)
+    current_app.logger.info('Carried forward {} unchanged persons'.format(len(unchanged)))
+
+
+def update_doc(collection, document):
+    query = get_doc_query(collection, document)
+    unchanged = get_unchanged_persons(collection, [document]) if query else None
+    if unchanged:
+        carry_forward_persons(collection, unchanged)
+    elif query and get_unchanged_docs(collection, [(query, document)]):
+        current_app.logger.info('Skipped unchanged {}'.format(get_doc_log_identifier(collection, document)))
+        count_updates(collection.name, skipped=1)
+    elif query:
         created = update_collection(collection, query, document)
         if MIGRATE_ES == '1':
             is_ok, msg = update_es(collection.name, document, created)
             if not is_ok:
                 current_app.logger.error(msg)
-        current_app.logger.info('Updated person: {}.{}'
-                                .format(tree_num, id))
+        invalidate_caches(collection)
+        current_app.logger.info('Updated {}'.format(get_doc_log_identifier(collection, document)))
+        count_updates(collection.name, updated=1)
     else:
-        doc_id = get_doc_id(collection.name, document)
-        if doc_id:
-            query = {get_collection_id_field(collection): doc_id}
-            created = update_collection(collection, query, document)
-            if MIGRATE_ES == '1':
-                is_ok, msg = update_es(collection.name, document, created)
-                if not is_ok:
-                    current_app.logger.error(msg)
-            slug = document.get("Slug", {}).get("En")
-            current_app.logger.info('Updated {} {}, Slug: {}'.format(collection.name, doc_id, slug))
+        current_app.logger.error('update failed because of id {}'.format(collection.name))
+
+
+def get_upsert_op(collection, query, document):
+    """ returns the bulk write operation that does what update_collection does """
+    if MIGRATE_MODE == 'i':
+        document['Slug'] = create_slug(document, collection.name)
+        return pymongo.InsertOne(document)
+    update = {'$set': document}
+    if 'Slug' not in document:
+        update['$setOnInsert'] = {'Slug': create_slug(document, collection.name)}
+    return pymongo.UpdateOne(query, update, upsert=True)
+
+
+def bulk_update_es(collection, documents):
+    """ update the documents in elasticsearch with a single bulk request, like
+        update_es of an existing doc - new docs are added and the fields of the
+        existing docs are updated.
+        returns a list of (document, error message) for the failed documents
+    """
+    actions = []
+    for document in documents:
+        es_id, body = get_es_doc(collection.name, document)
+        actions.append({'_op_type': 'update',
+                        '_index': current_app.es_data_db_index_name,
+                        '_type': collection.name,
+                        '_id': es_id,
+                        'doc': body,
+                        'doc_as_upsert': True})
+    failed = bulk_es(actions)
+    return [(document, failed[action['_id']]) for document, action in zip(documents, actions)
+            if action['_id'] in failed]
+
+
+def bulk_es(actions):
+    """ send the actions in a single elasticsearch bulk request,
+        returns the error messages of the failed actions by their _id
+    """
+    _, errors = elasticsearch.helpers.bulk(current_app.es, actions, raise_on_error=False, raise_on_exception=False)
+    failed = {}
+    for error in errors:
+        for op_result in error.values():
+            failed[op_result.get('_id')] = op_result.get('error', op_result)
+    return failed
+
+
+def update_docs(collection, documents):
+    """ update a chunk of documents with a single mongo bulk write and a single
+        elasticsearch bulk request, errors are logged per document.
+    """
+    queries = []
+    for document in documents:
+        query = get_doc_query(collection, document)
+        if query:
+            queries.append((query, document))
         else:
             current_app.logger.error('update failed because of id {}'.format(collection.name))
+    unchanged = get_unchanged_persons(collection, [document for _, document in queries])
+    if unchanged:
+        carry_forward_persons(collection, unchanged)
+        carried = set(id(document) for _, document in unchanged)
+        queries = [(query, document) for query, document in queries if id(document) not in carried]
+    skipped = get_unchanged_docs(collection, queries)
+    if skipped:
+        current_app.logger.info('Skipped {} unchanged {} documents'.format(len(skipped), collection.name))
+        queries = [(query, document) for query, document in queries if id(document) not in skipped]
+    count_updates(collection.name, skipped=len(skipped))
+    if not queries:
+        return
+    for _, document in queries:
+        add_related(collection, document)
+    failed = set()
+    try:
+        collection.bulk_write([get_upsert_op(collection, query, document) for query, document in queries],
+                              ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            query, document = queries[error['index']]
+            if error['code'] == 11000:
+                # duplicate slug - seems like we need to add the id to the slug
+                try:
+                    document.setdefault('Slug', create_slug(document, collection.name))
+                    reslugify(collection, document)
+                    collection.update_one(query, {'$set': document}, upsert=True)
+                    continue
+                except pymongo.errors.PyMongoError as retry_error:
+                    error = {'errmsg': str(retry_error)}
+            failed.add(id(document))
+            current_app.logger.error('failed to update {}: {}'.format(get_doc_log_identifier(collection, document),
+                                                                      error.get('errmsg')))
+    saved = [document for _, document in queries if id(document) not in failed]
+    if MIGRATE_ES == '1' and saved:
+        add_saved_slugs(collection, [(query, document) for query, document in queries if id(document) not in failed])
+        for document, msg in bulk_update_es(collection, saved):
+            current_app.logger.error('failed to index {}: {}'.format(get_doc_log_identifier(collection, document), msg))
+    if saved:
+        invalidate_caches(collection)
+    current_app.logger.info('Updated {} {} documents'.format(len(saved), collection.name))
+    count_updates(collection.name, updated=len(saved), failed=len(failed))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from datetime import datetime
+from pymongo import UpdateOne
+from bhs_api import create_app
+from bhs_api.persons import get_all_places, PERSON_PLACE_FIELDS
+
+
+class BackfillAllPlacesCommand(object):
+    ''' add the all_places_lc / all_places_S fields to persons which were migrated before they existed '''
+
+    def __init__(self, app=None):
+        self.args = self._parse_args()
+        self.app, self.conf = create_app() if not app else (app, app.conf)
+
+    def _parse_args(self):
+        parser = ArgumentParser()
+        parser.add_argument('--all', action="store_true", help="update persons which already have the fields as well")
+        parser.add_argument('--tree-num', type=int, help="only update persons of a single tree")
+        parser.add_argument('--batch-size', type=int, default=1000, help="number of updates to send to mongo at once")
+        parser.add_argument('--limit', type=int, help="update up to LIMIT persons - good for development / testing")
+        return parser.parse_args()
+
+    def _flush(self, persons, updates):
+        if updates:
+            persons.bulk_write(updates, ordered=False)
+        return len(updates)
+
+    def main(self):
+        started = datetime.now()
+        persons = self.app.data_db["persons"]
+        query = {}
+        if not self.args.all:
+            query["all_places_lc"] = {"$exists": False}
+        if self.args.tree_num is not None:
+            query["tree_num"] = self.args.tree_num
+        projection = {field: 1 for field in PERSON_PLACE_FIELDS}
+        cursor = persons.find(query, projection, no_cursor_timeout=True)
+        if self.args.limit:
+            cursor = cursor.limit(self.args.limit)
+        num_updated, updates = 0, []
+        try:
+            for person in cursor:
+                updates.append(UpdateOne({"_id": person["_id"]}, {"$set": get_all_places(person)}))
+                if len(updates) >= self.args.batch_size:
+                    num_updated += self._flush(persons, updates)
+                    updates = []
+                    print("updated {} persons".format(num_updated))
+            num_updated += self._flush(persons, updates)
+        finally:
+            cursor.close()
+        print("updated {} persons in {}".format(num_updated, datetime.now() - started))
+
+
+if __name__ == '__main__':
+    BackfillAllPlacesCommand().main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+import io
+import random
+import elasticsearch.helpers
+from bhs_api import create_app
+from bhs_api.constants import PIPELINES_ES_DOC_TYPE
+from bhs_api.utils import SEARCHABLE_COLLECTIONS
+from bhs_api.v1_endpoints import get_collections_es_query
+from scripts.elasticsearch_create_index import ElasticsearchCreateIndexCommand, PROFILES
+
+
+# the collections of a search without the persons
+COLLECTIONS = [collection for collection in SEARCHABLE_COLLECTIONS if collection != "persons"]
+
+
+def get_search_query(q):
+    return {"query_string": {"fields": ["title_en", "title_he", "content_html_he", "content_html_en"],
+                             "query": q, "default_operator": "and"}}
+
+
+# the queries to compare, as functions of (q, slugs) that return the search body
+QUERIES = [("search", lambda q, slugs: {"query": {"bool": {"must": [get_search_query(q),
+                                                                      get_collections_es_query(COLLECTIONS)]}}}),
+           ("search sort=abc", lambda q, slugs: {"query": {"bool": {"must": [get_search_query(q),
+                                                                               get_collections_es_query(COLLECTIONS)]}},
+                                                 "sort": [{"title_en_lc": "asc"}, "_score"]}),
+           ("slugs", lambda q, slugs: {"query": {"constant_score": {"filter": {"terms": {"slugs": slugs}}}}})]
+
+
+class BenchmarkEsProfilesCommand(object):
+
+    def __init__(self):
+        self.args = self._parse_args()
+        self.app, self.conf = create_app()
+        self.es = self.app.es
+
+    def _parse_args(self):
+        parser = ArgumentParser(description="compare the search latency of indexes created with the mapping profiles, "
+                                            "the docs of the source index are copied to an index per profile")
+        parser.add_argument('--index', help="the source index (defaults to index from app config)")
+        parser.add_argument('--queries', help="utf-8 file with a search query per line, words from random titles are used by default")
+        parser.add_argument('--num-queries', type=int, default=50, help="number of random queries")
+        parser.add_argument('--repeat', type=int, default=5, help="number of times to run every query")
+        parser.add_argument('--size', type=int, default=20, help="number of results of every query")
+        parser.add_argument('--keep', action="store_true", help="keep the indexes of the profiles")
+        parser.add_argument('--seed', type=int, default=1)
+        return parser.parse_args()
+
+    def _get_profile_index_name(self, profile):
+        return "{}_benchmark_{}".format(self.args.index, profile)
+
+    def _create_profile_indices(self):
+        command = ElasticsearchCreateIndexCommand()
+        for profile in PROFILES:
+            index_name = self._get_profile_index_name(profile)
+            command.create_es_index(self.es, index_name, delete_existing=True, profile=profile)
+            print("copying {} to {}..".format(self.args.index, index_name))
+            elasticsearch.helpers.reindex(self.es, self.args.index, index_name)
+            # compare the indexes in the same state, as much as possible
+            self.es.indices.forcemerge(index=index_name, max_num_segments=1)
+            self.es.indices.refresh(index=index_name)
+
+    def _get_sample_docs(self):
+        body = {"query": {"function_score": {"random_score": {"seed": self.args.seed}}}}
+        hits = self.es.search(index=self.args.index, doc_type=PIPELINES_ES_DOC_TYPE, body=body,
+                              size=self.args.num_queries)["hits"]["hits"]
+        return [hit["_source"] for hit in hits]
+
+    def _get_queries(self):
+        ''' returns a list of (q, slugs) '''
+        rand = random.Random(self.args.seed)
+        docs = self._get_sample_docs()
+        slugs = [slug for doc in docs for slug in doc.get("slugs", [])]
+        if self.args.queries:
+            with io.open(self.args.queries, encoding="utf-8") as f:
+                qs = [line.strip() for line in f if line.strip()]
+        else:
+            qs = [rand.choice(doc["title_en"].split()) for doc in docs if doc.get("title_en")]
+        return [(q, rand.sample(slugs, min(len(slugs), 5))) for q in qs]
+
+    def _measure(self, index_name, body):
+        return self.es.search(index=index_name, doc_type=PIPELINES_ES_DOC_TYPE, body=body, size=self.args.size)["took"]
+
+    def _print_stats(self, name, profile, took):
+        took = sorted(took)
+        print("{:<26} {:<12} {:>8.1f} {:>8} {:>8} {:>8}".format(name, profile, float(sum(took)) / len(took),
+                                                            took[len(took) // 2], took[int(len(took) * 0.95)], took[-1]))
+
+    def main(self):
+        if not self.args.index:
+            self.args.index = self.app.es_data_db_index_name
+        self._create_profile_indices()
+        try:
+            queries = self._get_queries()
+            if not queries:
+                raise Exception("no queries to run, index {} has no docs with titles".format(self.args.index))
+            print("{:<26} {:<12} {:>8} {:>8} {:>8} {:>8}".format("query", "profile", "mean ms", "p50", "p95", "max"))
+            for name, get_body in QUERIES:
+                took = {profile: [] for profile in PROFILES}
+                for q, slugs in queries:
+                    body = get_body(q, slugs)
+                    # the profiles take turns so they are affected the same by the load on the cluster
+                    for _ in range(self.args.repeat):
+                        for profile in PROFILES:
+                            took[profile].append(self._measure(self._get_profile_index_name(profile), body))
+                for profile in PROFILES:
+                    self._print_stats(name, profile, took[profile])
+        finally:
+            if not self.args.keep:
+                for profile in PROFILES:
+                    self.es.indices.delete(self._get_profile_index_name(profile))
+
+
+if __name__ == '__main__':
+    BenchmarkEsProfilesCommand().main()
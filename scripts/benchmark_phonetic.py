@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+import imp
+import random
+import time
+import io
+from bhs_api import phonetic
+
+
+class BenchmarkPhoneticCommand(object):
+
+    def __init__(self):
+        self.args = self._parse_args()
+
+    def _parse_args(self):
+        parser = ArgumentParser(description="measure the words per second of the phonetic encoders")
+        parser.add_argument('--words', help="utf-8 file with a word per line, random words are used by default")
+        parser.add_argument('--num-words', type=int, default=100000, help="number of random words")
+        parser.add_argument('--vocabulary', type=int, default=10000, help="number of distinct random words")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5, help="number of words to encode_many at once")
+        parser.add_argument('--baseline', help="phonetic.py of the version to compare with, e.g. the output of "
+                                               "`git show <commit>:bhs_api/phonetic.py`")
+        return parser.parse_args()
+
+    def _get_words(self):
+        if self.args.words:
+            with io.open(self.args.words, encoding="utf-8") as f:
+                return [line.strip() for line in f if line.strip()]
+        rand = random.Random(self.args.seed)
+        vocabulary = ["".join(rand.choice("ABCDEFGHIJKLMNOPRSTUVWZAEIOU") for _ in range(rand.randint(3, 10)))
+                      for _ in range(self.args.vocabulary)]
+        # names are repeated a lot, a few of them make most of the data
+        return [vocabulary[min(int(rand.paretovariate(1)) - 1, len(vocabulary) - 1)]
+                for _ in range(self.args.num_words)]
+
+    def _measure(self, name, func, words):
+        started = time.time()
+        res = func(words)
+        took = time.time() - started
+        print("{:<24} {:>10.0f} words/s ({} words in {:.2f}s)".format(name, len(words) / took, len(words), took))
+        return res
+
+    def _clear_cache(self):
+        phonetic._dms_cache.clear()
+
+    def main(self):
+        words = self._get_words()
+        hebrew_words = [word for word in words if phonetic.is_hebrew(word)]
+        words = [word for word in words if not phonetic.is_hebrew(word)]
+        if words:
+            distinct_words = list(set(words))
+            if self.args.baseline:
+                baseline = imp.load_source("phonetic_baseline", self.args.baseline)
+                expected = self._measure("baseline (distinct)", lambda words: [baseline.dm_soundex(word) for word in words], distinct_words)
+                self._measure("baseline", lambda words: [baseline.dm_soundex(word) for word in words], words)
+            self._clear_cache()
+            res = self._measure("dm_soundex (distinct)", lambda words: [phonetic.dm_soundex(word) for word in words], distinct_words)
+            if self.args.baseline and res != expected:
+                raise Exception("dm_soundex and the baseline encoded some of the words differently")
+            self._clear_cache()
+            self._measure("dm_soundex", lambda words: [phonetic.dm_soundex(word) for word in words], words)
+            self._clear_cache()
+            # the migration encodes the names and places of a person in a batch
+            size = self.args.batch_size
+            res = self._measure("encode_many", lambda words: [codes for i in range(0, len(words), size)
+                                                              for codes in phonetic.encode_many(words[i:i + size])], words)
+            if self.args.baseline and res != [baseline.dm_soundex(word) for word in words]:
+                raise Exception("encode_many and the baseline encoded some of the words differently")
+        if hebrew_words:
+            self._measure("get_hebrew_dms", lambda words: [phonetic.get_hebrew_dms(word) for word in words], hebrew_words)
+            self._measure("get_hebrew_dms_many", phonetic.get_hebrew_dms_many, hebrew_words)
+
+
+if __name__ == '__main__':
+    BenchmarkPhoneticCommand().main()
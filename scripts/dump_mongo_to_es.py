@@ -3,14 +3,18 @@
 import datetime
 from uuid import UUID
 import argparse
+import json
+from itertools import islice
 
 import elasticsearch
+import elasticsearch.helpers
 
 from bhs_api import create_app
 from bhs_api import phonetic
 from bhs_api.utils import uuids_to_str, SEARCHABLE_COLLECTIONS
 from bhs_api.item import SHOW_FILTER
-from scripts.elasticsearch_create_index import ElasticsearchCreateIndexCommand
+from bhs_api.cache import invalidate_cache
+from scripts.elasticsearch_create_index import ElasticsearchCreateIndexCommand, PROFILES
 
 
 def parse_args():
@@ -18,26 +22,94 @@ def parse_args():
     parser.add_argument('-c', '--collection',
                         help='run only on collection')
     parser.add_argument('-r', '--remove', action = "store_true",
-                        help='remove the current index')
+                        help='replace the current index - load a new version of it and then swap the alias to it')
+    parser.add_argument('--keep-versions', type=int, default=1,
+                        help='number of previous index versions to keep after replacing the index')
+    parser.add_argument('--profile', choices=PROFILES, default='default',
+                        help='mapping profile of a new index')
     parser.add_argument('--db',
                         help='the db to run on defaults to the value in /etc/bhs/config.yml')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='number of docs in a bulk request')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of bulk requests to send in parallel')
+    parser.add_argument('--dead-letter', default='dump_mongo_to_es.failed',
+                        help='file to append the docs that failed to index to, a json object per line')
     return parser.parse_args()
 
 
 
 class MongoToEsDumper(object):
 
-    def __init__(self, es, es_index_name, mongo_db):
+    # the index settings during the load - no refreshes and no replicas to copy the docs to
+    INGEST_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+    def __init__(self, app, es, es_index_name, mongo_db, chunk_size=500, thread_count=1, dead_letter_file=None,
+                 keep_versions=1, profile="default"):
+        self.app = app
         self.es = es
         self.es_index_name = es_index_name
         self.mongo_db = mongo_db
+        self.chunk_size = chunk_size
+        self.thread_count = thread_count
+        self.dead_letter_file = dead_letter_file
+        self.keep_versions = keep_versions
+        self.profile = profile
+        self.num_failed = 0
 
     def _process_collection(self, collection):
         started = datetime.datetime.now()
-        for doc in self.mongo_db[collection].find(SHOW_FILTER):
-            self._process_doc(collection, doc)
+        num_indexed = 0
+        for ok, item in self._bulk(self._get_actions(collection)):
+            if ok:
+                num_indexed += 1
+            else:
+                self._add_dead_letter(collection, item)
         finished = datetime.datetime.now()
-        print 'Collection {} took {}'.format(collection, finished - started)
+        print 'Collection {} took {}, {} docs indexed'.format(collection, finished - started, num_indexed)
+
+    def _bulk(self, actions):
+        ''' yields the (ok, item) results of indexing the actions '''
+        if self.thread_count > 1:
+            # parallel_bulk makes a list of all the actions, so it gets them a batch at a time
+            batch_size = self.chunk_size * self.thread_count * 10
+            while True:
+                batch = list(islice(actions, batch_size))
+                if not batch:
+                    break
+                for result in elasticsearch.helpers.parallel_bulk(self.es, batch, thread_count=self.thread_count,
+                                                                  chunk_size=self.chunk_size, raise_on_error=False,
+                                                                  raise_on_exception=False):
+                    yield result
+        else:
+            for result in elasticsearch.helpers.streaming_bulk(self.es, actions, chunk_size=self.chunk_size,
+                                                               raise_on_error=False, raise_on_exception=False):
+                yield result
+
+    def _get_actions(self, collection):
+        for doc in self.mongo_db[collection].find(SHOW_FILTER):
+            action = self._get_action(collection, doc)
+            if action:
+                yield action
+
+    def _add_dead_letter(self, collection, item):
+        ''' item is the failed action or a result of the bulk helpers - {op_type: {"_id": ..., "error": ...}} '''
+        self.num_failed += 1
+        if len(item) == 1 and isinstance(item.values()[0], dict):
+            item = item.values()[0]
+        item = {k: v for k, v in item.items() if k != "exception"}
+        print 'failed to index {} {}: {}'.format(collection, item.get("_id"), item.get("error"))
+        if self.dead_letter_file:
+            with open(self.dead_letter_file, "a") as f:
+                f.write(json.dumps(dict(item, collection=collection), default=str) + "\n")
+
+    def _set_index_settings(self, settings):
+        ''' returns the previous values of the settings '''
+        index_settings = self.es.indices.get_settings(index=self.es_index_name).values()[0]["settings"]["index"]
+        # unset settings are restored to the elasticsearch defaults
+        previous = {name: index_settings.get(name) for name in settings}
+        self.es.indices.put_settings(index=self.es_index_name, body={"index": settings})
+        return previous
 
     def _add_phonetics(self, doc):
         if doc['Header']['En']:
@@ -49,7 +121,8 @@ class MongoToEsDumper(object):
         options = s.split(' ')
         doc['dm_soundex'] = options
 
-    def _process_doc(self, collection, doc):
+    def _get_action(self, collection, doc):
+        ''' returns the bulk index action of the doc, with the doc already serialized '''
         _id = doc['_id']
         del doc['_id']
         del doc['UnitHeaderDMSoundex']
@@ -62,26 +135,47 @@ class MongoToEsDumper(object):
             if not header[lang]:
                 header[lang] = '1234567890'
             header["{}_lc".format(lang)] = header[lang].lower()
-        res = None
+        action = {"_index": self.es_index_name, "_type": collection, "_id": str(_id)}
+        # UUID fields are causing es to crash, turn them to strings
+        uuids_to_str(doc)
         try:
-            res = app.es.index(index=self.es_index_name, doc_type=collection, id=_id, body=doc)
-        except elasticsearch.exceptions.SerializationError:
-            # UUID fields are causing es to crash, turn them to strings
-            uuids_to_str(doc)
-            try:
-                res = app.es.index(index=self.es_index_name, doc_type=collection, id=_id, body=doc)
-            except elasticsearch.exceptions.SerializationError as e:
-                import pdb
-                pdb.set_trace()
-        except elasticsearch.exceptions.RequestError as e:
-            import pdb
-            pdb.set_trace()
-        return res
+            # a doc that can't be serialized would fail its whole chunk in the bulk helpers
+            action["_source"] = self.es.transport.serializer.dumps(doc)
+        except elasticsearch.exceptions.SerializationError as e:
+            self._add_dead_letter(collection, dict(action, error=str(e)))
+            return None
+        return action
+
+    def _load(self, collections):
+        previous_settings = self._set_index_settings(self.INGEST_SETTINGS)
+        try:
+            for collection in collections:
+                self._process_collection(collection)
+        finally:
+            self._set_index_settings(previous_settings)
+            self.es.indices.refresh(index=self.es_index_name)
 
     def main(self, collections, delete_existing=False):
-        ElasticsearchCreateIndexCommand().create_es_index(self.es, self.es_index_name, delete_existing=delete_existing)
-        for collection in collections:
-            self._process_collection(collection)
+        create_index_command = ElasticsearchCreateIndexCommand()
+        if delete_existing:
+            # the current index keeps serving searches until the new version is loaded
+            # N.B. docs updated in the current index during the load are not copied to the new version
+            alias_name = self.es_index_name
+            self.es_index_name = create_index_command.create_versioned_index(self.es, alias_name, self.profile)
+            try:
+                self._load(collections)
+            except:
+                self.es.indices.delete(self.es_index_name)
+                raise
+            create_index_command.swap_alias(self.es, alias_name, self.es_index_name)
+            create_index_command.prune_versions(self.es, alias_name, keep=self.keep_versions)
+        else:
+            create_index_command.create_es_index(self.es, self.es_index_name, profile=self.profile)
+            self._load(collections)
+        if self.num_failed:
+            print '{} docs failed to index, see {}'.format(self.num_failed, self.dead_letter_file)
+        invalidate_cache("search", app=self.app)
+        invalidate_cache("search_index", app=self.app)
 
 
 if __name__ == '__main__':
@@ -90,4 +184,6 @@ if __name__ == '__main__':
     app, conf = create_app()
     db = app.data_db if not args.db else app.client_data_db[args.db]
     collections = SEARCHABLE_COLLECTIONS if not args.collection else [args.collection]
-    MongoToEsDumper(es=app.es, es_index_name=db.name, mongo_db=db).main(delete_existing=args.remove, collections=collections)
+    MongoToEsDumper(app=app, es=app.es, es_index_name=db.name, mongo_db=db, chunk_size=args.chunk_size, thread_count=args.threads,
+                    dead_letter_file=args.dead_letter, keep_versions=args.keep_versions,
+                    profile=args.profile).main(delete_existing=args.remove, collections=collections)
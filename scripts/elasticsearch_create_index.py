@@ -7,6 +7,10 @@ from bhs_api.constants import PIPELINES_ES_DOC_TYPE, SUPPORTED_SUGGEST_LANGS
 import time
 
 
+# the index mapping variants, performance is tuned for the search queries
+PROFILES = ("default", "performance")
+
+
 class ElasticsearchCreateIndexCommand(object):
 
     def _parse_args(self):
@@ -15,6 +19,7 @@ class ElasticsearchCreateIndexCommand(object):
         parser.add_argument('--host', help="elasticsearch host to create the index in (default to host from app)")
         parser.add_argument('--force', action="store_true", help="delete existing index if exists")
         parser.add_argument('--ensure', action="store_true", help="optimistically ensure index exists")
+        parser.add_argument('--profile', choices=PROFILES, default="default", help="mapping profile of the index")
         return parser.parse_args()
 
     @property
@@ -82,8 +87,17 @@ class ElasticsearchCreateIndexCommand(object):
         #     }
 
 
-    def _get_index_body(self):
-        return {"mappings": {PIPELINES_ES_DOC_TYPE: {"properties": self.get_properties(),
+    def get_performance_properties(self):
+        properties = self.get_properties()
+        # only returned or sorted on, never searched - no need for the inverted index
+        properties["main_thumbnail_image_url"] = {"type": "keyword", "index": False}
+        properties["main_image_url"] = {"type": "keyword", "index": False}
+        properties["period_startdate"] = {"type": "date", "index": False}
+        return properties
+
+    def _get_index_body(self, profile="default"):
+        properties = self.get_performance_properties() if profile == "performance" else self.get_properties()
+        return {"mappings": {PIPELINES_ES_DOC_TYPE: {"properties": properties,
                                                      "dynamic_templates": self.get_dynamic_templates()}}}
 
     def _is_index_exists(self, es, es_index_name, ensure, try_num=1):
@@ -98,7 +112,45 @@ class ElasticsearchCreateIndexCommand(object):
             else:
                 raise
 
-    def create_es_index(self, es, es_index_name, delete_existing=False, ensure=False):
+    def get_version_index_name(self, alias_name):
+        return "{}_v{}".format(alias_name, time.strftime("%Y%m%d%H%M%S"))
+
+    def create_versioned_index(self, es, alias_name, profile="default"):
+        """
+        create a new version of the index, to be filled while the current version keeps serving the alias
+        returns the name of the new index
+        """
+        index_name = self.get_version_index_name(alias_name)
+        print("creating index {}..".format(index_name))
+        es.indices.create(index_name, body=self._get_index_body(profile))
+        return index_name
+
+    def swap_alias(self, es, alias_name, index_name):
+        """ point the alias to the index, in a single atomic update of the aliases """
+        actions = [{"add": {"index": index_name, "alias": alias_name}}]
+        if es.indices.exists_alias(name=alias_name):
+            actions = [{"remove": {"index": old_index_name, "alias": alias_name}}
+                       for old_index_name in es.indices.get_alias(name=alias_name)] + actions
+        elif es.indices.exists(alias_name):
+            # an index from before the versioned indices, its name can only be used for the alias once it's deleted,
+            # it's deleted in the same update so searches don't fail in between or if the update fails
+            print("replacing unversioned index {}".format(alias_name))
+            actions = [{"remove_index": {"index": alias_name}}] + actions
+        es.indices.update_aliases(body={"actions": actions})
+        print("alias {} points to {}".format(alias_name, index_name))
+
+    def prune_versions(self, es, alias_name, keep=1):
+        """ delete the old versions of the index, except the current one and the last `keep` versions before it """
+        versions = es.indices.get_alias(index="{}_v*".format(alias_name))
+        current = [name for name, info in versions.items() if alias_name in info.get("aliases", {})]
+        if not current:
+            return
+        old_versions = sorted(name for name in versions if name < min(current))
+        for name in old_versions[:max(len(old_versions) - keep, 0)]:
+            print("deleting old version {}".format(name))
+            es.indices.delete(name)
+
+    def create_es_index(self, es, es_index_name, delete_existing=False, ensure=False, profile="default"):
         if ensure:
             print("sleeping 5 seconds to let elasticsearch start properly")
             time.sleep(5)
@@ -112,7 +164,7 @@ class ElasticsearchCreateIndexCommand(object):
                 print("deleting existing index")
                 es.indices.delete(es_index_name)
             print("creating index..")
-            es.indices.create(es_index_name, body=self._get_index_body())
+            es.indices.create(es_index_name, body=self._get_index_body(profile))
             print("Great success!")
 
     def main(self):
@@ -126,7 +178,7 @@ class ElasticsearchCreateIndexCommand(object):
         es = elasticsearch.Elasticsearch(host_name) if host_name else app.es
         if not index_name:
             index_name = app.es_data_db_index_name
-        self.create_es_index(es, index_name, delete_existing=args.force, ensure=args.ensure)
+        self.create_es_index(es, index_name, delete_existing=args.force, ensure=args.ensure, profile=args.profile)
 
 
 if __name__ == '__main__':
@@ -5,7 +5,10 @@ from bhs_api import create_app
 from bhs_api.utils import SEARCHABLE_COLLECTIONS
 from bhs_api.item import get_collection_id_field
 from bhs_api.item import doc_show_filter, update_es, get_show_metadata
+from bhs_api.cache import invalidate_cache
 import sys
+import time
+import multiprocessing
 from datetime import datetime
 from traceback import print_exc
 import elasticsearch.helpers
@@ -20,9 +23,17 @@ class EnsureRequiredMetadataCommand(object):
     DELETED_ITEM = 3
     NO_UPDATE_NEEDED = 4
 
+    # number of elasticsearch updates / deletes to send in a single bulk request in merge mode
+    BULK_SIZE = 500
+    # seconds between the throughput messages
+    PROGRESS_INTERVAL = 10
+
     def __init__(self, app=None):
         self.args = self._parse_args()
         self.app, self.conf = create_app() if not app else (app, app.conf)
+        # pending bulk actions in merge mode, None writes each action on its own
+        self._bulk_actions = None
+        self._start_progress("")
 
     def _parse_args(self):
         parser = ArgumentParser()
@@ -33,6 +44,9 @@ class EnsureRequiredMetadataCommand(object):
         parser.add_argument('--legacy', action="store_true", help="sync with legacy collections as well (for development/testing purposes only)")
         parser.add_argument('--limit', type=int, help="process up to LIMIT results - good for development / testing")
         parser.add_argument('--index', help="use this Elasticsearch index instead of the index from configuration")
+        parser.add_argument('--workers', type=int, default=1, help="split each collection to key ranges and process them in WORKERS processes")
+        parser.add_argument('--merge', action="store_true", help="merge-join the mongo and elasticsearch items, both sorted by key, "
+                                                                 "and write the updates in bulk - much faster for big collections")
         return parser.parse_args()
 
     def _debug(self, msg):
@@ -74,10 +88,10 @@ class EnsureRequiredMetadataCommand(object):
                 # need to copy the relevant metadata for deciding whether to show the item
                 updates.update(get_show_metadata(collection_name, mongo_item))
         if len(updates) > 0:
-            self.app.es.update(index=self._get_elasticsearch_index_name(),
-                               doc_type=collection_name,
-                               id=self._get_elasticsearch_doc_id_from_item_key(collection_name, item_key),
-                               body={"doc": updates})
+            self._write_elasticsearch({"_op_type": "update",
+                                       "_type": collection_name,
+                                       "_id": self._get_elasticsearch_doc_id_from_item_key(collection_name, item_key),
+                                       "doc": updates})
             return self.UPDATED_METADATA, "updated {} keys in elasticsearch ({})".format(len(updates), self._get_item_log_identifier(item_key, collection_name))
         else:
             return self.NO_UPDATE_NEEDED, "item has correct metadata, no update needed: ({})".format(self._get_item_log_identifier(item_key, collection_name))
@@ -91,7 +105,7 @@ class EnsureRequiredMetadataCommand(object):
             return self.ERROR, "error adding item ({}): {}".format(self._get_item_log_identifier(item_key, collection_name), msg)
 
     def _del_item(self, item_key, mongo_item, collection_name, es_item):
-        self.app.es.delete(index=self._get_elasticsearch_index_name(), doc_type=collection_name, id=self._get_elasticsearch_doc_id_from_item_key(collection_name, item_key))
+        self._delete_elasticsearch_item(collection_name, item_key)
         return self.DELETED_ITEM, "deleted item: ({})".format(self._get_item_log_identifier(item_key, collection_name))
 
     def _update_item(self, item_key, show_item, exists_in_elasticsearch, mongo_item, collection_name, es_item):
@@ -154,23 +168,48 @@ class EnsureRequiredMetadataCommand(object):
         else:
             return {"term": {get_collection_id_field(collection_name): item_key}}
 
-    def _process_mongo_item(self, collection_name, mongo_item):
+    def _write_elasticsearch(self, action):
+        action["_index"] = self._get_elasticsearch_index_name()
+        if self._bulk_actions is not None:
+            self._bulk_actions.append(action)
+        elif action["_op_type"] == "update":
+            self.app.es.update(index=action["_index"], doc_type=action["_type"], id=action["_id"], body={"doc": action["doc"]})
+        else:
+            self.app.es.delete(index=action["_index"], doc_type=action["_type"], id=action["_id"])
+
+    def _delete_elasticsearch_item(self, collection_name, item_key):
+        self._write_elasticsearch({"_op_type": "delete",
+                                   "_type": collection_name,
+                                   "_id": self._get_elasticsearch_doc_id_from_item_key(collection_name, item_key)})
+
+    def _flush_bulk_actions(self, errors, force=False):
+        if self._bulk_actions and (force or len(self._bulk_actions) >= self.BULK_SIZE):
+            _, bulk_errors = elasticsearch.helpers.bulk(self.app.es, self._bulk_actions,
+                                                        raise_on_error=False, raise_on_exception=False)
+            for error in bulk_errors:
+                for op_type, op_result in error.items():
+                    errors.append("elasticsearch bulk {} failed ({}): {}".format(op_type, op_result.get("_id"),
+                                                                                op_result.get("error", op_result)))
+            self._bulk_actions = []
+
+    def _process_mongo_item(self, collection_name, mongo_item, hits=None):
         """
-        process and update a single mongo item
+        process and update a single mongo item, hits are its elasticsearch items - searched if not given
          returns tuple (code, msg, processed_key)
         """
         item_key = self._get_mongo_item_key(collection_name, mongo_item)
         if item_key:
             self._debug("processing mongo item ({})".format(self._get_item_log_identifier(item_key, collection_name)))
             show_item = doc_show_filter(collection_name, mongo_item)  # should this item be shown or not?
-            body = {"query": self._get_elasticsearch_item_key_query(collection_name, item_key)}
-            try:
-                res = self.app.es.search(index=self._get_elasticsearch_index_name(), doc_type=collection_name, body=body)
-            except Exception as e:
-                self._info("exception processing mongo item from collection {} ({}): {}".format(collection_name, self._get_item_log_identifier(item_key, collection_name), str(e)))
-                res = {}
-                # raise
-            hits = res.get("hits", {}).get("hits", [])
+            if hits is None:
+                body = {"query": self._get_elasticsearch_item_key_query(collection_name, item_key)}
+                try:
+                    res = self.app.es.search(index=self._get_elasticsearch_index_name(), doc_type=collection_name, body=body)
+                except Exception as e:
+                    self._info("exception processing mongo item from collection {} ({}): {}".format(collection_name, self._get_item_log_identifier(item_key, collection_name), str(e)))
+                    res = {}
+                    # raise
+                hits = res.get("hits", {}).get("hits", [])
             if len(hits) > 1:
                 raise Exception("more then 1 hit for item ({})".format(self._get_item_log_identifier(item_key, collection_name)))
             elif len(hits) == 1:
@@ -193,7 +232,7 @@ class EnsureRequiredMetadataCommand(object):
             if item_key in processed_mongo_item_keys:
                 return self.NO_UPDATE_NEEDED, "elasticsearch item exists in mongo - it would have been updated from mongo side", item_key
             else:
-                self.app.es.delete(index=self._get_elasticsearch_index_name(), doc_type=collection_name, id=self._get_elasticsearch_doc_id_from_item_key(collection_name, item_key))
+                self._delete_elasticsearch_item(collection_name, item_key)
                 return self.DELETED_ITEM, "deleted an item which exists in elastic but not in mongo", item_key
         else:
             raise Exception("invalid elasticsearch item key for collection {}, elasticsearch item: {}".format(collection_name, es_item))
@@ -206,6 +245,7 @@ class EnsureRequiredMetadataCommand(object):
         # collection_name param is used in tests/test_migration.py
         code, msg, processed_key = results
         self._debug(msg)
+        self._report_progress()
         if code:
             num_actions[code] = num_actions.get(code, 0) + 1
             if self.args.debug:
@@ -220,26 +260,61 @@ class EnsureRequiredMetadataCommand(object):
             sys.stdout.flush()
             return None
 
+    def _start_progress(self, label):
+        self._progress_label = label
+        self._progress_started = self._progress_time = time.time()
+        self._num_processed = self._progress_num_processed = 0
+
+    def _report_progress(self):
+        self._num_processed += 1
+        now = time.time()
+        if now - self._progress_time >= self.PROGRESS_INTERVAL:
+            self._info("{}processed {} items, {:.0f} items/sec ({:.0f} items/sec overall)".format(
+                self._progress_label, self._num_processed,
+                (self._num_processed - self._progress_num_processed) / (now - self._progress_time),
+                self._num_processed / (now - self._progress_started)))
+            self._progress_time, self._progress_num_processed = now, self._num_processed
+
     def _limit(self, items):
         if self.args.limit:
             return islice(items, 0, self.args.limit)
         else:
             return items
 
-    def _get_mongo_items(self, collection_name, key):
+    def _get_mongo_items(self, collection_name, key, key_range=None):
         if key:
             if collection_name == "persons":
                 raise NotImplementedError("persons does not support updating by key yet")
             else:
                 items = self.app.data_db[collection_name].find({get_collection_id_field(collection_name): key})
         else:
-            items = self.app.data_db[collection_name].find()
+            items = self.app.data_db[collection_name].find(self._get_mongo_key_range_query(collection_name, key_range))
         items = self._limit(items)
         return items
 
-    def _process_mongo_items(self, collection_name, errors, key, num_actions, processed_keys):
+    def _get_key_range_bounds(self, key_range, gte, lt):
+        bounds = {}
+        if key_range and key_range[0] is not None:
+            bounds[gte] = key_range[0]
+        if key_range and key_range[1] is not None:
+            bounds[lt] = key_range[1]
+        return bounds
+
+    def _get_mongo_key_range_query(self, collection_name, key_range):
+        """ key ranges are of the first key field, (None, None) is the whole collection """
+        bounds = self._get_key_range_bounds(key_range, "$gte", "$lt")
+        return {self._get_key_fields(collection_name)[0][0]: bounds} if bounds else {}
+
+    def _get_elasticsearch_key_range_query(self, collection_name, key_range):
+        bounds = self._get_key_range_bounds(key_range, "gte", "lt")
+        if bounds:
+            return {"range": {self._get_key_fields(collection_name)[1][0]: bounds}}
+        else:
+            return {"match_all": {}}
+
+    def _process_mongo_items(self, collection_name, errors, key, num_actions, processed_keys, key_range=None):
         num_processed_keys = 0
-        items = self._get_mongo_items(collection_name, key)
+        items = self._get_mongo_items(collection_name, key, key_range)
         if self.args.legacy and collection_name == "persons":
             # persons data used to be in genTreeIndividuals, in legacy mode we process those items as well
             self._info("processing legacy genTreeIndividuals items as well")
@@ -247,7 +322,7 @@ class EnsureRequiredMetadataCommand(object):
         for item in items:
             processed_key = self._handle_process_item_results(num_actions, errors, self._process_mongo_item(collection_name, item), collection_name)
             if processed_key:
-                processed_keys.append(processed_key)
+                processed_keys.add(processed_key)
             num_processed_keys += 1
         if num_processed_keys == 0:
             self._info("no items found in mongo")
@@ -255,7 +330,8 @@ class EnsureRequiredMetadataCommand(object):
             self._info("processed {} mongo items".format(num_processed_keys))
         return num_processed_keys
 
-    def _process_elasticsearch_items(self, collection_name, errors, key, num_actions, processed_mongo_keys, processed_elasticsearch_keys):
+    def _process_elasticsearch_items(self, collection_name, errors, key, num_actions, processed_mongo_keys, processed_elasticsearch_keys,
+                                     key_range=None):
         num_processed_keys = 0
         if key:
             if collection_name == "persons":
@@ -263,13 +339,16 @@ class EnsureRequiredMetadataCommand(object):
             else:
                 body = {"query": self._get_elasticsearch_item_key_query(collection_name, key)}
                 items = elasticsearch.helpers.scan(self.app.es, index=self._get_elasticsearch_index_name(), doc_type=collection_name, scroll=u"3h", query=body)
+        elif key_range:
+            body = {"query": self._get_elasticsearch_key_range_query(collection_name, key_range)}
+            items = elasticsearch.helpers.scan(self.app.es, index=self._get_elasticsearch_index_name(), doc_type=collection_name, scroll=u"3h", query=body)
         else:
             items = elasticsearch.helpers.scan(self.app.es, index=self._get_elasticsearch_index_name(), doc_type=collection_name, scroll=u"3h")
         items = self._limit(items)
         for item in items:
             processed_key = self._handle_process_item_results(num_actions, errors, self._process_elasticsearch_item(collection_name, item, processed_mongo_keys), collection_name)
             if processed_key:
-                processed_elasticsearch_keys.append(processed_key)
+                processed_elasticsearch_keys.add(processed_key)
             num_processed_keys += 1
         if num_processed_keys == 0:
             self._info("no items found in elasticsearch")
@@ -277,18 +356,145 @@ class EnsureRequiredMetadataCommand(object):
             self._info("processed {} elasticsearch items".format(num_processed_keys))
         return num_processed_keys
 
+    def _get_key_fields(self, collection_name):
+        """ returns the mongo and the elasticsearch fields of the item key """
+        if collection_name == "persons":
+            return ["tree_num", "tree_version", "id"], ["tree_num", "tree_version", "person_id"]
+        else:
+            id_field = get_collection_id_field(collection_name)
+            return [id_field], [id_field]
+
+    def _get_elasticsearch_sort_fields(self, collection_name):
+        """ the elasticsearch key fields to sort on - the person_id strings are mapped dynamically as text,
+            which can't be sorted on, so its keyword subfield is used instead """
+        return ["{}.keyword".format(field) if field == "person_id" else field
+                for field in self._get_key_fields(collection_name)[1]]
+
+    def _iter_sorted_items(self, items, get_key, source):
+        """ yields the (key, item) of the items, which must be sorted by key """
+        last_key = None
+        for item in items:
+            item_key = get_key(item)
+            if item_key is None:
+                raise Exception("invalid {} item key: {}".format(source, item))
+            if last_key is not None and item_key < last_key:
+                raise Exception("{} items are not sorted by key ({} after {}) - run without --merge".format(source, item_key, last_key))
+            last_key = item_key
+            yield item_key, item
+
+    def _merge_items(self, collection_name, errors, num_actions, processed_mongo_keys, processed_elasticsearch_keys, key_range=None):
+        """
+        walk the mongo and the elasticsearch items of the collection together, both
+        sorted by key, so each item is matched without searching for it
+        """
+        if self.args.legacy:
+            raise Exception("legacy items are not supported with --merge")
+        mongo_fields = self._get_key_fields(collection_name)[0]
+        mongo_items = self.app.data_db[collection_name].find(self._get_mongo_key_range_query(collection_name, key_range))
+        mongo_items = mongo_items.sort([(field, 1) for field in mongo_fields])
+        es_items = elasticsearch.helpers.scan(self.app.es, index=self._get_elasticsearch_index_name(), doc_type=collection_name,
+                                              scroll=u"3h", preserve_order=True,
+                                              query={"query": self._get_elasticsearch_key_range_query(collection_name, key_range),
+                                                     "sort": [{field: "asc"} for field in self._get_elasticsearch_sort_fields(collection_name)]})
+        mongo_items = self._iter_sorted_items(self._limit(mongo_items), lambda item: self._get_mongo_item_key(collection_name, item), "mongo")
+        es_items = self._iter_sorted_items(self._limit(es_items), lambda item: self._get_elasticsearch_item_key(collection_name, item["_source"]), "elasticsearch")
+        mongo_key, mongo_item = next(mongo_items, (None, None))
+        es_key, es_item = next(es_items, (None, None))
+        last_es_key = None
+        self._bulk_actions = []
+        try:
+            while mongo_key is not None or es_key is not None:
+                if es_key is None or (mongo_key is not None and mongo_key < es_key):
+                    # only in mongo
+                    results = self._process_mongo_item(collection_name, mongo_item, hits=[])
+                    mongo_key, mongo_item = next(mongo_items, (None, None))
+                    processed_keys = processed_mongo_keys
+                elif mongo_key is None or es_key < mongo_key:
+                    if es_key == last_es_key:
+                        results = self.ERROR, "more then 1 hit for item ({})".format(self._get_item_log_identifier(es_key, collection_name)), None
+                    else:
+                        # only in elasticsearch
+                        results = self._process_elasticsearch_item(collection_name, es_item, processed_mongo_keys)
+                    last_es_key = es_key
+                    es_key, es_item = next(es_items, (None, None))
+                    processed_keys = processed_elasticsearch_keys
+                else:
+                    results = self._process_mongo_item(collection_name, mongo_item, hits=[es_item])
+                    last_es_key = es_key
+                    mongo_key, mongo_item = next(mongo_items, (None, None))
+                    es_key, es_item = next(es_items, (None, None))
+                    processed_keys = processed_mongo_keys
+                processed_key = self._handle_process_item_results(num_actions, errors, results, collection_name)
+                if processed_key:
+                    processed_keys.add(processed_key)
+                self._flush_bulk_actions(errors)
+            self._flush_bulk_actions(errors, force=True)
+        finally:
+            self._bulk_actions = None
+        self._info("processed {} mongo items and {} elasticsearch items".format(len(processed_mongo_keys), len(processed_elasticsearch_keys)))
+
     def _get_elasticsearch_index_name(self):
         if self.args.index:
             return self.args.index
         else:
             return self.app.es_data_db_index_name
 
+    def _process_collection_items(self, collection_name, key, key_range=None):
+        """
+        process the items of the collection, or only the items in the key range
+         returns tuple (errors, num_actions, number of processed keys)
+        """
+        self._start_progress("{} {}: ".format(collection_name, key_range) if key_range else "{}: ".format(collection_name))
+        errors, processed_mongo_keys, processed_elasticsearch_keys, num_actions = [], set(), set(), {}
+        if self.args.merge and not key:
+            self._merge_items(collection_name, errors, num_actions, processed_mongo_keys, processed_elasticsearch_keys, key_range)
+        else:
+            self._process_mongo_items(collection_name, errors, key, num_actions, processed_mongo_keys, key_range)
+            self._process_elasticsearch_items(collection_name, errors, key, num_actions, processed_mongo_keys, processed_elasticsearch_keys,
+                                              key_range)
+        return errors, num_actions, len(processed_mongo_keys) + len(processed_elasticsearch_keys)
+
+    def _get_key_ranges(self, collection_name, num_ranges):
+        """ split the collection to key ranges of about the same number of mongo items """
+        field = self._get_key_fields(collection_name)[0][0]
+        collection = self.app.data_db[collection_name]
+        total = collection.count()
+        bounds = []
+        for i in range(1, num_ranges):
+            for item in collection.find({field: {"$ne": None}}, {field: 1}).sort(field, 1).skip(total * i // num_ranges).limit(1):
+                if not bounds or item[field] > bounds[-1]:
+                    bounds.append(item[field])
+        bounds = [None] + bounds + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    def _process_collection_in_workers(self, collection_name):
+        key_ranges = self._get_key_ranges(collection_name, self.args.workers)
+        self._info("processing {} key ranges in {} workers".format(len(key_ranges), self.args.workers))
+        errors, num_actions, num_processed_keys, num_done_ranges = [], {}, 0, 0
+        started = time.time()
+        pool = multiprocessing.Pool(self.args.workers, _init_worker)
+        try:
+            for range_errors, range_num_actions, range_num_processed_keys in pool.imap_unordered(
+                    _process_key_range, [(collection_name, key_range) for key_range in key_ranges]):
+                errors += range_errors
+                for code, num in range_num_actions.items():
+                    num_actions[code] = num_actions.get(code, 0) + num
+                num_processed_keys += range_num_processed_keys
+                num_done_ranges += 1
+                self._info("{}/{} key ranges done, {} items, {:.0f} items/sec".format(
+                    num_done_ranges, len(key_ranges), num_processed_keys, num_processed_keys / (time.time() - started)))
+        finally:
+            pool.close()
+            pool.join()
+        return errors, num_actions, num_processed_keys
+
     def _process_collection(self, collection_name, key):
         self._info("processing collection {}{}".format(collection_name, " key {}".format(key) if key else ""))
-        errors, processed_mongo_keys, processed_elasticsearch_keys, num_actions = [], [], [], {}
-        self._process_mongo_items(collection_name, errors, key, num_actions, processed_mongo_keys)
-        self._process_elasticsearch_items(collection_name, errors, key, num_actions, processed_mongo_keys, processed_elasticsearch_keys)
-        self._info("total {} items were processed:".format(len(processed_mongo_keys) + len(processed_elasticsearch_keys) + len(errors)))
+        if self.args.workers > 1 and not key:
+            errors, num_actions, num_processed_keys = self._process_collection_in_workers(collection_name)
+        else:
+            errors, num_actions, num_processed_keys = self._process_collection_items(collection_name, key)
+        self._info("total {} items were processed:".format(num_processed_keys + len(errors)))
         if len(errors) > 0:
             self._info("{} errors (see error.log for details)".format(len(errors)))
             with open("error.log", "a") as f:
@@ -313,6 +519,23 @@ class EnsureRequiredMetadataCommand(object):
         else:
             for collection_name in collection_names:
                 self._process_collection(collection_name, key)
+            # the index was modified - cached search results and the objects built from the index might be stale
+            invalidate_cache("search", app=self.app)
+            invalidate_cache("search_index", app=self.app)
+
+
+# the command of a worker process
+_worker_command = None
+
+
+def _init_worker():
+    global _worker_command
+    _worker_command = EnsureRequiredMetadataCommand()
+
+
+def _process_key_range(args):
+    collection_name, key_range = args
+    return _worker_command._process_collection_items(collection_name, None, key_range)
 
 
 if __name__ == '__main__':
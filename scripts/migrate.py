@@ -2,12 +2,14 @@
 import re
 import os
 import sys
+import json
 import logging
 from argparse import ArgumentParser
 from decimal import Decimal
 import datetime
 import calendar
 import time
+import multiprocessing
 from functools import partial
 
 from pymongo import MongoClient
@@ -16,12 +18,14 @@ from bson.code import Code
 
 from gedcom import Gedcom, GedcomParseError
 from migration.migration_sqlclient import MigrationSQLClient
-from migration.tasks import update_row
+from migration.tasks import (update_row, update_rows, update_tree, get_update_counts, reset_update_counts,
+                             MIGRATE_BATCH_SIZE)
 from migration.files import upload_photo
 from migration.family_trees import Gedcom2Persons
 from bhs_api.utils import get_migrate_conf, create_thumb, get_unit_type
 from bhs_api import phonetic
 from bhs_api.item import get_collection_id_field
+from bhs_api.persons import get_all_places
 
 
 conf = get_migrate_conf(('queries_repo_path', 'sql_server', 'sql_user', 'sql_password',
@@ -38,6 +42,12 @@ logger.setLevel(logging.getLevelName('INFO'))
 
 repeated_slugs = {'He': {}, 'En': {}}
 
+# parsed rows waiting to be sent in a single update_rows task, by collection name
+pending_rows = {}
+
+# the MigrateCheckpoint of the run, None in dryrun
+checkpoint = None
+
 split = lambda x: re.split(',|\||;| ', x)
 
 def parse_args():
@@ -53,9 +63,95 @@ def parse_args():
     parser.add_argument('--lasthours',
                         help="migrate all content changed in the last LASTHOURS")
     parser.add_argument('--dryrun', help="don't update data, just print what will be done")
+    parser.add_argument('--batch-size', type=int, default=MIGRATE_BATCH_SIZE,
+                        help="number of rows to update in a single task, 0 updates each row in its own task")
+    parser.add_argument('--tree-workers', type=int, default=1,
+                        help="number of processes converting family trees in parallel")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted run from its checkpoint")
+    parser.add_argument('--checkpoint', default='/var/run/bhs/migrate_checkpoint',
+                        help="file to keep the progress of the run in")
 
     return parser.parse_args()
 
+class MigrateCheckpoint(object):
+    ''' a journal of the rows of each collection which were sent to the update
+        tasks, a run which was interrupted continues from it with --resume.
+        the file has a json line with the since / until of the run, and then
+        a line for every chunk of processed row keys and for every collection
+        which is done.
+    '''
+
+    def __init__(self, path, since, until, resume=False, every=1000):
+        self.path = path
+        self.every = every
+        self.done = set()
+        self.processed = {}
+        # photos of the done collections, they are updated at the end of the run
+        self.photos = []
+        self._keys = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut in the middle
+                        continue
+                    if 'since' in entry:
+                        since, until = entry['since'], entry['until']
+                    elif entry.get('done'):
+                        self.done.add(entry['collection'])
+                        self.photos += entry.get('photos', [])
+                    else:
+                        self.processed.setdefault(entry['collection'], set()).update(entry['keys'])
+            self.file = open(path, 'a')
+            # end a line that was cut in the middle
+            self.file.write('\n')
+        else:
+            self.file = open(path, 'w')
+            self._write({'since': since, 'until': until})
+        self.since, self.until = since, until
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _write_keys(self, collection_name):
+        keys = self._keys.pop(collection_name, None)
+        if keys:
+            self._write({'collection': collection_name, 'keys': keys})
+
+    def is_processed(self, collection_name, key):
+        return key in self.processed.get(collection_name, ())
+
+    def add(self, collection_name, key):
+        keys = self._keys.setdefault(collection_name, [])
+        keys.append(key)
+        if len(keys) >= self.every:
+            self._write_keys(collection_name)
+
+    def set_done(self, collection_name, photos=()):
+        self._write_keys(collection_name)
+        self._write({'collection': collection_name, 'done': True, 'photos': list(photos)})
+        self.done.add(collection_name)
+
+    def close(self, remove=False):
+        for collection_name in self._keys.keys():
+            self._write_keys(collection_name)
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def get_row_key(row, collection_name):
+    ''' the key of a sql row in the checkpoint '''
+    if collection_name == 'synonyms':
+        return row.get('SynonymKey')
+    return row.get(get_collection_id_field(collection_name))
+
+
 def get_now_str():
     format = '%d.%h-%H:%M:%S'
     now = datetime.datetime.now()
@@ -240,6 +336,9 @@ def parse_image(doc):
 
 def parse_person(doc):
     indi_doc = {}
+    # the soundex of all the names and places of the person are encoded in a single batch
+    values = list(doc.get('name') or []) + [doc[key] for key in ('BIRT_PLAC', 'MARR_PLAC', 'DEAT_PLAC') if key in doc]
+    soundex = dict(zip(values, phonetic.get_bhp_soundex_many(values)))
     for key, val in doc.items():
         if key in ('BIRT_PLAC', 'MARR_PLAC', 'DEAT_PLAC'):
             indi_doc[key] = val
@@ -252,11 +351,12 @@ def parse_person(doc):
         elif key =='name':
             indi_doc[key] = val
             indi_doc['name_lc'] = map(unicode.lower, val)
-            indi_doc['name_S'] = map(phonetic.get_bhp_soundex, val)
+            indi_doc['name_S'] = [soundex[name] for name in val]
         else:
             indi_doc[key] = val
         if key in ('BIRT_PLAC', 'MARR_PLAC', 'DEAT_PLAC'):
-             indi_doc[key + '_S'] = phonetic.get_bhp_soundex(val)
+             indi_doc[key + '_S'] = soundex[val]
+    indi_doc.update(get_all_places(doc))
 
     return indi_doc
 
@@ -291,17 +391,54 @@ def parse_doc(doc, collection_name):
     return collection_procedure_map[collection_name](doc)
 
 
-def parse_n_update(row, collection_name, dryrun=False):
+def parse_n_update(row, collection_name, dryrun=False, batch_size=0):
     doc = parse_doc(row, collection_name)
+    return queue_update(doc, collection_name, dryrun, batch_size)
+
+
+def queue_update(doc, collection_name, dryrun=False, batch_size=0):
+    ''' send a parsed doc to an update task, or to the pending rows of its
+        collection when updating in batches
+    '''
     id_field = get_collection_id_field(collection_name)
     logger.info('{}:Updating {}: {}, updated {}'.format(
         collection_name, id_field, doc[id_field],
         doc.get('UpdateDate', '?')))
     if not dryrun:
-        update_row.delay(doc, collection_name)
+        if batch_size:
+            docs = pending_rows.setdefault(collection_name, [])
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                flush_updates(collection_name)
+        else:
+            update_row.delay(doc, collection_name)
+            add_to_checkpoint(collection_name, [doc])
     return doc
 
 
+def add_to_checkpoint(collection_name, docs):
+    # persons are added to the checkpoint by their tree number after the whole tree is sent
+    if checkpoint and collection_name != 'persons':
+        id_field = get_collection_id_field(collection_name)
+        for doc in docs:
+            checkpoint.add(collection_name, doc[id_field])
+
+
+def flush_updates(collection_name=None):
+    ''' send the pending rows of the collection, or of all the collections, to update_rows tasks '''
+    for name in [collection_name] if collection_name else pending_rows.keys():
+        docs = pending_rows.pop(name, None)
+        if docs:
+            update_rows.delay(docs, name)
+            add_to_checkpoint(name, docs)
+
+
+def add_tree_to_checkpoint(tree_num):
+    if checkpoint:
+        flush_updates("persons")
+        checkpoint.add('genTrees', tree_num)
+
+
 def get_file_descriptors(tree, gedcom_path):
     ''' returns both the file_id and the full file name of the gedcom file '''
     if not gedcom_path:
@@ -312,14 +449,65 @@ def get_file_descriptors(tree, gedcom_path):
     return file_id, file_name
 
 
-def migrate_trees(cursor, only_process_treenum=None, gedcom_path=None, on_save=None, dryrun=False):
+def convert_tree(tree):
+    ''' parse the gedcom file of a tree and convert it to person docs, runs
+        in the migrate_trees worker processes.
+        returns (tree number, file name, tree meta, person docs, error)
+    '''
+    tree_num, file_id, file_name = tree
+    try:
+        gedcom_fd = open(file_name)
+        try:
+            g = Gedcom(fd=gedcom_fd)
+            persons, meta = [], {}
+            Gedcom2Persons(g, tree_num, file_id, persons.append, ontree=meta.update)
+        finally:
+            gedcom_fd.close()
+        docs = [parse_doc(person, "persons") for person in persons]
+    except Exception as e:
+        return tree_num, file_name, None, None, "{}: {}".format(e.__class__.__name__, e)
+    return tree_num, file_name, meta, docs, None
+
+
+def migrate_trees_parallel(rows, gedcom_path=None, dryrun=False, batch_size=0, workers=2):
+    ''' convert the trees in a pool of worker processes, the persons are
+        sent to the update tasks from this process as each tree is done.
+        returns how many trees were migrated
+    '''
+    trees = ((row['GenTreeNumber'],) + get_file_descriptors(row, gedcom_path) for row in rows)
+    pool = multiprocessing.Pool(workers)
+    num_trees = 0
+    try:
+        for tree_num, file_name, meta, docs, error in pool.imap_unordered(convert_tree, trees):
+            num_trees += 1
+            if error:
+                logger.error('failed to migrate tree number {}, path {}: {}'.format(tree_num, file_name, error))
+                continue
+            if not dryrun:
+                update_tree.delay(meta)
+            for doc in docs:
+                queue_update(doc, "persons", dryrun, batch_size)
+            add_tree_to_checkpoint(tree_num)
+            logger.info('<<< migrated tree {}, path {}'.format(tree_num, file_name))
+    finally:
+        pool.close()
+        pool.join()
+    flush_updates("persons")
+    return num_trees
+
+
+def migrate_trees(cursor, only_process_treenum=None, gedcom_path=None, on_save=None, dryrun=False, batch_size=0,
+                  workers=1):
     ''' get command line arguments and sql query and initiated update_tree
         and update_row celery tasks.
         returns how many people migrated
     '''
     collection_name = "persons"
     row_number = 0
-    filtered_rows = filter(lambda row: not only_process_treenum or row['GenTreeNumber'] == only_process_treenum, cursor)
+    filtered_rows = (row for row in cursor if (not only_process_treenum or row['GenTreeNumber'] == only_process_treenum)
+                     and not (checkpoint and checkpoint.is_processed('genTrees', row['GenTreeNumber'])))
+    if workers > 1 and not on_save:
+        return migrate_trees_parallel(filtered_rows, gedcom_path, dryrun, batch_size, workers)
     for row_number, row in enumerate(filtered_rows, start=1):
         file_id, file_name = get_file_descriptors(row, gedcom_path)
         try:
@@ -336,9 +524,12 @@ def migrate_trees(cursor, only_process_treenum=None, gedcom_path=None, on_save=N
                 if on_save and dryrun:
                     raise Exception("dryrun is not supported with on_save")
                 else:
-                    on_save = partial(parse_n_update, collection_name=collection_name, dryrun=dryrun) if not on_save else on_save
+                    on_save = partial(parse_n_update, collection_name=collection_name, dryrun=dryrun,
+                                      batch_size=batch_size) if not on_save else on_save
                     Gedcom2Persons(g, row['GenTreeNumber'], file_id, on_save)
+                    add_tree_to_checkpoint(row['GenTreeNumber'])
                     logger.info('<<< migrated tree {}, path {}'.format(row['GenTreeNumber'], file_name))
+    flush_updates(collection_name)
     return row_number
 
 
@@ -364,11 +555,24 @@ if __name__ == '__main__':
     else:
         since = int(args.since)
 
+    if not args.dryrun:
+        if args.resume and not os.path.exists(args.checkpoint):
+            logger.warn('no checkpoint in {}, starting from the beginning'.format(args.checkpoint))
+        checkpoint = MigrateCheckpoint(args.checkpoint, since, until, resume=args.resume)
+        # a resumed run continues the window of the interrupted one
+        since, until = checkpoint.since, checkpoint.until
+        if not args.resume:
+            reset_update_counts()
+
     collection = args.collection
     queries = get_queries(collection)
     logger.info('looking for changed items in {}-{}'.format(since, until))
-    photos_to_update = []
+    photos_to_update = list(checkpoint.photos) if checkpoint else []
     for collection_name, query in queries.items():
+        if checkpoint and collection_name in checkpoint.done:
+            logger.info('{}:Skipping, done before resuming'.format(collection_name))
+            continue
+        collection_photos = len(photos_to_update)
         if collection_name == 'genTrees':
             # the family trees get special treatment
             # TODO: don't give them special treatment..
@@ -376,7 +580,8 @@ if __name__ == '__main__':
             # TODO: have all places refer to it as "persons" instead of variations on genTrees / ftrees etc..
             tree_nums = [args.unitid] if args.unitid else None
             sql_cursor = sqlClient.execute(query, since=since, until=until)
-            count = migrate_trees(sql_cursor, args.unitid, args.gedcom_path, dryrun=args.dryrun)
+            count = migrate_trees(sql_cursor, args.unitid, args.gedcom_path, dryrun=args.dryrun,
+                                  batch_size=args.batch_size, workers=args.tree_workers)
             if not count:
                 logger.info('{}:Skipping'.format(collection_name))
         else:
@@ -387,13 +592,18 @@ if __name__ == '__main__':
 
             if sql_cursor:
                 for row in sql_cursor:
-                    doc = parse_n_update(row, collection_name, dryrun=args.dryrun)
+                    if checkpoint and checkpoint.is_processed(collection_name, get_row_key(row, collection_name)):
+                        # sent before resuming, parsed only for its photos
+                        doc = parse_doc(row, collection_name)
+                    else:
+                        doc = parse_n_update(row, collection_name, dryrun=args.dryrun, batch_size=args.batch_size)
                     # collect all the photos
                     pictures = doc.get('Pictures', None)
                     if pictures:
                         for pic in pictures:
                             if 'PictureId' in pic:
                                 photos_to_update.append(pic['PictureId'])
+                flush_updates(collection_name)
             else:
                 logger.warn('failed getting updated units {}:{}'
                             .format(collection_name, ','.join(units)))
@@ -401,6 +611,9 @@ if __name__ == '__main__':
             # TODO:
             # rsync_media(collection_name)
 
+        if checkpoint:
+            checkpoint.set_done(collection_name, photos_to_update[collection_photos:])
+
     # update photos
     if len(photos_to_update) > 0:
         photos_query = get_queries('photos')['photos']
@@ -414,5 +627,11 @@ if __name__ == '__main__':
         since_file.seek(0)
         since_file.write(str(until))
         since_file.close()
+    if checkpoint:
+        checkpoint.close(remove=True)
+    # the update tasks may still be running, the counts are of the ones that are done
+    for collection_name, counts in sorted(get_update_counts().items()):
+        logger.info('{}: {}'.format(collection_name, ', '.join('{} {}'.format(count, name)
+                                                              for name, count in sorted(counts.items()))))
     logger.info("closing sql connection...")
     sqlClient.close_connections()
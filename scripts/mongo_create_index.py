@@ -1,26 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from bhs_api import create_app
+from migration.indices import get_declared_indices
 
 
 app, conf = create_app()
 
 
-# following indexes are built to support bhs_api.fsearch functionality
+# the persons indexes support bhs_api.fsearch functionality,
+# see migration.indices for the declared indexes of all the collections
 
-for field in ["name_lc.0",
-              "name_lc.1",
-              "sex",
-              "BIRT_PLAC_lc",
-              "MARR_PLAC_lc",
-              "tree_num",
-              "DEAT_PLAC_lc",
-              "marriage_years",
-              "birth_year",
-              "death_year",
-              "archived",
-              "sex",
-              "tree_num",
-              "deceased"]:
-    print("creating index for field {}".format(field))
-    app.data_db.persons.create_index(field)
+for keys, options in get_declared_indices("persons"):
+    print("creating index for {}".format(", ".join(field for field, _ in keys)))
+    app.data_db.persons.create_index(keys, **options)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from bhs_api import create_app
+from migration.indices import INDICES, UNIQUE_INDICES, get_declared_indices, get_live_indices, diff_indices
+
+
+def format_index(index):
+    keys, options = index
+    return ", ".join("{}:{}".format(field, direction) for field, direction in keys) + \
+           "".join(" ({})".format(option) for option in sorted(options))
+
+
+class MongoIndicesCommand(object):
+    ''' diff the indexes declared in migration.indices against the live ones '''
+
+    def __init__(self, app=None):
+        self.args = self._parse_args()
+        self.app, self.conf = create_app() if not app else (app, app.conf)
+
+    def _parse_args(self):
+        parser = ArgumentParser(description="diff the declared mongo indexes against the live indexes")
+        parser.add_argument('--collection', help="only diff this collection")
+        parser.add_argument('--create', action="store_true", help="create the missing indexes")
+        return parser.parse_args()
+
+    def main(self):
+        collection_names = [self.args.collection] if self.args.collection else sorted(set(INDICES) | set(UNIQUE_INDICES))
+        num_missing = 0
+        for collection_name in collection_names:
+            collection = self.app.data_db[collection_name]
+            missing, extra, changed = diff_indices(get_declared_indices(collection_name), get_live_indices(collection))
+            print("{}: {} missing, {} extra, {} changed".format(collection_name, len(missing), len(extra), len(changed)))
+            for index in missing:
+                print("  - {}".format(format_index(index)))
+            for index in extra:
+                print("  + {}".format(format_index(index)))
+            for declared, live in changed:
+                print("  ~ {} (live: {})".format(format_index(declared), format_index(live)))
+            if self.args.create:
+                for keys, options in missing:
+                    print("  creating index: {}".format(collection.create_index(keys, **options)))
+            num_missing += len(missing)
+        return num_missing
+
+
+if __name__ == '__main__':
+    MongoIndicesCommand().main()
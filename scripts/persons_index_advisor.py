@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from itertools import combinations
+import json
+import random
+import pymongo
+from bhs_api import create_app
+from bhs_api.fsearch import build_query, CURSOR_SORT, MAX_RESULTS
+
+
+# fsearch params and the person fields to take their example values from
+PARAM_FIELDS = OrderedDict([("first_name", lambda p: (p.get("name_lc") or [None])[0]),
+                            ("last_name", lambda p: (p.get("name_lc") or [None, None])[-1]),
+                            ("sex", lambda p: p.get("sex")),
+                            ("birth_place", lambda p: p.get("BIRT_PLAC_lc")),
+                            ("marriage_place", lambda p: p.get("MARR_PLAC_lc")),
+                            ("death_place", lambda p: p.get("DEAT_PLAC_lc")),
+                            ("place", lambda p: (p.get("all_places_lc") or [p.get("BIRT_PLAC_lc")])[0]),
+                            ("birth_year", lambda p: p.get("birth_year")),
+                            ("marriage_year", lambda p: (p.get("marriage_years") or [None])[0]),
+                            ("death_year", lambda p: p.get("death_year")),
+                            ("tree_number", lambda p: p.get("tree_num"))])
+
+# search modifiers of name and place params (first name is always exact)
+MODIFIERS = ("prefix", "phonetic")
+
+# the order of equality fields in recommended indexes, most selective first
+FIELD_PRIORITY = ["tree_num", "id", "name_lc.1", "name_lc.0", "all_places_lc", "all_places_S",
+                  "BIRT_PLAC_lc", "DEAT_PLAC_lc", "MARR_PLAC_lc", "sex", "deceased"]
+
+# mongo can't index more than one array field in a compound index
+ARRAY_FIELDS = ("all_places_lc", "all_places_S", "marriage_years", "name_S")
+
+
+def get_field_kind(value):
+    if hasattr(value, "pattern"):
+        return "regex"
+    elif isinstance(value, dict):
+        if "$exists" in value:
+            return "exists"
+        elif "$regex" in value:
+            return "regex"
+        else:
+            return "range"
+    else:
+        return "eq"
+
+
+def get_query_shape(query):
+    ''' returns the shape of a persons query - the fields and how they are matched
+    >>> get_query_shape({"archived": {"$exists": False}, "name_lc.1": "cohen", "birth_year": {"$gte": 1900, "$lte": 1902}})
+    (('archived', 'exists'), ('birth_year', 'range'), ('name_lc.1', 'eq'))
+    '''
+    # $and is only used for the paging cursor
+    return tuple(sorted((field, get_field_kind(value)) for field, value in query.items() if field != "$and"))
+
+
+def get_recommended_index(shape):
+    ''' equality fields first, then the fsearch sort fields and then the range fields
+    >>> get_recommended_index((('archived', 'exists'), ('birth_year', 'range'), ('name_lc.1', 'eq')))
+    [('name_lc.1', 1), ('tree_num', 1), ('tree_version', 1), ('id', 1), ('birth_year', 1)]
+    '''
+    priority = lambda field: (FIELD_PRIORITY.index(field) if field in FIELD_PRIORITY else len(FIELD_PRIORITY), field)
+    eq_fields = sorted((field for field, kind in shape if kind == "eq"), key=priority)
+    range_fields = sorted((field for field, kind in shape if kind == "regex"), key=priority)
+    range_fields += sorted((field for field, kind in shape if kind == "range"), key=priority)
+    fields = eq_fields + [field for field, _ in CURSOR_SORT if field not in eq_fields] + range_fields
+    index, has_array_field = [], False
+    for field in fields:
+        if field in ARRAY_FIELDS:
+            if has_array_field:
+                continue
+            has_array_field = True
+        index.append((field, pymongo.ASCENDING))
+    return index
+
+
+def get_explain_stats(explain):
+    ''' returns (docs examined, keys examined, returned, index name) of an explain() result '''
+    if "executionStats" in explain:
+        stats = explain["executionStats"]
+        stages = [explain["queryPlanner"]["winningPlan"]]
+        index_names = []
+        while stages:
+            stage = stages.pop()
+            if stage.get("indexName"):
+                index_names.append(stage["indexName"])
+            stages += [stage["inputStage"]] if "inputStage" in stage else stage.get("inputStages", [])
+        return (stats.get("totalDocsExamined", 0), stats.get("totalKeysExamined", 0),
+                stats.get("nReturned", 0), ",".join(index_names) or "COLLSCAN")
+    # mongo < 3.0
+    return explain.get("nscannedObjects", 0), explain.get("nscanned", 0), explain.get("n", 0), explain.get("cursor")
+
+
+class PersonsIndexAdvisorCommand(object):
+
+    def __init__(self, app=None):
+        self.args = self._parse_args()
+        self.app, self.conf = create_app() if not app else (app, app.conf)
+        self.persons = self.app.data_db["persons"]
+
+    def _parse_args(self):
+        parser = ArgumentParser(description="recommend compound indexes for the persons queries of fsearch, "
+                                            "based on the explain() of each query shape")
+        parser.add_argument('--log', help="file with a json object of fsearch params per line, "
+                                          "by default all the shapes fsearch can emit are explained")
+        parser.add_argument('--profile', action="store_true", help="use the persons queries from the mongo profiler "
+                                                                   "(system.profile collection)")
+        parser.add_argument('--max-params', type=int, default=2, help="max number of params in the generated shapes")
+        parser.add_argument('--modifiers', action="store_true", help="generate shapes with prefix / phonetic modifiers")
+        parser.add_argument('--samples', type=int, default=3, help="number of example queries to explain per shape")
+        parser.add_argument('--top', type=int, default=10, help="number of shapes to recommend indexes for")
+        parser.add_argument('--create', action="store_true", help="create the recommended indexes")
+        return parser.parse_args()
+
+    def _get_sample_persons(self, num):
+        total = self.persons.count()
+        for _ in range(num):
+            for person in self.persons.find({"archived": {"$exists": False}}).skip(random.randint(0, max(total - 1, 0))).limit(1):
+                yield person
+
+    def _get_generated_queries(self):
+        ''' yields (query, weight) for all the param combinations, with values from random persons '''
+        params = []
+        for param in PARAM_FIELDS:
+            params.append((param, None))
+            if self.args.modifiers and (param.endswith("name") or param.endswith("place")) and param != "first_name":
+                params += [(param, modifier) for modifier in MODIFIERS]
+        persons = list(self._get_sample_persons(self.args.samples))
+        for num_params in range(1, self.args.max_params + 1):
+            for combination in combinations(params, num_params):
+                if len(set(param for param, _ in combination)) < num_params or combination == (("sex", None),):
+                    continue
+                for person in persons:
+                    search_dict = {}
+                    for param, modifier in combination:
+                        value = PARAM_FIELDS[param](person)
+                        if value is None:
+                            break
+                        value = unicode(value)
+                        search_dict[param] = u"{};{}".format(value, modifier) if modifier else value
+                    else:
+                        yield build_query(search_dict, self.app.config['PERSONS_SEARCH_ALL_PLACES']), 1
+
+    def _get_logged_queries(self):
+        with open(self.args.log) as f:
+            for line in f:
+                if line.strip():
+                    params = json.loads(line)
+                    yield build_query({k: unicode(v[0] if isinstance(v, list) else v) for k, v in params.items()
+                                       if k not in ("max_results", "max_count_results", "count", "start", "cursor")},
+                                      self.app.config['PERSONS_SEARCH_ALL_PLACES']), 1
+
+    def _get_profiled_queries(self):
+        ns = "{}.persons".format(self.app.data_db.name)
+        for entry in self.app.data_db["system.profile"].find({"ns": ns, "op": "query"}):
+            query = entry.get("query", {})
+            query = query.get("$query", query.get("filter", query))
+            yield query, 1
+
+    def _get_shapes(self):
+        if self.args.log:
+            queries = self._get_logged_queries()
+        elif self.args.profile:
+            queries = self._get_profiled_queries()
+        else:
+            queries = self._get_generated_queries()
+        counts, examples = Counter(), {}
+        for query, weight in queries:
+            shape = get_query_shape(query)
+            counts[shape] += weight
+            if len(examples.setdefault(shape, [])) < self.args.samples:
+                examples[shape].append(query)
+        return counts, examples
+
+    def _explain(self, query):
+        return get_explain_stats(self.persons.find(query).sort(CURSOR_SORT).limit(MAX_RESULTS).explain())
+
+    def _is_indexed(self, index, existing_indexes):
+        return any(existing[:len(index)] == index for existing in existing_indexes)
+
+    def main(self):
+        counts, examples = self._get_shapes()
+        existing_indexes = [[(field, int(direction) if isinstance(direction, (int, float)) else direction)
+                             for field, direction in info["key"]]
+                            for info in self.persons.index_information().values()]
+        print("{:>6} {:>10} {:>10} {:>8}  {:<40} {}".format("count", "docs", "keys", "returned", "index used", "shape"))
+        recommendations = []
+        for shape, count in counts.most_common():
+            stats = [self._explain(query) for query in examples[shape]]
+            docs, keys, returned = [sum(stat[i] for stat in stats) / len(stats) for i in range(3)]
+            print("{:>6} {:>10} {:>10} {:>8}  {:<40} {}".format(count, docs, keys, returned, stats[0][3],
+                                                                ", ".join("{}:{}".format(*field) for field in shape)))
+            # an index is worth it when many more docs are examined than returned
+            if len(recommendations) < self.args.top and docs > max(returned, 1) * 2:
+                index = get_recommended_index(shape)
+                if not self._is_indexed(index, existing_indexes) and index not in recommendations:
+                    recommendations.append(index)
+        print("\nrecommended indexes:")
+        for index in recommendations:
+            print(", ".join("{}".format(field) for field, _ in index))
+            if self.args.create:
+                print("creating index: {}".format(self.persons.create_index(index, background=True)))
+                existing_indexes.append(index)
+
+
+if __name__ == '__main__':
+    PersonsIndexAdvisorCommand().main()
@@ -107,3 +107,43 @@ def get_res_dump(res):
 
 def dump_res(res):
     print(get_res_dump(res))
+
+
+class MockRedis(object):
+    """ the redis commands used by bhs_api.cache """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value)
+        return True
+
+    def delete(self, key):
+        return 1 if self.values.pop(key, None) is not None else 0
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1)
+        return int(self.values[key])
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def hincrby(self, key, field, amount):
+        pass
+
+    hincrbyfloat = hincrby
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
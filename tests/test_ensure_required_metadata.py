@@ -0,0 +1,88 @@
+import multiprocessing.dummy
+
+import pytest
+import mongomock
+
+from scripts.ensure_required_metadata import EnsureRequiredMetadataCommand
+
+
+def given_person(num, person_id, **kwargs):
+    person = {"tree_num": num, "tree_version": 0, "id": person_id, "name": ["moshe", "cohen"], "deceased": True,
+              "Slug": {"En": "person_{};0.{}".format(num, person_id)}}
+    person.update(kwargs)
+    return person
+
+
+def given_es_person(num, person_id, **kwargs):
+    source = {"tree_num": num, "tree_version": 0, "person_id": person_id, "deceased": True,
+              "Header": {"En": "moshe cohen", "He": "moshe cohen"}, "Slug": {"En": "person_{};0.{}".format(num, person_id)}}
+    source.update(kwargs)
+    return {"_source": source}
+
+
+def given_command(mocker, app, mongo_persons, es_persons, *args):
+    mocker.patch("sys.argv", ["ensure_required_metadata.py", "--merge", "--collection", "persons"] + list(args))
+    app.data_db = mongomock.MongoClient().db
+    for person in mongo_persons:
+        app.data_db["persons"].insert_one(person)
+    # elasticsearch returns the persons in the given order, only the key range query is applied
+    scan_queries = []
+    def scan(es, query=None, **kwargs):
+        scan_queries.append(query)
+        bounds = query["query"].get("range", {}).get("tree_num", {})
+        return [person for person in es_persons
+                if bounds.get("gte", person["_source"]["tree_num"]) <= person["_source"]["tree_num"] < bounds.get("lt", float("inf"))]
+    mocker.patch("elasticsearch.helpers.scan", side_effect=scan)
+    bulk_actions = []
+    def bulk(es, actions, **kwargs):
+        bulk_actions.extend(actions)
+        return len(actions), []
+    mocker.patch("elasticsearch.helpers.bulk", side_effect=bulk)
+    return EnsureRequiredMetadataCommand(app=app), scan_queries, bulk_actions
+
+
+def test_merge_persons(mocker, app):
+    command, scan_queries, bulk_actions = given_command(mocker, app,
+        [given_person(1, "I1"), given_person(1, "I2"), given_person(1, "I4", Slug={"En": "person_1;0.I4-new"})],
+        [given_es_person(1, "I1"), given_es_person(1, "I3"), given_es_person(1, "I4"), given_es_person(1, "I4")])
+    errors, num_actions, num_processed_keys = command._process_collection_items("persons", None)
+    # person_id is a text field, elasticsearch can only sort on its keyword subfield
+    assert scan_queries[0]["sort"] == [{"tree_num": "asc"}, {"tree_version": "asc"}, {"person_id.keyword": "asc"}]
+    assert num_actions == {command.NO_UPDATE_NEEDED: 1, command.DELETED_ITEM: 1, command.UPDATED_METADATA: 1}
+    # I2 is only in mongo (and --add wasn't given), the second I4 is a duplicate elasticsearch key
+    assert errors == ["could not find item in elasticsearch ((tree_num,version,id=1,0,I2))",
+                      "more then 1 hit for item ((tree_num,version,id=1,0,I4))"]
+    assert num_processed_keys == 3
+    assert [(action["_op_type"], action["_id"], action.get("doc")) for action in bulk_actions] == [
+        ("delete", "1_0_I3", None),
+        ("update", "1_0_I4", {"Slug": {"En": "person_1;0.I4-new"}})]
+
+
+def test_merge_persons_requires_sorted_items(mocker, app):
+    command, _, _ = given_command(mocker, app, [given_person(1, "I1"), given_person(1, "I2")],
+                                  [given_es_person(1, "I2"), given_es_person(1, "I1")])
+    with pytest.raises(Exception) as excinfo:
+        command._process_collection_items("persons", None)
+    assert "elasticsearch items are not sorted by key" in str(excinfo.value)
+
+
+def test_merge_persons_in_key_ranges(mocker, app):
+    mongo_persons = [given_person(1, "I1"), given_person(1, "I2"), given_person(2, "I1", Slug={"En": "person_2;0.I1-new"}),
+                     given_person(3, "I1"), given_person(4, "I1"), given_person(4, "I2")]
+    es_persons = [given_es_person(1, "I1"), given_es_person(2, "I1"), given_es_person(2, "I2"),
+                  given_es_person(3, "I1"), given_es_person(3, "I1"), given_es_person(4, "I2")]
+    command, _, bulk_actions = given_command(mocker, app, mongo_persons, es_persons)
+    expected_errors, expected_num_actions, expected_num_processed_keys = command._process_collection_items("persons", None)
+    expected_bulk_actions = list(bulk_actions)
+    command, scan_queries, bulk_actions = given_command(mocker, app, mongo_persons, es_persons, "--workers", "2")
+    # the key ranges are processed in the same process, like the pool workers would
+    mocker.patch("scripts.ensure_required_metadata._worker_command", command)
+    mocker.patch("multiprocessing.Pool", lambda processes, initializer: multiprocessing.dummy.Pool(1))
+    assert command._get_key_ranges("persons", 2) == [(None, 3), (3, None)]
+    errors, num_actions, num_processed_keys = command._process_collection_in_workers("persons")
+    assert [query["query"]["range"]["tree_num"] for query in scan_queries] == [{"lt": 3}, {"gte": 3}]
+    assert (sorted(errors), num_actions, num_processed_keys) == (sorted(expected_errors), expected_num_actions,
+                                                                 expected_num_processed_keys)
+    assert sorted(bulk_actions) == sorted(expected_bulk_actions)
+    assert num_actions == {command.NO_UPDATE_NEEDED: 3, command.DELETED_ITEM: 1, command.UPDATED_METADATA: 1}
+    assert len(errors) == 3
@@ -32,6 +32,20 @@ def test_from_search_to_item(client, app):
         assert item["collection"] == "movies"
         assert item["title_en"] == "Living Moments in Jewish Spain (English jews)"
 
+def test_multiple_items(client, app):
+    given_local_elasticsearch_client_with_test_data(app, "test_item::test_multiple_items",
+                                                    additional_index_docs={"places": [PLACES_GERMANY]})
+    items = assert_client_get(client, u"/v1/item/video_living-moments-in-jewish-spain,place_foobarbaz,"
+                                      u"invalid-slug,place_germany,וידאו_רגעים-עם-יהודי-ספרד")
+    # items are returned in the requested order, with errors in place of the bad slugs
+    assert len(items) == 5
+    assert items[0]["source_id"] == "130323"
+    assert items[1]["slug"] == "place_foobarbaz" and items[1]["error_code"] == 404
+    assert items[2]["slug"] == "invalid-slug" and items[2]["error_code"] == 404
+    assert items[2]["msg"].startswith("missing an underscore in item's slug")
+    assert items[3]["title_en"] == "GERMANY"
+    assert items[4]["source_id"] == "130323"
+
 def test_item_embedded_google_map(client, app):
     given_local_elasticsearch_client_with_test_data(app, "test_item::test_item_embedded_google_map",
                                                     additional_index_docs={"places": [PLACES_GERMANY]})
@@ -0,0 +1,107 @@
+import time
+import mongomock
+
+from bhs_api.cache import get_cache_generation
+from common import MockRedis
+from migration import tasks
+
+
+def given_migration_environment(mocker, app):
+    app.data_db = mongomock.MongoClient().db
+    app.redis = MockRedis()
+    app.es_data_db_index_name = "bh_dbs_back_pytest"
+    mocker.patch("migration.tasks.celery.redis", None)
+    mocker.patch("migration.tasks.MIGRATE_RELATED", "0")
+    mocker.patch("migration.tasks.MIGRATE_ES", "1")
+    # the actions of every elasticsearch bulk request
+    bulk_actions = []
+    def bulk(es, actions, **kwargs):
+        bulk_actions.append(list(actions))
+        return len(bulk_actions[-1]), []
+    mocker.patch("elasticsearch.helpers.bulk", side_effect=bulk)
+    return app.data_db, bulk_actions
+
+
+def given_family_name(unit_id, header, **kwargs):
+    doc = {"UnitId": unit_id, "Header": {"En": header, "He": ""}, "StatusDesc": "Completed"}
+    doc.update(kwargs)
+    return doc
+
+
+def test_update_docs_upserts_and_updates_elasticsearch(mocker, app):
+    db, bulk_actions = given_migration_environment(mocker, app)
+    db["familyNames"].insert_one(given_family_name(1, "Cohen", Slug={"En": "familyname_old-cohen"}))
+    with app.app_context():
+        tasks.update_docs(db["familyNames"], [given_family_name(1, "Cohen", StatusDesc="Draft"),
+                                              given_family_name(2, "Levi")])
+    # existing docs keep their slug and new docs get one
+    assert db["familyNames"].find_one({"UnitId": 1})["Slug"] == {"En": "familyname_old-cohen"}
+    assert db["familyNames"].find_one({"UnitId": 1})["StatusDesc"] == "Draft"
+    assert db["familyNames"].find_one({"UnitId": 2})["Slug"] == {"En": "familyname_levi"}
+    # elasticsearch docs are partially updated, with the saved slugs
+    [actions] = bulk_actions
+    assert [(action["_op_type"], action["_id"], action["doc_as_upsert"], action["doc"]["Slug"]["En"])
+            for action in actions] == [("update", 1, True, "familyname_old-cohen"),
+                                       ("update", 2, True, "familyname_levi")]
+    assert "_id" not in actions[0]["doc"]
+
+
+def test_update_docs_skips_unchanged_docs(mocker, app):
+    db, bulk_actions = given_migration_environment(mocker, app)
+    with app.app_context():
+        tasks.update_docs(db["familyNames"], [given_family_name(1, "Cohen")])
+        tasks.update_docs(db["familyNames"], [given_family_name(1, "Cohen"), given_family_name(2, "Levi")])
+    assert [[action["_id"] for action in actions] for actions in bulk_actions] == [[1], [2]]
+
+
+def test_bulk_update_es_returns_the_failed_docs(mocker, app):
+    db, bulk_actions = given_migration_environment(mocker, app)
+    mocker.patch("elasticsearch.helpers.bulk", return_value=(1, [{"update": {"_id": 2, "error": "mapping error"}}]))
+    documents = [given_family_name(1, "Cohen"), given_family_name(2, "Levi")]
+    with app.app_context():
+        assert tasks.bulk_update_es(db["familyNames"], documents) == [(documents[1], "mapping error")]
+
+
+def given_person(tree_file_id, **kwargs):
+    doc = {"tree_num": 7, "id": "I1", "tree_file_id": tree_file_id, "tree_size": 1,
+           "name_lc": ["moshe", "cohen"], "sex": "M", "deceased": True}
+    doc.update(kwargs)
+    return doc
+
+
+def test_update_docs_carries_forward_unchanged_persons(mocker, app):
+    db, bulk_actions = given_migration_environment(mocker, app)
+    mocker.patch("migration.tasks.MIGRATE_TREE_DIFF", "1")
+    db["trees"].insert_one({"num": 7, "versions": [{"file_id": "a"}, {"file_id": "b"}]})
+    with app.app_context():
+        tasks.update_docs(db["persons"], [given_person("a")])
+        db["persons"].update_one({"id": "I1"}, {"$set": {"archived": True, "related": ["person_7;0.I2"]}})
+        tasks.update_docs(db["persons"], [given_person("b")])
+    previous, person = db["persons"].find().sort("tree_version", 1)
+    assert (person["tree_version"], person["tree_file_id"], person["Slug"], "archived" in person) == (1, "b", {"En": "person_7;1.I1"}, False)
+    assert person["related"] == ["person_7;0.I2"]
+    # the previous version is kept archived, so its slug still resolves
+    assert (previous["tree_version"], previous["Slug"], previous["archived"]) == (0, {"En": "person_7;0.I1"}, True)
+    # the new version is indexed under its own id, the previous one is left in elasticsearch
+    assert [(action.get("_op_type", "index"), action["_id"]) for action in bulk_actions[-1]] == [("index", "7_1_I1")]
+    assert bulk_actions[-1][0]["_source"]["Slug"] == {"En": "person_7;1.I1"}
+    assert "cache_pending:persons_count:bh_dbs_back_pytest" in app.redis.values
+
+
+def test_update_docs_invalidates_the_search_cache(mocker, app):
+    db, bulk_actions = given_migration_environment(mocker, app)
+    mocker.patch("time.time", return_value=1000)
+    with app.app_context():
+        tasks.update_docs(db["familyNames"], [given_family_name(1, "Cohen")])
+        tasks.update_docs(db["familyNames"], [given_family_name(2, "Levi")])
+        # the invalidations are delayed, so the migration writes don't invalidate the cache over and over
+        assert get_cache_generation("search") == 0
+        time.time.return_value = 1000 + app.config["CACHING_INVALIDATION_DELAY"]
+        # and all the writes during the delay are invalidated once
+        assert get_cache_generation("search") == 1
+        assert get_cache_generation("search") == 1
+        # nothing is written when the docs didn't change
+        tasks.update_docs(db["familyNames"], [given_family_name(1, "Cohen")])
+        assert "cache_pending:search:bh_dbs_back_pytest" not in app.redis.values
+        # the objects built from the search index are only refreshed when the scripts rewrite the index
+        assert get_cache_generation("search_index") == 0
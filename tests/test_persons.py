@@ -1,9 +1,12 @@
 import json
 import logging
 import pytest
+import mongomock
 from datetime import datetime
 
-from bhs_api.fsearch import fsearch, clean_person, build_query, build_search_dict
+from bhs_api.cache import invalidate_cache
+from bhs_api.fsearch import fsearch, clean_person, build_query, build_search_dict, count_persons
+from common import MockRedis
 
 # The documentation for client is at http://werkzeug.pocoo.org/docs/0.9/test/
 
@@ -35,11 +38,13 @@ def skip_test_fsearch_api(mock_db):
             'BIRT_PLAC_lc': "acapulco"
         }]:
             mock_db['persons'].insert(i)
-    total, persons = fsearch(last_name=['Einstein'], db=mock_db)
+    res = fsearch(last_name=['Einstein'], db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 1
     assert persons[0]['tree_version'] == 1
     # searching with living person details should not return any living persons
-    total, persons = fsearch(birth_place=["Acapulco"], db=mock_db)
+    res = fsearch(birth_place=["Acapulco"], db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 1
     assert persons[0]['id'] == "I7"
 
@@ -65,10 +70,12 @@ def skip_test_fsearch_range(mock_db):
         "marriage_years": [1875, 1888]
     }]:
         mock_db['persons'].insert(i)
-    total, persons = fsearch(birth_year=["1862:2"], db=mock_db)
+    res = fsearch(birth_year=["1862:2"], db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 1
     assert persons[0]["birth_year"] == 1860
-    total, persons = fsearch(marriage_year=["1876:2"], db=mock_db)
+    res = fsearch(marriage_year=["1876:2"], db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 1
     assert persons[0]["id"] == "I7"
     assert persons[0]["marriage_years"] == [1875, 1888]
@@ -85,12 +92,19 @@ def skip_test_fsearch_results_limit(mock_db):
             'id': 'I26{}'.format(i),
             'Slug': {'En': 'person_{};0.I26{}'.format(i, i)},
         })
-    total, persons = fsearch(max_results=3, db=mock_db)
+    res = fsearch(max_results=3, db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 100
     assert len(persons) == 3
-    total, persons = fsearch(max_results=3, max_count_results=5, db=mock_db)
+    res = fsearch(max_results=3, max_count_results=5, db=mock_db)
+    total, persons = res['total'], res['items']
     assert total == 5
     assert len(persons) == 3
+    assert res['count_mode'] == 'capped' and res['total_capped']
+    res = fsearch(max_results=3, count=['capped'], db=mock_db)
+    assert res['total'] == 100 and not res['total_capped']
+    res = fsearch(max_results=3, count=['exact'], db=mock_db)
+    assert res['total'] == 100 and res['count_mode'] == 'exact'
 
 
 # TODO: re-enable once we have persons in new ES
@@ -119,6 +133,16 @@ def skip_test_fsearch_build_query():
         "archived": {"$exists": false},
         "name_lc.1": "cohen"
     }""")
+    assert build_query({"place": "Paris"}) == json.loads("""{
+        "archived": {"$exists": false},
+        "$or": [{"BIRT_PLAC_lc": "paris"}, {"MARR_PLAC_lc": "paris"}, {"DEAT_PLAC_lc": "paris"}],
+        "deceased": true
+    }""")
+    assert build_query({"place": "Paris"}, all_places=True) == json.loads("""{
+        "archived": {"$exists": false},
+        "all_places_lc": "paris",
+        "deceased": true
+    }""")
 
 # TODO: re-enable once we have persons in new ES
 def skip_test_clean_person(mock_db):
@@ -206,3 +230,63 @@ def skip_test_get_persons(client, mock_db):
     res = client.get('/v1/item/person_1;0.I1')
     assert res.status_code == 200
     assert res.json[0]['bio'] == 'yossi is a big boy' # this will FAIL in the year 2100
+
+
+def given_persons(num, **kwargs):
+    persons = mongomock.MongoClient().db['persons']
+    for i in range(num):
+        person = {'name_lc': ['moshe', 'cohen'], 'deceased': True, 'tree_num': i % 3, 'tree_version': 0,
+                  'id': 'I{}'.format(i)}
+        person.update(kwargs)
+        persons.insert_one(person)
+    return persons
+
+
+def test_count_persons_modes(app):
+    persons = given_persons(5)
+    search_dict = {'last_name': 'cohen'}
+    query = build_query(search_dict)
+    with app.app_context():
+        assert count_persons(persons, query, search_dict, 'exact', -1) == (5, 'exact', False)
+        assert count_persons(persons, query, search_dict, 'capped', 3) == (3, 'capped', True)
+        assert count_persons(persons, query, search_dict, 'capped', 5) == (5, 'capped', False)
+        # without caching the exact count is used
+        app.config['CACHING_ENABLED'] = False
+        assert count_persons(persons, query, search_dict, 'cached', -1) == (5, 'exact', False)
+        app.config['CACHING_ENABLED'] = True
+        app.redis = MockRedis()
+        assert count_persons(persons, query, search_dict, 'cached', -1) == (5, 'cached', False)
+        persons.insert_one({'name_lc': ['moshe', 'cohen'], 'tree_num': 9, 'tree_version': 0, 'id': 'I9'})
+        assert count_persons(persons, query, search_dict, 'cached', -1) == (5, 'cached', False)
+        # the migration invalidates the counts whenever it writes persons
+        invalidate_cache('persons_count')
+        assert count_persons(persons, query, search_dict, 'cached', -1) == (6, 'cached', False)
+
+
+def test_fsearch_pages(app):
+    db = given_persons(25).database
+    with app.app_context():
+        res = fsearch(last_name=['cohen'], max_results=10, db=db)
+        persons = res['items']
+        while res['next_cursor']:
+            res = fsearch(last_name=['cohen'], max_results=10, cursor=[res['next_cursor']], db=db)
+            assert res['total'] == 25
+            persons += res['items']
+        keys = [(person['tree_num'], person['tree_version'], person['id']) for person in persons]
+        assert len(set(keys)) == 25
+        assert keys == sorted(keys)
+        # start pages are not sorted, so they can't continue with a cursor
+        res = fsearch(last_name=['cohen'], max_results=10, start=['10'], db=db)
+        assert len(res['items']) == 10 and res['next_cursor'] is None
+
+
+def test_fsearch_place(app):
+    db = given_persons(3).database
+    db['persons'].update_one({'id': 'I1'}, {'$set': {'MARR_PLAC': u'Paris', 'MARR_PLAC_lc': u'paris'}})
+    with app.app_context():
+        # persons which weren't backfilled with all_places are found by the place fields
+        assert [p['id'] for p in fsearch(place=['Paris'], db=db)['items']] == ['I1']
+        app.config['PERSONS_SEARCH_ALL_PLACES'] = True
+        assert fsearch(place=['Paris'], db=db)['items'] == []
+        db['persons'].update_one({'id': 'I1'}, {'$set': {'all_places_lc': [u'paris']}})
+        assert [p['id'] for p in fsearch(place=['Paris'], db=db)['items']] == ['I1']
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from bhs_api.hebrew_dms import hebrew_dm_soundex
+from bhs_api.phonetic import get_hebrew_dms, get_hebrew_dms_many, get_bhp_soundex
+
+# the output of the hebrew_dm_server.js node server for these names, without the newline it adds
+HEBREW_DMS = {
+    u"ירושלים": u"194860 197486",
+    u"כהן לוי": u"556000 560000 800000 870000",
+    u"בורג'": u"795000",
+    u"אברהם": u"079560 079600",
+    u"שטרן": u"296000 439600",
+    u"וייס": u"740000",
+    u"ויינברג": u"767950",
+    u"פוזננסקי": u"746450 746645",
+    u"רבינוביץ": u"976740 976774",
+    u"גולדשטיין": u"578343 578436 583436 584360",
+    u"חיים": u"560000",
+    u"דוד בן גוריון": u"330000 373000 760000 579160 591600",
+    u"ייה": u"100000",
+    u"בוונה": u"760000 776000",
+    u"  רחל  ": u"958000  ",
+    u"תל-אביב": u"387700",
+    u"שרה (כהן)": u"490000 556000 560000",
+    u"ששון": u"446000 460000",
+    u"abc": u"",
+}
+
+
+def test_hebrew_dm_soundex():
+    for name, dms in HEBREW_DMS.items():
+        assert hebrew_dm_soundex(name) == dms, name
+
+
+def test_hebrew_dms():
+    # the stored codes were made by the node server, keep them byte for byte
+    for name, dms in HEBREW_DMS.items():
+        assert get_hebrew_dms(name) == dms + u"\n", name
+    assert get_hebrew_dms(u"ירושלים".encode("utf-8")) == u"194860 197486\n"
+
+
+def test_hebrew_dms_many():
+    names = HEBREW_DMS.keys() + HEBREW_DMS.keys()
+    assert get_hebrew_dms_many(names) == [HEBREW_DMS[name] + u"\n" for name in names]
+
+
+def test_bhp_soundex():
+    assert get_bhp_soundex(u"ירושלים") == 'ZZ H194860 H197486\n ZZ '
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from StringIO import StringIO
+
+from bhs_api.suggest import SuggestIndex, build_suggest_index, SHORT_PREFIX_SIZE
+from common import MockRedis
+
+
+def get_name(i):
+    # the suggest inputs are normalized to letters
+    return u"b{}{}{}".format(u"aeiou"[i % 5], u"klmnprstvz"[i // 10], u"klmnprstvz"[i % 10])
+
+
+def given_weighted_index():
+    index = SuggestIndex()
+    for i in range(60):
+        name = get_name(i)
+        index.add(u"places", u"en", [{"input": name, "weight": i % 7 + 1},
+                                     {"input": u"x" + name, "weight": 1}], name.upper())
+    index.build()
+    return index
+
+
+def get_expected_titles(prefix, size):
+    # all the inputs of the weighted index, the heaviest first, then by their key
+    inputs = sorted([(-(i % 7 + 1), get_name(i)) for i in range(60)] + [(-1, u"x" + get_name(i)) for i in range(60)])
+    titles = [key.lstrip(u"x").upper() for weight, key in inputs if key.startswith(prefix)]
+    return sorted(set(titles), key=titles.index)[:size]
+
+
+def test_complete_weighted_short_prefixes():
+    index = given_weighted_index()
+    for prefix in [u"", u"b", u"ba", u"x", u"xb", u"z"]:
+        assert index.complete(u"places", u"en", prefix, size=7) == get_expected_titles(prefix, 7)
+    assert index.complete(u"places", u"en", u"b", size=SHORT_PREFIX_SIZE) == get_expected_titles(u"b", SHORT_PREFIX_SIZE)
+
+
+def test_complete_weighted_long_prefixes():
+    index = given_weighted_index()
+    for prefix in [u"bal", u"xba", u"xbel", u"burr", u"burs"]:
+        assert index.complete(u"places", u"en", prefix, size=3) == get_expected_titles(prefix, 3)
+    # more than the precomputed titles of a short prefix
+    assert index.complete(u"places", u"en", u"b", size=50) == get_expected_titles(u"b", 50)
+
+
+def test_dump_load():
+    index = given_weighted_index()
+    index.generation, index.built_at = 3, 1000.0
+    f = StringIO()
+    index.dump(f)
+    f.seek(0)
+    loaded = SuggestIndex.load(f)
+    assert (loaded.generation, loaded.built_at) == (3, 1000.0)
+    for prefix in [u"b", u"bo", u"xbi", u"bur"]:
+        assert loaded.complete(u"places", u"en", prefix) == index.complete(u"places", u"en", prefix)
+
+
+def given_snapshot(app, tmpdir, generation, built_at):
+    index = SuggestIndex()
+    index.add(u"places", u"en", u"BOURGES", u"BOURGES")
+    index.build()
+    index.generation, index.built_at = generation, built_at
+    snapshot = tmpdir.join("suggest.json")
+    with open(str(snapshot), "w") as f:
+        index.dump(f)
+    app.config["SUGGEST_INDEX_SNAPSHOT"] = str(snapshot)
+
+
+def given_scan(mocker):
+    return mocker.patch("elasticsearch.helpers.scan", return_value=[
+        {"_source": {"collection": "places", "title_en": "BOZZOLO", "title_en_suggest": "BOZZOLO"}}])
+
+
+def test_build_suggest_index_loads_fresh_snapshot(mocker, app, tmpdir):
+    mocker.patch("time.time", return_value=1000.0)
+    app.redis = MockRedis()
+    app.redis.set("cache_gen:search_index:{}".format(app.es_data_db_index_name), 2)
+    given_snapshot(app, tmpdir, 2, 1000.0 - app.config["CACHING_TTL"] + 1)
+    scan = given_scan(mocker)
+    assert build_suggest_index(app).complete(u"places", u"en", u"bo") == [u"BOURGES"]
+    assert not scan.called
+
+
+def test_build_suggest_index_scans_stale_snapshot(mocker, app, tmpdir):
+    mocker.patch("time.time", return_value=1000.0)
+    app.redis = MockRedis()
+    app.redis.set("cache_gen:search_index:{}".format(app.es_data_db_index_name), 2)
+    scan = given_scan(mocker)
+    # the search index was rewritten since the snapshot
+    given_snapshot(app, tmpdir, 1, 1000.0)
+    assert build_suggest_index(app).complete(u"places", u"en", u"bo") == [u"BOZZOLO"]
+    # the snapshot is older than a refresh of the index
+    app.suggest_snapshot_loaded = False
+    given_snapshot(app, tmpdir, 2, 1000.0 - app.config["CACHING_TTL"] - 1)
+    assert build_suggest_index(app).complete(u"places", u"en", u"bo") == [u"BOZZOLO"]
+    assert scan.call_count == 2
+    # the scanned index is saved with the current generation
+    with open(app.config["SUGGEST_INDEX_SNAPSHOT"]) as f:
+        assert SuggestIndex.load(f).generation == 2